@@ -0,0 +1,140 @@
+"""
+Benchmark the compact intraday layout against the current HeartRateIntraday
+layout, in two SQLite databases filled with the same synthetic heart rate
+data: database size, and the latency of reading one day of data and of a
+daily mean over the whole history.
+
+Usage: PYTHONPATH=data_pipeline python3 benchmarks/bench_compact.py [-d DAYS]
+"""
+from db_tables import Base, HeartRateIntraday, HeartRateIntradayCompact
+from db_tables import IntradayDay
+from sqlalchemy import create_engine, func
+from sqlalchemy.orm import sessionmaker
+import argparse
+import intraday_compact
+import numpy as np
+import os
+import pandas as pd
+import tempfile
+import time
+
+
+def make_database(path, tables):
+    engine = create_engine("sqlite:///" + path)
+    Base.metadata.create_all(engine, tables=[t.__table__ for t in tables])
+    return engine
+
+
+def fill(engine, statement, rows):
+    connection = engine.raw_connection()
+    connection.cursor().executemany(statement, rows)
+    connection.commit()
+    connection.close()
+
+
+def time_queries(session, queries, dates, runs):
+    """Return the mean seconds of each query, over runs random dates."""
+    rng = np.random.default_rng(1)
+    sample = [dates[i] for i in rng.integers(0, len(dates), size=runs)]
+
+    results = {}
+    for name, query in queries.items():
+        start = time.perf_counter()
+        for date in sample:
+            query(date)
+        results[name] = (time.perf_counter() - start) / runs
+
+    return results
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--days", type=int, default=730,
+                        help="number of days of 1-minute heart rate data")
+    parser.add_argument("-n", "--runs", type=int, default=10,
+                        help="number of times each query is timed")
+    args = parser.parse_args()
+
+    dates = pd.date_range(end="2021-07-31", periods=args.days)
+    times = dates[0] + pd.to_timedelta(np.arange(args.days * 1440), unit="m")
+    bpm = np.random.default_rng(0).integers(50, 160, size=len(times))
+
+    with tempfile.TemporaryDirectory() as folder:
+
+        # Current layout, with DateTime columns stored as ISO strings.
+        wide_path = os.path.join(folder, "wide.db")
+        wide = make_database(wide_path, [HeartRateIntraday])
+        fill(wide, "INSERT INTO heart_rate_intraday "
+                   "(user_id, date, time, bpm) VALUES (1, ?, ?, ?)",
+             zip(times.normalize().strftime("%Y-%m-%d %H:%M:%S.%f"),
+                 times.strftime("%Y-%m-%d %H:%M:%S.%f"), bpm.tolist()))
+
+        # Compact layout.
+        compact_path = os.path.join(folder, "compact.db")
+        compact = make_database(compact_path,
+                                [IntradayDay, HeartRateIntradayCompact])
+        fill(compact, "INSERT INTO intraday_day (id, date) VALUES (?, ?)",
+             zip(intraday_compact.day_ids(dates).tolist(),
+                 dates.strftime("%Y-%m-%d %H:%M:%S.%f")))
+        day_ids = intraday_compact.day_ids(times.normalize())
+        seconds = (times - times.normalize()).total_seconds().astype(int)
+        fill(compact, "INSERT INTO heart_rate_intraday_compact "
+                      "(user_id, day_id, second_of_day, bpm) "
+                      "VALUES (1, ?, ?, ?)",
+             zip(day_ids.tolist(), seconds.tolist(), bpm.tolist()))
+        intraday_compact.create_compatibility_views(compact)
+
+        for engine in [wide, compact]:
+            engine.execute("VACUUM")
+
+        print("{days} days, {rows} rows of heart rate data:".format(
+                                            days=args.days, rows=len(times)))
+        print("  database size: {0:.1f} MiB current, {1:.1f} MiB compact "
+              "(x{2:.1f})".format(os.path.getsize(wide_path) / 2**20,
+                                  os.path.getsize(compact_path) / 2**20,
+                                  os.path.getsize(wide_path)
+                                  / os.path.getsize(compact_path)))
+
+        wide_session = sessionmaker(bind=wide)()
+        compact_session = sessionmaker(bind=compact)()
+        W, C = HeartRateIntraday, HeartRateIntradayCompact
+
+        wide_results = time_queries(wide_session, {
+            "one day": lambda date: wide_session.query(W.time, W.bpm).filter(
+                            W.date == date.to_pydatetime()).all(),
+            "daily means": lambda date: wide_session.query(
+                            W.date, func.avg(W.bpm)).group_by(W.date).all()
+            }, dates, args.runs)
+
+        compact_results = time_queries(compact_session, {
+            "one day": lambda date: compact_session.query(
+                            C.second_of_day, C.bpm).filter(
+                            C.day_id == int(intraday_compact.day_ids(
+                                                        [date])[0])).all(),
+            "daily means": lambda date: compact_session.query(
+                            C.day_id, func.avg(C.bpm)).group_by(
+                            C.day_id).all()
+            }, dates, args.runs)
+
+        view_results = time_queries(compact_session, {
+            "one day": lambda date: compact_session.execute(
+                            "SELECT time, bpm FROM heart_rate_intraday_compat "
+                            "WHERE date = :date",
+                            {"date": date.strftime("%Y-%m-%d %H:%M:%S.%f")}
+                            ).fetchall()
+            }, dates, args.runs)
+
+        for name in wide_results:
+            print("  {name:>13}: {0:8.2f} ms current, {1:8.2f} ms compact "
+                  "(x{2:.1f})".format(wide_results[name] * 1000,
+                                      compact_results[name] * 1000,
+                                      wide_results[name]
+                                      / compact_results[name], name=name))
+        print("  one day through the compatibility view: {:.2f} ms".format(
+                                            view_results["one day"] * 1000))
+
+        wide_session.close()
+        compact_session.close()
+        wide.dispose()
+        compact.dispose()
@@ -0,0 +1,54 @@
+"""
+Benchmark the decoding of 1,440-point intraday heart rate payloads followed
+by their parse into a dataframe: stdlib json, orjson (if installed), and the
+json_decoder extraction of the dataset straight into columns.
+
+Usage: PYTHONPATH=data_pipeline python3 benchmarks/bench_decoding.py [-n RUNS]
+"""
+from pipeline import ResponseParser
+import argparse
+import emulator_payloads as payloads
+import json
+import json_decoder
+import pandas as pd
+import timeit
+
+
+if __name__ == "__main__":
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("-n", "--runs", type=int, default=200,
+                            help="number of decodes timed per decoder")
+    args = arg_parser.parse_args()
+
+    date = pd.to_datetime("2021-07-24")
+    parser = ResponseParser()
+
+    # The API serves compact JSON.
+    content = json.dumps(payloads.heart_rate_response(date),
+                         separators=(",", ":")).encode()
+
+    decoders = [("stdlib json", json.loads)]
+    if json_decoder.orjson is not None:
+        decoders.append(("orjson", json_decoder.orjson.loads))
+    decoders.append(("columnar", json_decoder.decode))
+
+    print("Heart rate intraday payload, {kb:.1f} KiB:".format(
+                                                    kb=len(content) / 1024))
+    results = {}
+    for name, decode in decoders:
+
+        def decode_and_parse():
+            return parser.parse_heart_rate_response(decode(content), date)
+
+        decode_seconds = timeit.timeit(lambda: decode(content),
+                                       number=args.runs) / args.runs
+        total_seconds = timeit.timeit(decode_and_parse,
+                                      number=args.runs) / args.runs
+        results[name] = total_seconds
+
+        print("  {name:>11}: decode {0:6.3f} ms, decode + parse {1:6.3f} ms"
+              .format(decode_seconds * 1000, total_seconds * 1000, name=name))
+
+    print("  speedup over stdlib json: x{:.1f}".format(
+                            results["stdlib json"] / results["columnar"]))
@@ -0,0 +1,114 @@
+"""
+Benchmark date lookups on a synthetic HeartRateIntraday table of several
+million rows in SQLite, before and after adding the index on its date
+column: selecting one day of data, the existing keys of one day (as done
+before each bulk upsert), and the latest date (as when seeding watermarks).
+
+Usage: PYTHONPATH=data_pipeline python3 benchmarks/bench_indexes.py [-r ROWS]
+"""
+from db_tables import Base, HeartRateIntraday
+from sqlalchemy import create_engine, func
+from sqlalchemy.orm import sessionmaker
+import argparse
+import db_migrations
+import numpy as np
+import os
+import pandas as pd
+import tempfile
+import time
+
+
+def fill_heart_rate_table(engine, num_rows, batch_size=500000):
+    """Insert num_rows minutes of heart rate data, ending on 2021-07-31."""
+    num_days = -(-num_rows // 1440)
+    start = pd.to_datetime("2021-07-31") - pd.Timedelta(days=num_days - 1)
+    rng = np.random.default_rng(0)
+
+    # SQLAlchemy stores SQLite datetimes as ISO strings.
+    connection = engine.raw_connection()
+    cursor = connection.cursor()
+    for i in range(0, num_rows, batch_size):
+        times = start + pd.to_timedelta(np.arange(i, min(i + batch_size,
+                                                        num_rows)), unit="m")
+        rows = zip([1] * len(times),
+                   times.normalize().strftime("%Y-%m-%d %H:%M:%S.%f"),
+                   times.strftime("%Y-%m-%d %H:%M:%S.%f"),
+                   rng.integers(50, 160, size=len(times)).tolist())
+        cursor.executemany("INSERT INTO heart_rate_intraday "
+                           "(user_id, date, time, bpm) VALUES (?, ?, ?, ?)",
+                           rows)
+    connection.commit()
+    connection.close()
+
+    return pd.date_range(start=start, periods=num_days)
+
+
+def time_lookups(session, dates, runs):
+    """Return the mean seconds of each lookup, over runs random dates."""
+    rng = np.random.default_rng(1)
+    sample = [dates[i].to_pydatetime()
+              for i in rng.integers(0, len(dates), size=runs)]
+    table = HeartRateIntraday
+
+    lookups = {
+        "one day of rows": lambda date: session.query(
+                            table.time, table.bpm).filter(
+                            table.date == date).all(),
+        "keys on a date": lambda date: session.query(table.time).filter(
+                            table.date == date).count(),
+        "latest date": lambda date: session.query(
+                            func.max(table.date)).scalar()
+    }
+
+    results = {}
+    for name, lookup in lookups.items():
+        start = time.perf_counter()
+        for date in sample:
+            lookup(date)
+        results[name] = (time.perf_counter() - start) / runs
+
+    return results
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-r", "--rows", type=int, default=3000000,
+                        help="number of rows in the heart rate table")
+    parser.add_argument("-n", "--runs", type=int, default=20,
+                        help="number of lookups timed per query")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        engine = create_engine(
+                "sqlite:///" + os.path.join(folder, "benchmark.db"))
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+
+        # Start from a table as created before the index was declared.
+        engine.execute("DROP INDEX ix_heart_rate_intraday_date")
+
+        start = time.perf_counter()
+        dates = fill_heart_rate_table(engine, args.rows)
+        print("Filled {rows} rows ({days} days) in {s:.1f}s.".format(
+                rows=args.rows, days=len(dates),
+                s=time.perf_counter() - start))
+
+        before = time_lookups(session, dates, args.runs)
+
+        start = time.perf_counter()
+        db_migrations.create_missing_indexes(engine, Base.metadata)
+        print("Created the date index in {:.1f}s.".format(
+                                            time.perf_counter() - start))
+
+        after = time_lookups(session, dates, args.runs)
+
+        for name in before:
+            print("{name:>16}: {0:9.3f} ms without index, {1:7.3f} ms with "
+                  "index (x{2:.0f})".format(before[name] * 1000,
+                                            after[name] * 1000,
+                                            before[name] / after[name],
+                                            name=name))
+
+        session.close()
+        engine.dispose()
@@ -0,0 +1,111 @@
+"""
+Memory profile of a long replay: a response store is filled with DAYS days
+of synthetic payloads of all endpoints (365 by default), then replayed into
+an empty SQLite database while a thread samples the resident set size (RSS)
+of the process. RSS should stay flat once the first days are written, as
+days are parsed and written in bounded chunks, rather than grow with the
+number of days replayed.
+
+Usage:
+  PYTHONPATH=data_pipeline python3 benchmarks/bench_memory.py \
+      [-d DAYS] [-p PROCESSES] [-m MAX_BUFFERED_MB]
+"""
+from bench_replay import fill_store
+from db_tables import Base, FitbitUserInfo
+from memory_budget import MemoryBudget
+from pipeline import Loader
+from response_store import ResponseStore
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+import argparse
+import os
+import resource
+import tempfile
+import threading
+import time
+
+
+def rss_mb():
+    """Resident set size of this process, in megabytes (Linux only)."""
+    with open("/proc/self/statm") as f:
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+class RssSampler:
+    """Sample the RSS every `interval` seconds, from a background thread."""
+
+    def __init__(self, interval=0.25):
+        self.interval = interval
+        self.samples = []  # (seconds since start, RSS in megabytes)
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._start = time.perf_counter()
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            self.samples.append((time.perf_counter() - self._start,
+                                 rss_mb()))
+            self._stop_event.wait(self.interval)
+
+
+if __name__ == "__main__":
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("-d", "--days", type=int, default=365)
+    arg_parser.add_argument("-p", "--processes", type=int, default=1,
+                            help="parser processes of the replay")
+    arg_parser.add_argument("-m", "--max_buffered_mb", type=int, default=256,
+                            help="memory budget of the parsed data")
+    args = arg_parser.parse_args()
+
+    if not os.path.exists("/proc/self/statm"):
+        raise Exception("bench_memory.py reads the RSS from /proc (Linux).")
+
+    with tempfile.TemporaryDirectory() as folder:
+        store = ResponseStore(os.path.join(folder, "responses"))
+        dates = fill_store(store, args.days)
+
+        engine = create_engine("sqlite:///" + os.path.join(folder, "m.db"))
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        session.add(FitbitUserInfo(id=1, start_date=dates[0]))
+        session.commit()
+
+        budget = MemoryBudget(args.max_buffered_mb * 2**20)
+        loader = Loader(session, None, response_store=store,
+                        parse_processes=args.processes, memory_budget=budget)
+
+        sampler = RssSampler().start()
+        loader.replay()
+        sampler.stop()
+
+        session.close()
+        engine.dispose()
+
+    # RSS at each tenth of the replay, and its growth after the first one.
+    samples = sampler.samples
+    duration = samples[-1][0]
+    print("Replay of {} days in {:.1f}s, RSS in MB:".format(args.days,
+                                                             duration))
+
+    deciles = []
+    for i in range(1, 11):
+        decile = [rss for seconds, rss in samples
+                  if seconds <= duration * i / 10]
+        deciles.append(max(decile))
+        print("  {:>3}%  {:8.1f}".format(10 * i, deciles[-1]))
+
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print("growth after the first 10%: {:+.1f} MB".format(deciles[-1]
+                                                          - deciles[0]))
+    print("peak RSS: {:.1f} MB, peak parsed data buffered: {:.2f} MB".format(
+                                            peak_mb, budget.peak / 2**20))
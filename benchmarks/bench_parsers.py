@@ -0,0 +1,122 @@
+"""
+Benchmark the schema-driven ResponseParser against the former per-column
+template parsers, on synthetic 1,440-point heart rate and steps intraday
+responses. Reports the mean latency of a parse, and the peak memory
+allocated during one.
+
+Usage: PYTHONPATH=data_pipeline python3 benchmarks/bench_parsers.py [-n RUNS]
+"""
+from pipeline import ResponseParser
+import argparse
+import contextlib
+import emulator_payloads as payloads
+import pandas as pd
+import timeit
+import tracemalloc
+
+
+def legacy_parse_intraday(response, date, key, value_column):
+    """The former parse_steps_response and parse_heart_rate_response, which
+    only differed by their keys, kept for comparison.
+    """
+    types = {
+        "date": "datetime64[ns]",
+        "time": "datetime64[ns]",
+        value_column: "int64"
+    }
+
+    df_response = None
+    try:
+        intraday = response[key]["dataset"]
+        if intraday:
+            df_response = pd.DataFrame(intraday)
+
+    except:
+        pass
+
+    df = None
+    if df_response is not None:
+
+        num_rows = len(df_response.index)
+        df = pd.DataFrame(data=None, index=range(num_rows))
+
+        for column in types.keys():
+            df[column] = None
+
+        with contextlib.suppress(KeyError, TypeError):
+            date_string = date.strftime("%Y-%m-%d")
+            df["time"] = date_string + " " + df_response["time"]
+            df["time"] = df["time"].astype(types["time"])
+
+        with contextlib.suppress(KeyError, TypeError):
+            df[value_column] = df_response["value"].astype(
+                                                    types[value_column])
+
+        df["date"] = date
+        df.set_index("time", inplace=True)
+
+    return df
+
+
+def legacy_parse_heart_rate_response(response, date):
+    return {"HeartRateIntraday": legacy_parse_intraday(
+                    response, date, "activities-heart-intraday", "bpm")}
+
+
+def legacy_parse_steps_response(response, date):
+    return {"ActivitiesStepsIntraday": legacy_parse_intraday(
+                    response, date, "activities-steps-intraday", "num_steps")}
+
+
+def measure(parse, response, date, runs):
+    """Return the mean seconds per parse, and the peak bytes allocated
+    during a single parse.
+    """
+    parse(response, date)  # warm up caches and lazy imports
+    seconds = timeit.timeit(lambda: parse(response, date), number=runs) / runs
+
+    tracemalloc.start()
+    parse(response, date)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return seconds, peak
+
+
+if __name__ == "__main__":
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("-n", "--runs", type=int, default=200,
+                            help="number of parses timed per parser")
+    args = arg_parser.parse_args()
+
+    date = pd.to_datetime("2021-07-24")
+    parser = ResponseParser()
+
+    cases = [
+        ("heart rate", payloads.heart_rate_response(date),
+         legacy_parse_heart_rate_response, parser.parse_heart_rate_response),
+        ("steps", payloads.steps_response(date),
+         legacy_parse_steps_response, parser.parse_steps_response)
+    ]
+
+    for name, response, legacy_parse, schema_parse in cases:
+
+        # both parsers must agree before being compared
+        legacy_df = list(legacy_parse(response, date).values())[0]
+        schema_df = list(schema_parse(response, date).values())[0]
+        pd.testing.assert_frame_equal(schema_df, legacy_df)
+
+        print("{name} intraday, {rows} points:".format(name=name,
+                                                       rows=len(schema_df)))
+        results = {}
+        for label, parse in [("legacy", legacy_parse),
+                             ("schema", schema_parse)]:
+            results[label] = measure(parse, response, date, args.runs)
+            print("  {label:>7}: {0:7.3f} ms per parse, {1:8.1f} KiB peak "
+                  "allocations".format(results[label][0] * 1000,
+                                       results[label][1] / 1024, label=label))
+
+        legacy, schema = results["legacy"], results["schema"]
+        print("  speedup: x{:.1f}, peak memory x{:.1f}".format(
+                legacy[0] / schema[0], legacy[1] / schema[1]))
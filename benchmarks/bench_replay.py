@@ -0,0 +1,119 @@
+"""
+Benchmark the replay of stored responses with the parsing stage in a pool of
+processes, against parsing in the writing process: a response store is
+filled with DAYS days of synthetic payloads of all endpoints, then
+
+  - parse: every stored day read and parsed, by 1 to PROCESSES processes,
+    without writing, i.e. the stage the pool scales;
+  - replay: Loader.replay into an empty SQLite database, end to end.
+
+Usage:
+  PYTHONPATH=data_pipeline python3 benchmarks/bench_replay.py \
+      [-d DAYS] [-p PROCESSES]
+"""
+from concurrent.futures import ProcessPoolExecutor
+from db_tables import Base, FitbitUserInfo
+from pipeline import Loader, parse_stored_responses
+from response_store import ResponseStore
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+import argparse
+import emulator_payloads as payloads
+import os
+import pandas as pd
+import tempfile
+import time
+
+
+ENDPOINTS = ["activities", "steps", "heart_rate", "sleep"]
+
+
+def fill_store(store, num_days):
+    """Store num_days days of each endpoint, ending yesterday."""
+    today = pd.Timestamp.today().normalize()
+    dates = pd.date_range(end=today - pd.Timedelta(days=1), periods=num_days)
+
+    for date in dates:
+        seed = date.toordinal()
+        store.put("activities", date, payloads.activities_response(date))
+        store.put("steps", date, payloads.steps_response(date, seed))
+        store.put("heart_rate", date, payloads.heart_rate_response(date, seed))
+        store.put("sleep", date, payloads.sleep_response(date, seed))
+
+    return dates
+
+
+def jobs_of(store, days_per_job=30):
+    jobs = []
+    for endpoint_name in ENDPOINTS:
+        dates = store.dates(endpoint_name)
+        jobs.extend((endpoint_name, dates[i:i + days_per_job])
+                    for i in range(0, len(dates), days_per_job))
+    return jobs
+
+
+def bench_parse(store, processes):
+    """Seconds to read and parse every stored day."""
+    jobs = jobs_of(store)
+
+    start = time.perf_counter()
+    if processes <= 1:
+        for endpoint_name, dates in jobs:
+            parse_stored_responses(store, endpoint_name, dates)
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            futures = [pool.submit(parse_stored_responses, store,
+                                   endpoint_name, dates)
+                       for endpoint_name, dates in jobs]
+            for future in futures:
+                future.result()
+
+    return time.perf_counter() - start
+
+
+def bench_replay(store, dates, processes, folder):
+    """Seconds to replay the store into an empty SQLite database."""
+    path = os.path.join(folder, "replay_{}.db".format(processes))
+    engine = create_engine("sqlite:///" + path)
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    session.add(FitbitUserInfo(id=1, start_date=dates[0]))
+    session.commit()
+
+    loader = Loader(session, None, response_store=store,
+                    parse_processes=processes)
+
+    start = time.perf_counter()
+    loader.replay()
+    seconds = time.perf_counter() - start
+
+    session.close()
+    engine.dispose()
+    return seconds
+
+
+if __name__ == "__main__":
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("-d", "--days", type=int, default=365)
+    arg_parser.add_argument("-p", "--processes", type=int,
+                            default=min(4, os.cpu_count() or 1),
+                            help="largest number of parser processes")
+    args = arg_parser.parse_args()
+
+    counts = sorted({1, 2, args.processes} - {0})
+    counts = [n for n in counts if n <= args.processes]
+
+    with tempfile.TemporaryDirectory() as folder:
+        store = ResponseStore(os.path.join(folder, "responses"))
+        dates = fill_store(store, args.days)
+        print("{} days of {} endpoints stored".format(args.days,
+                                                      len(ENDPOINTS)))
+
+        print("{:<10} {:>12} {:>12}".format("processes", "parse (s)",
+                                             "replay (s)"))
+        for processes in counts:
+            parse_seconds = bench_parse(store, processes)
+            replay_seconds = bench_replay(store, dates, processes, folder)
+            print("{:<10} {:>12.2f} {:>12.2f}".format(processes, parse_seconds,
+                                                      replay_seconds))
@@ -0,0 +1,236 @@
+"""
+Benchmark suite of the pipeline, writing its results to a JSON file so that
+runs can be compared, e.g. before and after a change:
+
+  - parse.<endpoint>: each ResponseParser.parse_* method, on synthetic
+    payloads of the endpoint (see emulator_payloads.py);
+  - write.<table>: a day's parsed dataframe written to a SQLite database by
+    the DatabaseSink, for new rows and again for existing rows;
+  - sync.<N>_days: an end-to-end sync of N days of all endpoints from the
+    local API emulator, without rate limiting, into SQLite.
+
+Usage:
+  PYTHONPATH=data_pipeline python3 benchmarks/bench_suite.py \
+      [-o results.json] [--compare previous.json] [-n RUNS] [-d DAYS]
+"""
+from db_tables import Base, FitbitCredentials, FitbitUserInfo
+from fitbit_api import Fitbit
+from fitbit_emulator import FitbitEmulator
+from pipeline import Loader, ResponseParser
+from rate_limiter import RateLimiter
+from sinks import DatabaseSink
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+import argparse
+import datetime
+import db_tables
+import emulator_payloads as payloads
+import json
+import metrics
+import os
+import pandas as pd
+import platform
+import sqlalchemy
+import statistics
+import tempfile
+import time
+
+
+def time_runs(function, runs):
+    """Return the mean and median seconds of a call, after a warm up."""
+    function()
+
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+
+    return statistics.mean(timings), statistics.median(timings)
+
+
+def bench_parsers(runs):
+
+    date = pd.to_datetime("2021-07-24")
+    parser = ResponseParser()
+
+    cases = [
+        ("activities", parser.parse_activities_response,
+         payloads.activities_response(date)),
+        ("steps", parser.parse_steps_response, payloads.steps_response(date)),
+        ("heart_rate", parser.parse_heart_rate_response,
+         payloads.heart_rate_response(date)),
+        ("sleep", parser.parse_sleep_response, payloads.sleep_response(date))
+    ]
+
+    results = {}
+    for name, parse, response in cases:
+        mean, median = time_runs(lambda: parse(response, date), runs)
+        rows = sum(len(df) for df in parse(response, date).values()
+                   if df is not None)
+
+        results["parse." + name] = {"mean_ms": mean * 1000,
+                                    "median_ms": median * 1000,
+                                    "rows": rows}
+    return results
+
+
+def bench_writes(runs):
+
+    date = pd.to_datetime("2021-07-24")
+    parser = ResponseParser()
+
+    # A day of each table, parsed from the synthetic payloads.
+    frames = {}
+    for parse, response in [
+            (parser.parse_activities_response,
+             payloads.activities_response(date)),
+            (parser.parse_steps_response, payloads.steps_response(date)),
+            (parser.parse_heart_rate_response,
+             payloads.heart_rate_response(date)),
+            (parser.parse_sleep_response, payloads.sleep_response(date))]:
+        frames.update(parse(response, date))
+
+    results = {}
+    with tempfile.TemporaryDirectory() as folder:
+        engine = create_engine("sqlite:///" + os.path.join(folder, "w.db"))
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        sink = DatabaseSink()
+
+        for tablename, df in frames.items():
+            table = getattr(db_tables, tablename)
+
+            def write():
+                sink.write(session, table, df, date, 1)
+                session.commit()
+
+            # New rows first, then updates of the same keys.
+            start = time.perf_counter()
+            write()
+            insert_seconds = time.perf_counter() - start
+
+            mean, median = time_runs(write, runs)
+
+            results["write." + tablename] = {
+                "insert_ms": insert_seconds * 1000,
+                "update_mean_ms": mean * 1000,
+                "update_median_ms": median * 1000,
+                "rows": len(df),
+                "rows_per_second": len(df) / mean
+            }
+
+        session.close()
+        engine.dispose()
+
+    return results
+
+
+def bench_sync(num_days, workers):
+    """Sync num_days days of all endpoints from the local API emulator, with
+    the rate limiter out of the way, into an empty SQLite database.
+    """
+    emulator = FitbitEmulator(limit=10**9).start()
+
+    with tempfile.TemporaryDirectory() as folder:
+        engine = create_engine("sqlite:///" + os.path.join(folder, "s.db"),
+                               connect_args={"check_same_thread": False})
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+
+        today = pd.to_datetime(datetime.date.today())
+        session.add(FitbitUserInfo(
+                    id=1, start_date=today - pd.Timedelta(days=num_days - 1)))
+        session.add(FitbitCredentials(id=1, client_id="id",
+                                      client_secret="secret",
+                                      access_token="token",
+                                      expires_at=str(2**40)))
+        session.commit()
+
+        try:
+            fitbit = Fitbit(session, base_url=emulator.url,
+                            rate_limiter=RateLimiter(limit=10**9))
+            loader = Loader(session, fitbit, workers=workers)
+
+            before = metrics.REGISTRY.totals()
+            start = time.perf_counter()
+            loader.run()
+            seconds = time.perf_counter() - start
+            after = metrics.REGISTRY.totals()
+
+        finally:
+            emulator.stop()
+            session.close()
+            engine.dispose()
+
+    def total(name):
+        return after.get(name, 0) - before.get(name, 0)
+
+    return {"sync.{}_days".format(num_days): {
+        "seconds": seconds,
+        "workers": workers,
+        "api_calls": total("api_requests_total"),
+        "rows_written": total("rows_written_total"),
+        "rows_per_second": total("rows_written_total") / seconds,
+        "http_seconds": total("api_request_seconds_sum"),
+        "parse_seconds": total("parse_seconds_sum"),
+        "db_seconds": (total("sink_write_seconds_sum")
+                       + total("db_commit_seconds_sum"))
+    }}
+
+
+def compare(results, previous):
+    """Print the ratio of each timing to the previous run's."""
+    for name, values in results.items():
+        if name not in previous:
+            continue
+
+        for key, value in values.items():
+            old = previous[name].get(key)
+            if not (key.endswith("_ms") or key == "seconds") or not old:
+                continue
+
+            print("{name:<32} {key:<18} {old:10.3f} -> {new:10.3f}  "
+                  "x{ratio:.2f}".format(name=name, key=key, old=old,
+                                        new=value, ratio=value / old))
+
+
+if __name__ == "__main__":
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("-n", "--runs", type=int, default=50,
+                            help="number of timed runs per micro-benchmark")
+    arg_parser.add_argument("-d", "--days", type=int, default=90,
+                            help="number of days of the end-to-end sync")
+    arg_parser.add_argument("-w", "--workers", type=int, default=1,
+                            help="fetching threads of the end-to-end sync")
+    arg_parser.add_argument("-o", "--output",
+                            help="JSON file to write the results to")
+    arg_parser.add_argument("--compare",
+                            help="JSON results of a previous run to compare "
+                                 "with")
+    args = arg_parser.parse_args()
+
+    results = {}
+    results.update(bench_parsers(args.runs))
+    results.update(bench_writes(args.runs))
+    results.update(bench_sync(args.days, args.workers))
+
+    report = {
+        "created_at": datetime.datetime.now().isoformat(),
+        "environment": {"python": platform.python_version(),
+                        "pandas": pd.__version__,
+                        "sqlalchemy": sqlalchemy.__version__,
+                        "machine": platform.machine()},
+        "results": results
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f)["results"])
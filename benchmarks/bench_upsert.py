@@ -0,0 +1,122 @@
+"""
+Benchmark the bulk upsert against the former per-row delete/add/commit loop,
+on a 30-day backfill of the HeartRateIntraday and ActivitiesStepsIntraday
+tables in a local SQLite database. The backfill is followed by a re-sync of
+the last day, to time updates of existing keys as well.
+
+Usage: PYTHONPATH=data_pipeline python3 benchmarks/bench_upsert.py [-d DAYS]
+"""
+from db_tables import Base, ActivitiesStepsIntraday, HeartRateIntraday
+from sqlalchemy import create_engine
+from sqlalchemy.inspection import inspect
+from sqlalchemy.orm import sessionmaker
+import argparse
+import db_upsert
+import numpy as np
+import os
+import pandas as pd
+import tempfile
+import time
+
+
+def make_intraday_frame(date, value_column, low, high, seed):
+    """Build a parsed 1-minute intraday dataframe for a single day."""
+    rng = np.random.default_rng(seed)
+    times = pd.date_range(start=date, periods=1440, freq="min")
+    df = pd.DataFrame({
+        "user_id": 1,
+        "date": date,
+        "time": times,
+        value_column: rng.integers(low, high, size=len(times))
+        })
+    return df.set_index("time")
+
+
+def legacy_insert_dataframe_in_table(session, dataframe, table, date):
+    """The former Loader._insert_dataframe_in_table, kept for comparison."""
+    df = dataframe.replace([np.nan], [None])
+
+    # The time column, next to the user_id of the key.
+    primary_key = inspect(table).primary_key[-1].name
+    df[primary_key] = df.index
+
+    result = session.query(table).filter(table.date == date)
+    current_keys = [getattr(row, primary_key) for row in result]
+    df_known_keys = df[df[primary_key].isin(current_keys)]
+    df_unknown_keys = df[~df[primary_key].isin(current_keys)]
+
+    for row in df_known_keys.to_dict("records"):
+        old_entry = session.query(table).get((row["user_id"],
+                                              row[primary_key]))
+        session.delete(old_entry)
+        session.add(table(**row))
+        session.commit()
+
+    for row in df_unknown_keys.to_dict("records"):
+        session.add(table(**row))
+        session.commit()
+
+
+def bulk_insert_dataframe_in_table(session, dataframe, table, date):
+    """The current write path: one bulk upsert and commit per dataframe."""
+    db_upsert.upsert_dataframe(session, table, dataframe)
+    session.commit()
+
+
+def run_backfill(insert_function, frames):
+    """Time a backfill of all (table, date, df) frames in a fresh database,
+    followed by a re-sync of the last day's frames.
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        engine = create_engine(
+                "sqlite:///" + os.path.join(folder, "benchmark.db"))
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+
+        start = time.perf_counter()
+        for table, date, df in frames:
+            insert_function(session, df, table, date)
+        backfill_seconds = time.perf_counter() - start
+
+        last_date = frames[-1][1]
+        start = time.perf_counter()
+        for table, date, df in frames:
+            if date == last_date:
+                insert_function(session, df, table, date)
+        resync_seconds = time.perf_counter() - start
+
+        session.close()
+        engine.dispose()
+
+    return backfill_seconds, resync_seconds
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--days", type=int, default=30,
+                        help="number of days in the backfill")
+    args = parser.parse_args()
+
+    dates = pd.date_range(end="2021-07-31", periods=args.days)
+    frames = []
+    for i, date in enumerate(dates):
+        frames.append((HeartRateIntraday, date,
+                       make_intraday_frame(date, "bpm", 50, 160, i)))
+        frames.append((ActivitiesStepsIntraday, date,
+                       make_intraday_frame(date, "num_steps", 0, 120, i)))
+
+    num_rows = sum(len(df) for _, _, df in frames)
+    print("Backfill of {days} days ({rows} rows) in SQLite.".format(
+                                                days=args.days, rows=num_rows))
+
+    results = {}
+    for name, function in [("per-row loop", legacy_insert_dataframe_in_table),
+                           ("bulk upsert", bulk_insert_dataframe_in_table)]:
+        results[name] = run_backfill(function, frames)
+        print("{name:>14}: backfill {0:8.2f}s, re-sync last day {1:6.2f}s"
+              .format(*results[name], name=name))
+
+    legacy, bulk = results["per-row loop"], results["bulk upsert"]
+    print("{:>14}: backfill x{:.1f}, re-sync x{:.1f}".format(
+            "speedup", legacy[0] / bulk[0], legacy[1] / bulk[1]))
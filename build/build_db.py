@@ -11,9 +11,13 @@ import json
 from sqlalchemy import inspect
 from sqlalchemy.orm import sessionmaker
 import db_connection
+import db_migrations
+import endpoints
+import rollups
 from db_tables import Base, FitbitCredentials, FitbitUserInfo, SleepStageId
 from fitbit_api import Fitbit
-from pipeline import Pipeline
+from parser_utils import check_positive_int
+from pipeline import Loader, Pipeline
 
 
 if __name__ == "__main__":
@@ -28,7 +32,39 @@ if __name__ == "__main__":
                         help="launch complete data download from api")
     # -s flag: pipeline arg (number of seconds between api calls).
     parser.add_argument("-s", "--seconds_between_calls", type=int,
-                        help="number of seconds between fitbit api calls")
+                        help="minimal number of seconds between fitbit api calls")
+    # -w flag: pipeline arg (number of threads fetching concurrently).
+    parser.add_argument("-w", "--workers", type=check_positive_int,
+                        help="number of threads fetching from the api concurrently")
+    # -p flag: pipeline arg (number of processes parsing stored responses).
+    parser.add_argument("-p", "--parse_processes", type=check_positive_int,
+                        help="number of processes parsing stored responses")
+    # -m flag: pipeline arg (memory cap of the parsed data to write).
+    parser.add_argument("-m", "--max_buffered_mb", type=check_positive_int,
+                        help="megabytes of parsed data allowed to wait for "
+                             "writing")
+    # -o flag: pipeline arg (backfill from the oldest day instead).
+    parser.add_argument("-o", "--oldest_first", action="store_true",
+                        help="download from the oldest day rather than today")
+    # -e flag: pipeline arg (api endpoints to download, repeat for several).
+    parser.add_argument("-e", "--endpoint", dest="endpoint_names",
+                        action="append", choices=list(endpoints.ENDPOINTS),
+                        help="api endpoint to download (default: "
+                             + ", ".join(endpoints.get_endpoints()) + ")")
+    # -u flag: base url of the api, e.g. of a local emulator.
+    parser.add_argument("-u", "--api_base_url",
+                        help="base url of the fitbit api "
+                             "(default: https://api.fitbit.com)")
+    # -c flag: copy intraday tables to the compact layout, and use it.
+    parser.add_argument("-c", "--compact_intraday", action="store_true",
+                        help="migrate intraday tables to the compact layout")
+    # -r flag: recompute the rollup tables from the intraday tables.
+    parser.add_argument("-r", "--rebuild_rollups", action="store_true",
+                        help="recompute all rollups of the intraday tables")
+    # -i flag: id of the user added from the starter tokens.
+    parser.add_argument("-i", "--user_id", type=check_positive_int, default=1,
+                        help="id of the user to add from the starter tokens "
+                             "(default: 1)")
     args = parser.parse_args()
 
 
@@ -52,12 +88,36 @@ if __name__ == "__main__":
         else:
             print("All tables already exist.")
 
+    # Key the tables of a database created for a single user by user, its
+    # data going to user 1. This copies each table, and can take a while on
+    # large intraday tables.
+    migrated_tables = db_migrations.migrate_to_multi_user(engine)
+    if args.verbose and migrated_tables:
+        print("Migrated the following tables to multiple users:")
+        print(*[">> " + table for table in migrated_tables], sep="\n")
+
+    # Add columns declared since existing tables were created.
+    added_columns = db_migrations.add_missing_columns(engine, Base.metadata)
+    if args.verbose and added_columns:
+        print("Added the following columns:")
+        print(*[">> " + column for column in added_columns], sep="\n")
+
+    # Add indexes declared since existing tables were created. This can take
+    # a few minutes on large intraday tables.
+    created_indexes = db_migrations.create_missing_indexes(engine,
+                                                           Base.metadata)
+    if args.verbose and created_indexes:
+        print("Created the following indexes:")
+        print(*[">> " + index for index in created_indexes], sep="\n")
+
     # Table creation.
     Base.metadata.create_all(engine, checkfirst=True)
 
 
-    # If FitbitCredentials table is empty, populate from flat file.
-    if not session.query(FitbitCredentials).first():
+    # If the user has no FitbitCredentials, populate from flat file. Further
+    # users are added by running this again with their starter tokens and
+    # their own -i id.
+    if not session.query(FitbitCredentials).get(args.user_id):
 
         # Load credentials and starter tokens from flat file in build directory.
         if args.verbose:
@@ -68,7 +128,7 @@ if __name__ == "__main__":
         with open(token_path+"fitbit_starter_tokens.json") as f:
             flat_tokens_dict = json.load(f)
 
-        user_creds = FitbitCredentials(id = 1,
+        user_creds = FitbitCredentials(id = args.user_id,
                             client_id = flat_tokens_dict["client_id"],
                             client_secret = flat_tokens_dict["client_secret"],
                             access_token = flat_tokens_dict["access_token"],
@@ -80,7 +140,8 @@ if __name__ == "__main__":
 
         # Refresh tokens once for good measure, and then erase the flat tokens
         # if successful as they are no longer valid.
-        Fitbit(session).refresh_tokens()
+        Fitbit(session, base_url=args.api_base_url,
+               user_id=args.user_id).refresh_tokens()
 
         flat_tokens_dict["access_token"] = ""
         flat_tokens_dict["refresh_token"] = ""
@@ -88,24 +149,23 @@ if __name__ == "__main__":
             json.dump(flat_tokens_dict, f)
 
 
-    # If FitbitUserInfo table is empty, populate from web api.
-    if not session.query(FitbitUserInfo).first():
+    # If the user has no FitbitUserInfo, populate from web api.
+    if not session.query(FitbitUserInfo).get(args.user_id):
         if args.verbose:
             print("Populating FitbitUserInfo table by calling api.")
 
-        fitbit = Fitbit(session)
+        fitbit = Fitbit(session, base_url=args.api_base_url,
+                        user_id=args.user_id)
+
+        url = "/1/user/-/profile.json"
+        response = fitbit.get_resource(url)  # raises on error responses
 
-        url = "https://api.fitbit.com/1/user/-/profile.json"
-        response = fitbit.get_resource(url)
-        if response.status_code == 200:
-            response = response.json()
-            start_date = response["user"]["memberSince"]
-            start_date = pd.to_datetime(start_date)
-            stride_length_running = response["user"]["strideLengthRunning"]
-            stride_length_walking = response["user"]["strideLengthWalking"]
+        start_date = pd.to_datetime(response["user"]["memberSince"])
+        stride_length_running = response["user"]["strideLengthRunning"]
+        stride_length_walking = response["user"]["strideLengthWalking"]
 
         user_start_date = FitbitUserInfo(
-                             id=1,
+                             id=args.user_id,
                              start_date=start_date,
                              stride_length_running=stride_length_running,
                              stride_length_walking=stride_length_walking
@@ -135,6 +195,40 @@ if __name__ == "__main__":
         session.add_all([deep, light, rem, deep, wake, awake, restless, asleep])
         session.commit()
 
+    # Seed sync watermarks of tables filled before the SyncState table
+    # existed, from the latest date in each.
+    if args.verbose:
+        print("Seeding missing sync watermarks from existing data.")
+
+    for (user_id,) in session.query(FitbitCredentials.id).all():
+        Loader(session, fitbit=None, user_id=user_id).seed_sync_state()
+
+    # (Optional: -c flag): Copy intraday data into the compact tables.
+    if args.compact_intraday:
+        if args.verbose:
+            print("Migrating intraday tables to the compact layout.")
+
+        copied = db_migrations.migrate_intraday_to_compact(engine)
+
+        if args.verbose:
+            for tablename, num_rows in copied.items():
+                print(">> {table}: {rows} rows".format(table=tablename,
+                                                       rows=num_rows))
+
+    # (Optional: -r flag): Recompute the rollups, e.g. of intraday data
+    # written before the rollup tables existed.
+    if args.rebuild_rollups:
+        if args.verbose:
+            print("Rebuilding the rollups of the intraday tables.")
+
+        written = rollups.rebuild_rollups(
+                                engine, compact_intraday=args.compact_intraday)
+
+        if args.verbose:
+            for tablename, num_rows in written.items():
+                print(">> {table}: {rows} rows".format(table=tablename,
+                                                       rows=num_rows))
+
 
     # (Optional: -dl flag): Download full data from web api.
     if args.download_all:
@@ -142,9 +236,20 @@ if __name__ == "__main__":
         if args.verbose:
             print("Downloading dataset. This might take up to ~24h.")
 
-        # Collect pipeline command line args for initialisation.
+        # Collect pipeline command line args for initialisation. The download
+        # goes through a persistent queue, so that running this again after
+        # an interruption resumes it.
         pipeline_args = {
+            "backfill": True,
+            "oldest_first": args.oldest_first,
             "seconds_between_calls": args.seconds_between_calls,
+            "workers": args.workers,
+            "parse_processes": args.parse_processes,
+            "max_buffered_mb": args.max_buffered_mb,
+            "endpoint_names": args.endpoint_names,
+            "compact_intraday": args.compact_intraday,
+            "api_base_url": args.api_base_url,
+            "user_ids": [args.user_id],
             "verbose": args.verbose
             }
 
@@ -0,0 +1,109 @@
+"""
+A persistent queue of the (user, endpoint, date) work items of a full history
+backfill, so that an interrupted backfill resumes where it stopped. Items are
+marked done in the same transaction as the data written for them.
+"""
+from db_tables import BackfillItem
+import datetime
+import db_upsert
+import pandas as pd
+import time
+
+
+def plan(session, user_id, endpoint_names, start_date, end_date):
+    """Add the user's missing (endpoint, date) items between both dates to
+    the queue, leaving existing items as they are. Return the number added.
+    """
+    dates = pd.date_range(start=start_date, end=end_date)
+    items = pd.DataFrame({
+        "user_id": user_id,
+        "endpoint": [name for name in endpoint_names for _ in dates],
+        "date": list(dates) * len(endpoint_names)
+        }).set_index("endpoint")  # a dataframe without columns is empty
+
+    # With key columns only, the upsert ignores items already queued.
+    counts = db_upsert.upsert_dataframe(session, BackfillItem, items)
+    session.commit()
+
+    return counts["inserted"]
+
+
+def pending_dates(session, user_id, endpoint_name):
+    """Return the sorted dates still to do for the user's endpoint."""
+    rows = session.query(BackfillItem.date).filter(
+                            BackfillItem.user_id == user_id,
+                            BackfillItem.endpoint == endpoint_name,
+                            BackfillItem.done.is_(False)).order_by(
+                            BackfillItem.date).all()
+
+    return [pd.to_datetime(row.date) for row in rows]
+
+
+def mark_done(session, user_id, endpoint_name, date):
+    """Mark the item done, if queued. Nothing is committed here, so that it
+    happens in the same transaction as the data write.
+    """
+    date = pd.to_datetime(date).to_pydatetime()
+
+    session.query(BackfillItem).filter(
+                        BackfillItem.user_id == user_id,
+                        BackfillItem.endpoint == endpoint_name,
+                        BackfillItem.date == date,
+                        BackfillItem.done.is_(False)).update(
+                        {"done": True, "done_at": datetime.datetime.now()},
+                        synchronize_session=False)
+
+
+def count_items(session, user_id=None):
+    """Return the numbers of items done and queued for the user, or overall
+    when user_id is None.
+    """
+    query = session.query(BackfillItem)
+    if user_id is not None:
+        query = query.filter(BackfillItem.user_id == user_id)
+
+    total = query.count()
+    done = query.filter(BackfillItem.done.is_(True)).count()
+    return done, total
+
+
+class Progress:
+    """Progress of a backfill run, with an ETA from the measured rate of API
+    calls since the start of the run.
+    """
+
+    def __init__(self, num_calls, clock=time.time):
+        self.num_calls = num_calls  # API calls planned for this run
+        self.calls_done = 0
+        self.clock = clock
+        self.start = clock()
+
+    def update(self, num_calls):
+        self.calls_done += num_calls
+
+    def calls_per_hour(self):
+        elapsed = self.clock() - self.start
+        if elapsed <= 0 or not self.calls_done:
+            return None
+        return self.calls_done / elapsed * 3600
+
+    def eta(self):
+        """Estimated time left, as a timedelta, or None before any call."""
+        rate = self.calls_per_hour()
+        if rate is None:
+            return None
+
+        calls_left = self.num_calls - self.calls_done
+        return datetime.timedelta(seconds=round(calls_left / rate * 3600))
+
+    def report(self, items_done, items_total):
+        """One line summary, e.g. for verbose output and logs."""
+        rate, eta = self.calls_per_hour(), self.eta()
+        return ("Backfill: {done}/{total} days done ({percent:.1f}%), "
+                "{calls}/{num_calls} calls this run at {rate} calls/hour, "
+                "ETA {eta}".format(
+                    done=items_done, total=items_total,
+                    percent=100 * items_done / max(items_total, 1),
+                    calls=self.calls_done, num_calls=self.num_calls,
+                    rate="?" if rate is None else "{:.0f}".format(rate),
+                    eta="?" if eta is None else eta))
@@ -5,9 +5,10 @@ import json
 import sqlalchemy
 
 
-def create_engine():
+def create_engine(pool_size=5):
     """Wrapper for the sqlalchemy.create_engine function. Load config from json
-    file and instantiate a sqlalchemy engine with it.
+    file and instantiate a sqlalchemy engine with it, keeping up to pool_size
+    connections open.
     """
     config_filepath = ("/absolute/path/to/project/folder/" 
                        "/configs/db_config.json")
@@ -16,4 +17,8 @@ def create_engine():
         db_config = json.load(f)
 
     arg = "{db_type}+{con}://{usr}:{pw}@{host}/{db}".format(**db_config)
-    return sqlalchemy.create_engine(arg)
+
+    # Pooled connections left idle by the daemon mode may have been closed by
+    # the server in between; check them before use.
+    return sqlalchemy.create_engine(arg, pool_pre_ping=True,
+                                    pool_size=pool_size)
@@ -0,0 +1,172 @@
+"""
+Change detection of the days written to the database tables. A day's parsed
+dataframe is compared with the rows stored for that day, and only the rows
+inserted, changed or deleted since are written, rather than every row of the
+padding day being upserted again on each run.
+
+The hash of each day's rows, as last written, is kept in the
+day_content_hash table, so that a day received again unchanged costs a hash
+and a row count, without reading its rows back. Other days are compared with
+their stored rows in a vectorized merge on the primary key.
+
+Rows edited outside the pipeline, without changing the number of rows of
+their day, are only seen once the day's content_hash row is deleted.
+"""
+from db_tables import DayContentHash
+from sqlalchemy import func
+import db_upsert
+import hashlib
+import numpy as np
+import pandas as pd
+
+
+# Kinds of changes counted by write_day.
+CHANGES = ("inserted", "updated", "deleted", "unchanged")
+
+
+def write_day(session, table, dataframe, scope, date, batch_size=1000):
+    """Write a day's dataframe, with the primary key as index as served by
+    the ResponseParser, to an ORM table as changes to the rows stored for
+    that day. The day's stored rows are those matching the scope's column
+    values, e.g. {"user_id": 1, "date": date}; the ones missing from the
+    dataframe are deleted, all of them for a None or empty dataframe, e.g.
+    when the day's only activity was removed. Rows are sent in batches of
+    batch_size rows. Nothing is committed here.
+
+    Returns a dict with the number of rows of each kind of CHANGES.
+    """
+    counts = dict.fromkeys(CHANGES, 0)
+
+    tablename = table.__name__
+
+    if dataframe is None or dataframe.empty:
+        counts["deleted"] = clear_day(session, table, scope, date)
+        return counts
+
+    content_hash = hash_dataframe(dataframe)
+
+    # Same rows as last written, and as many rows still stored: done.
+    known = session.query(DayContentHash).get(
+                                        (scope["user_id"], tablename, date))
+    if known is not None and known.content_hash == content_hash \
+            and known.num_rows == len(dataframe) \
+            and _count_rows(session, table, scope) == len(dataframe):
+        counts["unchanged"] = len(dataframe)
+        return counts
+
+    write, deleted_keys = _diff(session, table, dataframe, scope)
+
+    db_upsert.upsert_rows(session, table, dataframe[write["mask"]],
+                          batch_size)
+    db_upsert.delete_keys(session, table, deleted_keys, batch_size)
+
+    counts["inserted"] = write["inserted"]
+    counts["updated"] = write["updated"]
+    counts["deleted"] = len(deleted_keys)
+    counts["unchanged"] = len(dataframe) - write["inserted"] \
+                                         - write["updated"]
+
+    if known is None:
+        session.add(DayContentHash(user_id=scope["user_id"],
+                                   table_name=tablename, date=date,
+                                   content_hash=content_hash,
+                                   num_rows=len(dataframe)))
+    else:
+        known.content_hash = content_hash
+        known.num_rows = len(dataframe)
+
+    return counts
+
+
+def clear_day(session, table, scope, date):
+    """Delete the day's stored rows matching the scope, along with their
+    content hash. Nothing is committed here. Returns the number of rows
+    deleted.
+    """
+    deleted = session.query(table).filter(*_scope_conditions(table, scope)) \
+                     .delete(synchronize_session=False)
+
+    session.query(DayContentHash).filter(
+            DayContentHash.user_id == scope["user_id"],
+            DayContentHash.table_name == table.__name__,
+            DayContentHash.date == date).delete(synchronize_session=False)
+
+    return deleted
+
+
+def hash_dataframe(dataframe):
+    """Return a hash of a dataframe's rows, index and column names."""
+    df = dataframe.reset_index()
+
+    digest = hashlib.sha1(",".join(map(str, df.columns)).encode())
+    row_hashes = pd.util.hash_pandas_object(df, index=False).values
+    digest.update(row_hashes.tobytes())
+
+    return digest.hexdigest()
+
+
+def _count_rows(session, table, scope):
+    return session.query(func.count()).select_from(table) \
+                  .filter(*_scope_conditions(table, scope)).scalar()
+
+
+def _scope_conditions(table, scope):
+    return [getattr(table, column) == value
+            for column, value in scope.items()]
+
+
+def _diff(session, table, dataframe, scope):
+    """Compare the dataframe with the stored rows of its day. Return the
+    rows to write, as a boolean mask over the dataframe with the number of
+    them inserted and updated, and the primary keys of the rows to delete.
+    """
+    incoming = dataframe.reset_index()
+    columns = list(incoming.columns)
+    keys = db_upsert.primary_key_names(table)
+
+    rows = session.query(*[getattr(table, column) for column in columns]) \
+                  .filter(*_scope_conditions(table, scope)).all()
+    if not rows:
+        mask = np.ones(len(incoming), dtype=bool)
+        return {"mask": mask, "inserted": len(incoming), "updated": 0}, []
+
+    stored = pd.DataFrame.from_records(rows, columns=columns)
+
+    # Bring the stored values to the parsed types, e.g. for keys and dates
+    # read back as python objects.
+    for column in columns:
+        dtype = incoming[column].dtype
+        if pd.api.types.is_datetime64_any_dtype(dtype):
+            stored[column] = pd.to_datetime(stored[column])
+        elif column in keys:
+            stored[column] = stored[column].astype(dtype)
+
+    incoming_keys = pd.MultiIndex.from_frame(incoming[keys])
+    stored.index = pd.MultiIndex.from_frame(stored[keys])
+
+    # Rows with a stored key are written if any of their values changed,
+    # missing values being equal to each other.
+    known = incoming_keys.isin(stored.index)
+    new = incoming[known].reset_index(drop=True)
+    old = stored.reindex(incoming_keys[known]).reset_index(drop=True)
+
+    changed = np.zeros(len(new), dtype=bool)
+    for column in columns:
+        if column in keys:
+            continue
+
+        same = (new[column] == old[column]) \
+               | (new[column].isna() & old[column].isna())
+        changed |= ~same.values
+
+    mask = ~known
+    mask[known] = changed
+
+    # Stored rows of the day which are no longer served are deleted.
+    gone = stored.loc[~stored.index.isin(incoming_keys), keys]
+    deleted_keys = [tuple(record[key] for key in keys) for record in
+                    db_upsert.dataframe_to_records(gone.set_index(keys))]
+
+    write = {"mask": mask, "inserted": int((~known).sum()),
+             "updated": int(changed.sum())}
+    return write, deleted_keys
@@ -0,0 +1,195 @@
+"""
+Schema migrations for databases created by earlier versions of the pipeline.
+Base.metadata.create_all only creates missing tables, so changes to existing
+tables are brought in here.
+"""
+from sqlalchemy import MetaData, Table, func, inspect, text
+from sqlalchemy.orm import sessionmaker
+import db_tables
+import intraday_compact
+import pandas as pd
+
+
+# Tables whose rows belong to a user, with a user_id in their primary key.
+USER_TABLES = [db_tables.Activities, db_tables.ActivitiesDailySummary,
+               db_tables.ActivitiesStepsIntraday, db_tables.HeartRateIntraday,
+               db_tables.SleepIntraday, db_tables.SleepDailySummary,
+               db_tables.SyncState, db_tables.BackfillItem,
+               db_tables.ActivitiesStepsIntradayCompact,
+               db_tables.HeartRateIntradayCompact,
+               db_tables.SleepIntradayCompact]
+
+
+def create_missing_indexes(engine, metadata):
+    """Create the indexes declared in the ORM which are missing from existing
+    tables of the database. Return the names of the indexes created.
+    """
+    inspector = inspect(engine)
+    existing_tables = inspector.get_table_names()
+
+    created = []
+    for table in metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue  # create_all makes it with its indexes
+
+        existing_indexes = {index["name"]
+                            for index in inspector.get_indexes(table.name)}
+
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                index.create(engine)
+                created.append(index.name)
+
+    return created
+
+
+def add_missing_columns(engine, metadata):
+    """Add the nullable columns declared in the ORM which are missing from
+    existing tables of the database. Return the "table.column" names of the
+    columns added.
+    """
+    inspector = inspect(engine)
+    existing_tables = inspector.get_table_names()
+
+    added = []
+    for table in metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue  # create_all makes it with its columns
+
+        existing_columns = {column["name"]
+                            for column in inspector.get_columns(table.name)}
+
+        for column in table.columns:
+            if column.name in existing_columns or not column.nullable:
+                continue
+
+            column_type = column.type.compile(dialect=engine.dialect)
+            with engine.begin() as connection:
+                connection.execute(text("ALTER TABLE {table} ADD COLUMN "
+                                        "{column} {type}".format(
+                                            table=table.name,
+                                            column=column.name,
+                                            type=column_type)))
+            added.append("{}.{}".format(table.name, column.name))
+
+    return added
+
+
+def migrate_to_multi_user(engine, user_id=1):
+    """Bring the tables of a single user database, created before tables
+    were keyed by user, to the multi user layout: each table is rebuilt with
+    a user_id in its primary key, its rows being given to user_id (the id of
+    the single row of credentials). Return the names of the tables migrated.
+
+    Tables are renamed, created anew, copied over and dropped, one at a time
+    in their own transaction, since primary keys can't be altered in place
+    on all databases.
+    """
+    inspector = inspect(engine)
+    existing_tables = inspector.get_table_names()
+
+    to_migrate = []
+    for table in USER_TABLES:
+        name = table.__tablename__
+        if name in existing_tables and "user_id" not in {
+                    column["name"] for column in inspector.get_columns(name)}:
+            to_migrate.append(table)
+
+    if not to_migrate:
+        return []
+
+    # Views over the compact tables would follow them when renamed: drop
+    # them, and create them again over the new tables.
+    had_views = bool(inspector.get_view_names())
+    _drop_compatibility_views(engine)
+
+    for table in to_migrate:
+        name = table.__tablename__
+        old_name = name + "_single_user"
+
+        with engine.begin() as connection:
+            connection.execute(text("ALTER TABLE {} RENAME TO {}".format(
+                                                            name, old_name)))
+
+            # Index names are global on some databases: free them for the
+            # new table.
+            old_table = Table(old_name, MetaData(), autoload_with=connection)
+            for index in old_table.indexes:
+                index.drop(connection)
+
+            table.__table__.create(connection)
+
+            columns = ", ".join(column.name for column in old_table.columns)
+            connection.execute(text(
+                        "INSERT INTO {name} (user_id, {columns}) "
+                        "SELECT :user_id, {columns} FROM {old_name}".format(
+                            name=name, columns=columns, old_name=old_name)),
+                        {"user_id": user_id})
+
+            connection.execute(text("DROP TABLE " + old_name))
+
+    if had_views:
+        intraday_compact.create_compatibility_views(engine)
+
+    return [table.__tablename__ for table in to_migrate]
+
+
+def _drop_compatibility_views(engine):
+
+    with engine.begin() as connection:
+        for tablename in intraday_compact.COMPACT_TABLES:
+            view = getattr(db_tables, tablename).__tablename__ + "_compat"
+            connection.execute(text("DROP VIEW IF EXISTS " + view))
+
+
+def migrate_intraday_to_compact(engine, days_per_chunk=30):
+    """Copy the intraday tables into their compact counterparts (see
+    intraday_compact.py), days_per_chunk days at a time with one transaction
+    per chunk, then create the compatibility views. The original tables are
+    left in place. Can be run again to resume or refresh a migration.
+
+    Return a dict of the number of rows copied from each table.
+    """
+    session = sessionmaker(bind=engine)()
+    copied = {}
+
+    for tablename in intraday_compact.COMPACT_TABLES:
+        table = getattr(db_tables, tablename)
+        copied[tablename] = 0
+
+        first_date, last_date = session.query(func.min(table.date),
+                                              func.max(table.date)).one()
+        if first_date is None:
+            continue  # empty table
+
+        chunk_starts = pd.date_range(start=first_date, end=last_date,
+                                     freq="{}D".format(days_per_chunk))
+
+        for chunk_start in chunk_starts:
+            chunk_end = chunk_start + pd.Timedelta(days=days_per_chunk)
+
+            query = session.query(table).filter(
+                            table.date >= chunk_start.to_pydatetime(),
+                            table.date < chunk_end.to_pydatetime())
+            df = pd.read_sql(query.statement, session.get_bind())
+            if df.empty:
+                continue
+
+            df = df.set_index("time")
+
+            try:
+                for user_id, user_df in df.groupby("user_id"):
+                    intraday_compact.upsert_compact(session, tablename,
+                                                    user_df, user_id)
+                session.commit()
+
+            except Exception:
+                session.rollback()
+                raise
+
+            copied[tablename] += len(df)
+
+    session.close()
+    intraday_compact.create_compatibility_views(engine)
+
+    return copied
@@ -3,11 +3,14 @@ Database table information for the sqlalchemy ORM.
 """
 from sqlalchemy import Column
 from sqlalchemy import Integer, BigInteger, Float, String, Boolean, DateTime
+from sqlalchemy import SmallInteger
 from sqlalchemy.ext.declarative import declarative_base
 Base = declarative_base()
 
 
 # --------------------------- FitbitML TABLES ---------------------------------
+# Each Fitbit account synced has a row of credentials, whose id is the user_id
+# of its rows in the other tables, and the id of its FitbitUserInfo row.
 class FitbitCredentials(Base):
     __tablename__ = 'fitbit_credentials'
 
@@ -20,7 +23,7 @@ class FitbitCredentials(Base):
     expires_at = Column(String(255))
     scope = Column(String(255))
     token_type = Column(String(255))
-    user_id = Column(String(255))
+    user_id = Column(String(255))  # the account's id on Fitbit's side
 
 
 class FitbitUserInfo(Base):
@@ -35,6 +38,7 @@ class FitbitUserInfo(Base):
 class Activities(Base):
     __tablename__ = 'activities'
 
+    user_id = Column(Integer, primary_key=True, autoincrement=False)
     logId = Column(BigInteger, primary_key=True)
     activityId = Column(Integer)
     activityParentId = Column(Integer)
@@ -55,6 +59,7 @@ class Activities(Base):
 class ActivitiesDailySummary(Base):
     __tablename__ = 'activities_daily_summary'
 
+    user_id = Column(Integer, primary_key=True, autoincrement=False)
     date = Column(DateTime, primary_key=True)
     activeScore = Column(Integer)
     activityCalories = Column(Integer)
@@ -72,7 +77,8 @@ class ActivitiesDailySummary(Base):
 class ActivitiesStepsIntraday(Base):
     __tablename__ = 'activities_steps_intraday'
 
-    date = Column(DateTime)
+    user_id = Column(Integer, primary_key=True, autoincrement=False)
+    date = Column(DateTime, index=True)
     time = Column(DateTime, primary_key=True)
     num_steps = Column(Integer)
 
@@ -80,7 +86,8 @@ class ActivitiesStepsIntraday(Base):
 class HeartRateIntraday(Base):
     __tablename__ = 'heart_rate_intraday'
 
-    date = Column(DateTime)
+    user_id = Column(Integer, primary_key=True, autoincrement=False)
+    date = Column(DateTime, index=True)
     time = Column(DateTime, primary_key=True)
     bpm = Column(Integer)
 
@@ -88,7 +95,8 @@ class HeartRateIntraday(Base):
 class SleepIntraday(Base):
     __tablename__ = 'sleep_intraday'
 
-    date = Column(DateTime)
+    user_id = Column(Integer, primary_key=True, autoincrement=False)
+    date = Column(DateTime, index=True)
     time = Column(DateTime, primary_key=True)
     duration_seconds = Column(Integer)
     sleep_stage = Column(Integer)
@@ -104,6 +112,7 @@ class SleepStageId(Base):
 class SleepDailySummary(Base):
     __tablename__ = 'sleep_daily_summary'
 
+    user_id = Column(Integer, primary_key=True, autoincrement=False)
     date = Column(DateTime, primary_key=True)
     totalMinutesAsleep = Column(Integer)
     totalTimeInBed = Column(Integer)
@@ -113,3 +122,187 @@ class SleepDailySummary(Base):
     wakeMinutes = Column(Integer)
     totalSleepRecords = Column(Integer)
     sleepBreakTimes = Column(String(100))
+
+
+class Spo2DailySummary(Base):
+    __tablename__ = 'spo2_daily_summary'
+
+    # Blood oxygen saturation during the night of the date, in percent.
+    user_id = Column(Integer, primary_key=True, autoincrement=False)
+    date = Column(DateTime, primary_key=True)
+    spo2Avg = Column(Float)
+    spo2Min = Column(Float)
+    spo2Max = Column(Float)
+
+
+class HeartRateVariability(Base):
+    __tablename__ = 'heart_rate_variability'
+
+    user_id = Column(Integer, primary_key=True, autoincrement=False)
+    date = Column(DateTime, primary_key=True)
+    dailyRmssd = Column(Float)
+    deepRmssd = Column(Float)
+
+
+class BreathingRate(Base):
+    __tablename__ = 'breathing_rate'
+
+    user_id = Column(Integer, primary_key=True, autoincrement=False)
+    date = Column(DateTime, primary_key=True)
+    breathingRate = Column(Float)
+
+
+class SkinTemperature(Base):
+    __tablename__ = 'skin_temperature'
+
+    user_id = Column(Integer, primary_key=True, autoincrement=False)
+    date = Column(DateTime, primary_key=True)
+    nightlyRelative = Column(Float)
+    logType = Column(String(30))
+
+
+class Weight(Base):
+    __tablename__ = 'weight'
+
+    user_id = Column(Integer, primary_key=True, autoincrement=False)
+    logId = Column(BigInteger, primary_key=True)
+    date = Column(DateTime, index=True)
+    dateTime = Column(DateTime)
+    weight = Column(Float)
+    bmi = Column(Float)
+    fat = Column(Float)
+    source = Column(String(30))
+
+
+class SyncState(Base):
+    __tablename__ = 'sync_state'
+
+    user_id = Column(Integer, primary_key=True, autoincrement=False)
+    endpoint = Column(String(50), primary_key=True)
+    table_name = Column(String(50), primary_key=True)
+    watermark = Column(DateTime)     # latest date written from the API
+    last_success = Column(DateTime)  # when it was written
+
+
+class BackfillItem(Base):
+    __tablename__ = 'backfill_queue'
+
+    user_id = Column(Integer, primary_key=True, autoincrement=False)
+    endpoint = Column(String(50), primary_key=True)
+    date = Column(DateTime, primary_key=True)
+    done = Column(Boolean, default=False)
+    done_at = Column(DateTime)
+
+
+class DayContentHash(Base):
+    __tablename__ = 'day_content_hash'
+
+    # Hash of the rows last written for a day of a table, see db_diff.py.
+    user_id = Column(Integer, primary_key=True, autoincrement=False)
+    table_name = Column(String(50), primary_key=True)
+    date = Column(DateTime, primary_key=True)
+    content_hash = Column(String(40))
+    num_rows = Column(Integer)
+
+
+class PipelineRun(Base):
+    __tablename__ = 'pipeline_runs'
+
+    # Totals of the run's metrics, see metrics.py.
+    id = Column(Integer, primary_key=True)
+    run_type = Column(String(20))
+    user_id = Column(Integer)  # for runs of a single user, if any
+    started_at = Column(DateTime)
+    duration_seconds = Column(Float)
+    api_calls = Column(Integer)
+    api_bytes = Column(BigInteger)
+    rows_written = Column(Integer)    # inserted, updated or deleted
+    rows_inserted = Column(Integer)
+    rows_updated = Column(Integer)
+    rows_deleted = Column(Integer)
+    rows_unchanged = Column(Integer)  # received, but left as they were
+    failed_jobs = Column(Integer)
+    http_seconds = Column(Float)
+    rate_limit_sleep_seconds = Column(Float)
+    retry_sleep_seconds = Column(Float)
+    parse_seconds = Column(Float)
+    db_seconds = Column(Float)
+    error = Column(String(500))
+
+# ----------------------- COMPACT INTRADAY TABLES -----------------------------
+# Alternative storage of the intraday tables: each sample is keyed by its day
+# (days since 1970-01-01) and its second within that day, next to a small
+# integer value, while the date itself is stored once in IntradayDay. See
+# intraday_compact.py.
+class IntradayDay(Base):
+    __tablename__ = 'intraday_day'
+
+    id = Column(Integer, primary_key=True, autoincrement=False)  # epoch day
+    date = Column(DateTime, unique=True)
+
+
+class ActivitiesStepsIntradayCompact(Base):
+    __tablename__ = 'activities_steps_intraday_compact'
+
+    user_id = Column(Integer, primary_key=True, autoincrement=False)
+    day_id = Column(Integer, primary_key=True, autoincrement=False)
+    second_of_day = Column(Integer, primary_key=True, autoincrement=False)
+    num_steps = Column(SmallInteger)
+
+
+class HeartRateIntradayCompact(Base):
+    __tablename__ = 'heart_rate_intraday_compact'
+
+    user_id = Column(Integer, primary_key=True, autoincrement=False)
+    day_id = Column(Integer, primary_key=True, autoincrement=False)
+    second_of_day = Column(Integer, primary_key=True, autoincrement=False)
+    bpm = Column(SmallInteger)
+
+
+class SleepIntradayCompact(Base):
+    __tablename__ = 'sleep_intraday_compact'
+
+    user_id = Column(Integer, primary_key=True, autoincrement=False)
+    # Sleep starting the evening before its date has negative seconds.
+    day_id = Column(Integer, primary_key=True, autoincrement=False)
+    second_of_day = Column(Integer, primary_key=True, autoincrement=False)
+    duration_seconds = Column(Integer)
+    sleep_stage = Column(SmallInteger)
+
+
+# ---------------------------- ROLLUP TABLES ----------------------------------
+# Aggregates of the intraday tables by minute, hour and day, for
+# queries over long time ranges (see query.py), kept by the DatabaseSink for
+# each day it writes (see rollups.py). time is the start of each period, and
+# date the day of intraday data it was computed from.
+class HeartRateRollup(Base):
+    __tablename__ = 'heart_rate_rollup'
+
+    user_id = Column(Integer, primary_key=True, autoincrement=False)
+    resolution = Column(String(6), primary_key=True)  # minute, hour or day
+    time = Column(DateTime, primary_key=True)
+    date = Column(DateTime, index=True)
+    bpm_min = Column(SmallInteger)
+    bpm_max = Column(SmallInteger)
+    bpm_mean = Column(Float)
+    num_samples = Column(Integer)
+
+
+class ActivitiesStepsRollup(Base):
+    __tablename__ = 'activities_steps_rollup'
+
+    user_id = Column(Integer, primary_key=True, autoincrement=False)
+    resolution = Column(String(6), primary_key=True)
+    time = Column(DateTime, primary_key=True)
+    date = Column(DateTime, index=True)
+    num_steps = Column(Integer)
+
+
+class SleepStageRollup(Base):
+    __tablename__ = 'sleep_stage_rollup'
+
+    # Time spent in each sleep stage, per night.
+    user_id = Column(Integer, primary_key=True, autoincrement=False)
+    date = Column(DateTime, primary_key=True)
+    sleep_stage = Column(SmallInteger, primary_key=True, autoincrement=False)
+    duration_seconds = Column(Integer)
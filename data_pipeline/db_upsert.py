@@ -0,0 +1,189 @@
+"""
+Bulk upsert of parsed dataframes into ORM tables, using the dialect-native
+INSERT ... ON DUPLICATE KEY UPDATE (MySQL) or INSERT ... ON CONFLICT
+(SQLite, PostgreSQL) statements with executemany batching.
+
+Dataframes are streamed to the database one batch at a time: each batch's
+rows are turned into python dicts as it is sent, so that no full copy of a
+dataframe as python objects is ever held.
+"""
+from sqlalchemy import tuple_
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+import pandas as pd
+
+
+def upsert_dataframe(session, table, dataframe, batch_size=1000):
+    """Insert a dataframe into an ORM table, updating the rows whose primary
+    key is already present. The dataframe is expected in the format served by
+    the ResponseParser, i.e. with the primary key passed as index.
+
+    Rows are sent in executemany batches of batch_size rows. Nothing is
+    committed here, so that the caller can write each dataframe in a single
+    transaction.
+
+    Returns a dict with the number of rows "inserted" and "updated".
+    """
+    counts = {"inserted": 0, "updated": 0}
+
+    if dataframe is None or dataframe.empty:
+        return counts
+
+    primary_keys = primary_key_names(table)
+    statement = _upsert_statement(session, table, record_names(dataframe))
+
+    for batch in iter_record_batches(dataframe, batch_size):
+
+        # Count the keys already in the table before overwriting them.
+        keys = [tuple(row[key] for key in primary_keys) for row in batch]
+        num_known = session.query(*_key_columns(table)).filter(
+                                *_key_conditions(table, keys)).count()
+
+        session.execute(statement, batch)
+
+        counts["updated"] += num_known
+        counts["inserted"] += len(batch) - num_known
+
+    return counts
+
+
+def upsert_rows(session, table, dataframe, batch_size=1000):
+    """Same as upsert_dataframe, without counting the keys already present,
+    for callers which know them. Returns the number of rows sent.
+    """
+    if dataframe is None or dataframe.empty:
+        return 0
+
+    statement = _upsert_statement(session, table, record_names(dataframe))
+
+    for batch in iter_record_batches(dataframe, batch_size):
+        session.execute(statement, batch)
+
+    return len(dataframe)
+
+
+def delete_keys(session, table, keys, batch_size=1000):
+    """Delete the rows of the given primary key tuples, in the order of the
+    table's primary key columns. Nothing is committed here.
+    """
+    for i in range(0, len(keys), batch_size):
+        session.query(table).filter(
+            *_key_conditions(table, keys[i:i + batch_size])).delete(
+                                                    synchronize_session=False)
+
+
+def primary_key_names(table):
+    return [column.name for column in table.__table__.primary_key]
+
+
+def iter_record_batches(dataframe, batch_size=1000):
+    """Yield the rows of a parsed dataframe as lists of up to batch_size
+    plain python dicts, ready to be passed as executemany parameters. The
+    index is added back as column(s), and all missing values (nan, NaT) are
+    turned to None. Rows are converted one batch at a time.
+    """
+    names = record_names(dataframe)
+    index = dataframe.index
+
+    for start in range(0, len(dataframe), batch_size):
+        stop = start + batch_size
+
+        columns = [_python_values(index.get_level_values(i)[start:stop])
+                   for i in range(index.nlevels)]
+        columns += [_python_values(dataframe.iloc[start:stop, i])
+                    for i in range(dataframe.shape[1])]
+
+        yield [dict(zip(names, row)) for row in zip(*columns)]
+
+
+def dataframe_to_records(dataframe):
+    """Turn a parsed dataframe into a list of plain python dicts, one per
+    row, as yielded by iter_record_batches.
+    """
+    return [record for batch in iter_record_batches(dataframe)
+            for record in batch]
+
+
+def record_names(dataframe):
+    """Names of the records' fields: the index level(s), then the columns,
+    as named by DataFrame.reset_index.
+    """
+    index_names = list(dataframe.index.names)
+    if index_names == [None]:
+        index_names = ["index"]
+
+    return index_names + list(dataframe.columns)
+
+
+def _python_values(values):
+    """Turn a column or index level into a list of python objects."""
+    series = pd.Series(values, copy=False)
+
+    # Database drivers expect datetime.datetime rather than pd.Timestamp.
+    if pd.api.types.is_datetime64_any_dtype(series):
+        objects = pd.Series(series.dt.to_pydatetime(), dtype=object,
+                            index=series.index)
+    else:
+        objects = series.astype(object)
+
+    return objects.where(series.notna(), None).tolist()
+
+
+def _upsert_statement(session, table, columns):
+    """Build the INSERT statement updating non-key columns on key conflict,
+    in the syntax of the session's database dialect.
+    """
+    sql_table = table.__table__
+    dialect = session.get_bind().dialect.name
+    primary_keys = primary_key_names(table)
+    update_columns = [c for c in columns if c not in primary_keys]
+
+    if dialect == "mysql":
+        statement = mysql.insert(sql_table)
+
+        # MySQL needs at least one assignment; a no-op on the key will do.
+        if not update_columns:
+            update_columns = primary_keys[:1]
+
+        return statement.on_duplicate_key_update(
+            {c: statement.inserted[c] for c in update_columns})
+
+    if dialect in ("sqlite", "postgresql"):
+        module = sqlite if dialect == "sqlite" else postgresql
+        statement = module.insert(sql_table)
+
+        if not update_columns:
+            return statement.on_conflict_do_nothing(
+                index_elements=primary_keys)
+
+        return statement.on_conflict_do_update(
+            index_elements=primary_keys,
+            set_={c: statement.excluded[c] for c in update_columns})
+
+    raise Exception(
+        "Bulk upsert is not supported for dialect {}.".format(dialect))
+
+
+def _key_columns(table):
+    return [getattr(table, name) for name in primary_key_names(table)]
+
+
+def _key_conditions(table, keys):
+    """Conditions selecting the rows of the given primary key tuples."""
+    columns = _key_columns(table)
+
+    # Key columns taking a single value in the batch (e.g. the user_id of a
+    # day's rows) are compared for equality, and the others with IN, which
+    # stays on the primary key index.
+    constant = [i for i in range(len(columns))
+                if len({key[i] for key in keys}) == 1]
+    varying = [i for i in range(len(columns)) if i not in constant]
+
+    conditions = [columns[i] == keys[0][i] for i in constant]
+    if len(varying) == 1:
+        i = varying[0]
+        conditions.append(columns[i].in_([key[i] for key in keys]))
+    elif varying:
+        conditions.append(tuple_(*[columns[i] for i in varying]).in_(
+                            [tuple(key[i] for i in varying) for key in keys]))
+
+    return conditions
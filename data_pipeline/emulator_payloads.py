@@ -0,0 +1,267 @@
+"""
+Synthetic Fitbit API responses, in the format served by each endpoint, for
+the local API emulator (see fitbit_emulator.py) and benchmarks. Intraday
+datasets have one point per minute of the day, and weight is logged every
+third day.
+"""
+import numpy as np
+import pandas as pd
+
+
+def intraday_response(resource, date, low, high, seed=0, num_points=1440):
+    """A 1-minute intraday response of the activities/{resource} endpoint,
+    e.g. resource="heart" or resource="steps".
+    """
+    rng = np.random.default_rng(seed)
+    values = rng.integers(low, high, size=num_points)
+
+    dataset = [{"time": "{:02d}:{:02d}:00".format(i // 60, i % 60),
+                "value": int(value)}
+               for i, value in enumerate(values)]
+
+    return {
+        "activities-{}".format(resource): [{
+            "dateTime": pd.to_datetime(date).strftime("%Y-%m-%d"),
+            "value": str(int(values.sum()))
+            }],
+        "activities-{}-intraday".format(resource): {
+            "dataset": dataset,
+            "datasetInterval": 1,
+            "datasetType": "minute"
+            }
+    }
+
+
+def heart_rate_response(date, seed=0, num_points=1440):
+    return intraday_response("heart", date, 50, 160, seed, num_points)
+
+
+def steps_response(date, seed=0, num_points=1440):
+    return intraday_response("steps", date, 0, 120, seed, num_points)
+
+
+def activities_response(date, seed=0, num_activities=3):
+    """A response of the activities/date/{date} endpoint, with the day's
+    summary and num_activities logged activities.
+    """
+    rng = np.random.default_rng(seed)
+    date_string = pd.to_datetime(date).strftime("%Y-%m-%d")
+
+    activities = []
+    for i in range(num_activities):
+        activities.append({
+            "logId": int(pd.to_datetime(date).value // 10**6) + i,
+            "activityId": 90013,
+            "activityParentId": 90013,
+            "activityParentName": "Walk",
+            "name": "Walk",
+            "description": "Walking less than 2 mph, strolling very slowly",
+            "hasStartTime": True,
+            "isFavorite": False,
+            "hasActiveZoneMinutes": True,
+            "startDate": date_string,
+            "startTime": "{:02d}:{:02d}".format(8 + 3 * i,
+                                                int(rng.integers(0, 60))),
+            "duration": int(rng.integers(10, 90)) * 60000,
+            "steps": int(rng.integers(500, 6000)),
+            "calories": int(rng.integers(50, 400))
+        })
+
+    summary = {key: int(rng.integers(low, high)) for key, low, high in [
+        ("activeScore", -1, 0),
+        ("activityCalories", 500, 1500),
+        ("caloriesBMR", 1500, 1800),
+        ("caloriesOut", 2000, 3500),
+        ("marginalCalories", 200, 900),
+        ("sedentaryMinutes", 500, 900),
+        ("lightlyActiveMinutes", 100, 300),
+        ("fairlyActiveMinutes", 0, 60),
+        ("veryActiveMinutes", 0, 60),
+        ("restingHeartRate", 50, 70),
+        ("steps", 2000, 20000)]}
+    summary["distances"] = []
+    summary["heartRateZones"] = []
+
+    return {"activities": activities, "goals": {}, "summary": summary}
+
+
+def sleep_record(date, seed=0):
+    """A night's staged sleep record, from 23:00 the evening before date,
+    with 30-second stage levels and a few short wake periods.
+    """
+    rng = np.random.default_rng(seed)
+    date = pd.to_datetime(date)
+    start = date - pd.Timedelta(hours=1)
+
+    # Long cycles of 5 to 40 minutes, in 30-second steps.
+    data, time = [], start
+    minutes = {"deep": 0, "light": 0, "rem": 0, "wake": 0}
+    while time < date + pd.Timedelta(hours=7):
+        level = ["deep", "light", "rem", "wake"][int(rng.integers(0, 4))]
+        seconds = int(rng.integers(10, 80)) * 30
+        data.append({"dateTime": time.strftime("%Y-%m-%dT%H:%M:%S.000"),
+                     "level": level, "seconds": seconds})
+        minutes[level] += seconds // 60
+        time += pd.Timedelta(seconds=seconds)
+
+    short_data = [{"dateTime": row["dateTime"], "level": "wake",
+                   "seconds": 30} for row in data[1::5]]
+
+    time_in_bed = int((time - start).total_seconds() // 60)
+    return {
+        "dateOfSleep": date.strftime("%Y-%m-%d"),
+        "startTime": start.strftime("%Y-%m-%dT%H:%M:%S.000"),
+        "endTime": time.strftime("%Y-%m-%dT%H:%M:%S.000"),
+        "type": "stages",
+        "isMainSleep": True,
+        "minutesAsleep": time_in_bed - minutes["wake"],
+        "timeInBed": time_in_bed,
+        "levels": {
+            "data": data,
+            "shortData": short_data,
+            "summary": {level: {"minutes": value}
+                        for level, value in minutes.items()}
+        }
+    }
+
+
+def sleep_response(date, seed=0):
+    """A response of the single day sleep/date/{date} endpoint."""
+    record = sleep_record(date, seed)
+    stages = record["levels"]["summary"]
+
+    return {"sleep": [record],
+            "summary": {
+                "totalMinutesAsleep": record["minutesAsleep"],
+                "totalSleepRecords": 1,
+                "totalTimeInBed": record["timeInBed"],
+                "stages": {level: stages[level]["minutes"]
+                           for level in ["deep", "light", "rem", "wake"]}
+            }}
+
+
+def sleep_range_response(start_date, end_date):
+    """A response of the sleep/date/{start}/{end} range endpoint."""
+    dates = pd.date_range(start=start_date, end=end_date)
+    return {"sleep": [sleep_record(date, seed=date.toordinal())
+                      for date in dates]}
+
+
+def spo2_record(date, seed=0):
+    """A night's SpO2 summary, in percent."""
+    rng = np.random.default_rng(seed)
+    low = round(float(rng.uniform(90, 95)), 1)
+    return {"dateTime": pd.to_datetime(date).strftime("%Y-%m-%d"),
+            "value": {"avg": round(low + 2.5, 1), "min": low,
+                      "max": round(low + 5, 1)}}
+
+
+def health_metric_records(key, date, seed=0):
+    """The night's record of the hrv, br or temp/skin endpoint, listed under
+    key ("hrv", "br" or "tempSkin").
+    """
+    rng = np.random.default_rng(seed)
+    date_string = pd.to_datetime(date).strftime("%Y-%m-%d")
+
+    if key == "hrv":
+        value = {"dailyRmssd": round(float(rng.uniform(20, 60)), 3),
+                 "deepRmssd": round(float(rng.uniform(20, 60)), 3)}
+    elif key == "br":
+        value = {"breathingRate": round(float(rng.uniform(12, 20)), 1)}
+    else:
+        value = {"nightlyRelative": round(float(rng.uniform(-1, 1)), 1)}
+
+    record = {"dateTime": date_string, "value": value}
+    if key == "tempSkin":
+        record["logType"] = "dedicated_temp_sensor"
+
+    return [record]
+
+
+def weight_records(date, seed=0):
+    """The weight logs of a day: one every third day, from a smart scale."""
+    date = pd.to_datetime(date)
+    if date.toordinal() % 3:
+        return []
+
+    rng = np.random.default_rng(seed)
+    weight = round(float(rng.uniform(70, 75)), 1)
+    return [{"logId": int(date.value // 10**6) + 7 * 3600 * 1000,
+             "date": date.strftime("%Y-%m-%d"),
+             "time": "07:00:00",
+             "weight": weight,
+             "bmi": round(weight / 1.75**2, 2),
+             "fat": round(float(rng.uniform(15, 20)), 1),
+             "source": "Aria"}]
+
+
+def health_metric_response(key, start_date, end_date=None):
+    """A response of the spo2, hrv, br, temp/skin or body/log/weight
+    endpoints (key "spo2", "hrv", "br", "tempSkin" or "weight"), for a day
+    or a date range.
+    """
+    dates = pd.date_range(start=start_date, end=end_date or start_date)
+
+    if key == "spo2":
+        records = [spo2_record(date, date.toordinal()) for date in dates]
+        if end_date is None:  # a single day's record, as is
+            return records[0]
+        return records
+
+    records = []
+    for date in dates:
+        if key == "weight":
+            records.extend(weight_records(date, date.toordinal()))
+        else:
+            records.extend(health_metric_records(key, date, date.toordinal()))
+
+    return {key: records}
+
+
+def profile_response(member_since="2020-01-01"):
+    """A response of the profile endpoint."""
+    return {"user": {"memberSince": member_since,
+                     "strideLengthRunning": 104.1,
+                     "strideLengthWalking": 73.2,
+                     "timezone": "Europe/Paris"}}
+
+
+def api_payload(path, member_since="2020-01-01"):
+    """The payload served by the Fitbit web API for a request path, e.g.
+    /1/user/-/activities/heart/date/2021-07-24/1d.json, for local stand-ins
+    of the API. Payloads only depend on the path. Return None for paths of
+    no known endpoint.
+    """
+    path = path.split("?")[0]
+    if path.endswith("/profile.json"):
+        return profile_response(member_since)
+
+    if "/date/" not in path:
+        return None
+
+    dates = [part[:10] for part in path.split("/date/")[1].split("/")
+             if part[:4].isdigit()]
+    if not dates:
+        return None
+
+    date = pd.to_datetime(dates[0])
+    seed = date.toordinal()
+
+    for marker, key in [("/spo2/", "spo2"), ("/hrv/", "hrv"), ("/br/", "br"),
+                        ("/temp/skin/", "tempSkin"),
+                        ("/body/log/weight/", "weight")]:
+        if marker in path:
+            return health_metric_response(key, *dates)
+
+    if "/sleep/" in path:
+        if len(dates) == 2:
+            return sleep_range_response(dates[0], dates[1])
+        return sleep_response(date, seed)
+
+    if "/heart/" in path:
+        return heart_rate_response(date, seed)
+
+    if "/steps/" in path:
+        return steps_response(date, seed)
+
+    return activities_response(date, seed)
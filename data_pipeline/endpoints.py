@@ -0,0 +1,288 @@
+"""
+Registry of the Fitbit API resources synced by the Loader. Each endpoint
+declares its urls, how many days a request may cover, how often the daemon
+updates it (see scheduler.py), and the tables parsed out of its responses,
+each by its parser schema (see parser_schemas.py) and ORM table. Fetching,
+parsing, writing, backfills, replays and schedules then work the same for
+every endpoint registered, and a new resource is added with:
+
+    endpoints.register(Endpoint(
+        name="body_fat",
+        url="/1/user/-/body/log/fat/date/{date}.json",
+        tables=[(BodyFat, BODY_FAT_SCHEMA)],
+        schedule=DailyAt(hour=9)))
+
+Endpoints are synced unless left out of the Loader's endpoint_names. Those
+registered with enabled=False are only synced when asked for, e.g. as they
+need OAuth scopes granted to few applications.
+"""
+from scheduler import DailyAt, Every
+import db_tables
+import pandas as pd
+import parser_schemas
+
+
+class Endpoint:
+    """An API resource synced by the Loader.
+
+    name:             name of the endpoint in the sync state, the response
+                      store, the backfill queue and the metrics.
+    url:              path of a day's data from the base url of the Fitbit
+                      client, with a {date} field.
+    tables:           (ORM table, TableSchema) pairs of the tables parsed
+                      out of each day's response.
+    range_url:        path of the data over a date range, with {start} and
+                      {end} fields, for endpoints serving ranges.
+    max_range_days:   maximal number of days per request, 1 for endpoints
+                      fetched one day at a time.
+    split_range:      function(response, dates) splitting a range response
+                      into a dict of (date, single day response) pairs, in
+                      the format of the single day url.
+    final_after_days: a stored raw response fetched at least that many days
+                      after its date is final, and is read back from the
+                      response store instead of the API. None to always
+                      fetch from the API.
+    schedule:         how often the daemon updates the endpoint.
+    enabled:          whether the endpoint is synced by default.
+    """
+
+    def __init__(self, name, url, tables, range_url=None, max_range_days=1,
+                 split_range=None, final_after_days=None,
+                 schedule=Every(60 * 60), enabled=True):
+        self.name = name
+        self.url = url
+        self.tables = tables
+        self.range_url = range_url
+        self.max_range_days = max_range_days
+        self.split_range = split_range
+        self.final_after_days = final_after_days
+        self.schedule = schedule
+        self.enabled = enabled
+
+        if max_range_days > 1 and (range_url is None or split_range is None):
+            raise Exception("Endpoint {} needs a range_url and a split_range "
+                            "function to fetch date ranges.".format(name))
+
+        # ORM table of each table parsed, by table name.
+        self.db_tables = {table.__name__: table for table, _ in tables}
+
+    def parse(self, response, date):
+        """Parse a day's response into a dict of (tablename, df) pairs."""
+        return {table.__name__: parser_schemas.parse_table(schema, response,
+                                                           date)
+                for table, schema in self.tables}
+
+    def get_url(self, dates):
+        """Return the url fetching the endpoint's data over consecutive
+        dates: the single day url for a single date, the range url otherwise.
+        """
+        if len(dates) == 1:
+            return self.url.format(date=dates[0].strftime("%Y-%m-%d"))
+
+        return self.range_url.format(start=dates[0].strftime("%Y-%m-%d"),
+                                     end=dates[-1].strftime("%Y-%m-%d"))
+
+    def split_response_by_date(self, response, dates):
+        """Return a dict of (date, response) pairs of a response over
+        consecutive dates, in the format of the single day url. Raises
+        parser_schemas.BadResponseFormat if the response can't be split.
+        """
+        if len(dates) == 1:
+            return {dates[0]: response}
+
+        try:
+            return self.split_range(response, dates)
+        except (KeyError, TypeError, AttributeError) as e:
+            raise parser_schemas.BadResponseFormat(
+                    "Bad {name} range response format: {e!r}".format(
+                        name=self.name, e=e)) from e
+
+
+# Endpoints by name, in the order they are synced.
+ENDPOINTS = {}
+
+
+def register(endpoint):
+    """Add an endpoint to the registry, replacing any of the same name."""
+    ENDPOINTS[endpoint.name] = endpoint
+    return endpoint
+
+
+def get_endpoints(names=None):
+    """Return the registered endpoints of the given names, or those enabled
+    by default, as a dict by name in the order of the registry.
+    """
+    if names is None:
+        return {name: endpoint for name, endpoint in ENDPOINTS.items()
+                if endpoint.enabled}
+
+    unknown = [name for name in names if name not in ENDPOINTS]
+    if unknown:
+        raise Exception("Unknown endpoint(s) {}, expected some of {}.".format(
+                        ", ".join(unknown), ", ".join(ENDPOINTS)))
+
+    return {name: endpoint for name, endpoint in ENDPOINTS.items()
+            if name in names}
+
+
+# ------------------------------ RANGE SPLITS ---------------------------------
+def split_sleep_range_response(response, dates):
+    """Split a date range sleep response into single day responses. Return a
+    dict of (date, response) pairs, with an entry for each date in dates.
+    """
+    # The range response only lists sleep records, each stamped with
+    # its dateOfSleep. We group them by date first.
+    records_by_date = {date: [] for date in dates}
+
+    for record in response.get("sleep", []):
+        date = pd.to_datetime(record["dateOfSleep"])
+        if date in records_by_date:
+            records_by_date[date].append(record)
+
+    # The daily summary isn't served for a date range, so we rebuild it
+    # from the records, as the single day endpoint does: totals are
+    # summed over all records and stage minutes over records with stages.
+    responses = {}
+    for date, records in records_by_date.items():
+
+        summary = {
+            "totalMinutesAsleep": sum(r["minutesAsleep"] for r in records),
+            "totalSleepRecords": len(records),
+            "totalTimeInBed": sum(r["timeInBed"] for r in records)
+        }
+
+        stages_records = [r for r in records if r.get("type") == "stages"]
+        if stages_records:
+            summary["stages"] = {
+                stage: sum(r["levels"]["summary"][stage]["minutes"]
+                           for r in stages_records)
+                for stage in ["deep", "light", "rem", "wake"]
+            }
+
+        responses[date] = {"sleep": records, "summary": summary}
+
+    return responses
+
+
+def split_records_by_date(key, date_key="dateTime"):
+    """Split range responses listing records under key, each stamped with
+    its "yyyy-mm-dd" date under date_key, as the single day responses do.
+    """
+    def split(response, dates):
+        responses = {date: {key: []} for date in dates}
+
+        for record in response.get(key, []):
+            date = pd.to_datetime(record[date_key][:10])
+            if date in responses:
+                responses[date][key].append(record)
+
+        return responses
+    return split
+
+
+def split_spo2_range_response(response, dates):
+    """SpO2 ranges are served as a list of the days' records, and single
+    days as the record itself, or empty.
+    """
+    responses = {date: {} for date in dates}
+
+    for record in response:
+        date = pd.to_datetime(record["dateTime"][:10])
+        if date in responses:
+            responses[date] = record
+
+    return responses
+
+
+# ------------------------------ ENDPOINTS ------------------------------------
+# Intraday data comes in through the day, while the night's sleep and the
+# metrics computed from it are synced once in the morning.
+register(Endpoint(
+    name="heart_rate",
+    url="/1/user/-/activities/heart/date/{date}/1d.json",
+    tables=[(db_tables.HeartRateIntraday,
+             parser_schemas.HEART_RATE_INTRADAY)],
+    final_after_days=2,
+    schedule=Every(15 * 60)))
+
+register(Endpoint(
+    name="steps",
+    url="/1/user/-/activities/steps/date/{date}/1d.json",
+    tables=[(db_tables.ActivitiesStepsIntraday,
+             parser_schemas.ACTIVITIES_STEPS_INTRADAY)],
+    final_after_days=2,
+    schedule=Every(15 * 60)))
+
+register(Endpoint(
+    name="activities",
+    url="/1/user/-/activities/date/{date}.json",
+    tables=[(db_tables.Activities, parser_schemas.ACTIVITIES),
+            (db_tables.ActivitiesDailySummary,
+             parser_schemas.ACTIVITIES_DAILY_SUMMARY)],
+    schedule=Every(60 * 60)))
+
+register(Endpoint(
+    name="sleep",
+    url="/1.2/user/-/sleep/date/{date}.json",
+    range_url="/1.2/user/-/sleep/date/{start}/{end}.json",
+    max_range_days=100,
+    split_range=split_sleep_range_response,
+    tables=[(db_tables.SleepIntraday, parser_schemas.SLEEP_INTRADAY),
+            (db_tables.SleepDailySummary,
+             parser_schemas.SLEEP_DAILY_SUMMARY)],
+    schedule=DailyAt(hour=9)))
+
+# The health metrics and weight endpoints need the oxygen_saturation,
+# heartrate, respiratory_rate, temperature and weight OAuth scopes, which
+# tokens authorized for the endpoints above may lack: they are synced when
+# asked for.
+register(Endpoint(
+    name="spo2",
+    url="/1/user/-/spo2/date/{date}.json",
+    range_url="/1/user/-/spo2/date/{start}/{end}.json",
+    max_range_days=30,
+    split_range=split_spo2_range_response,
+    tables=[(db_tables.Spo2DailySummary, parser_schemas.SPO2_DAILY_SUMMARY)],
+    schedule=DailyAt(hour=9),
+    enabled=False))
+
+register(Endpoint(
+    name="hrv",
+    url="/1/user/-/hrv/date/{date}.json",
+    range_url="/1/user/-/hrv/date/{start}/{end}.json",
+    max_range_days=30,
+    split_range=split_records_by_date("hrv"),
+    tables=[(db_tables.HeartRateVariability,
+             parser_schemas.HEART_RATE_VARIABILITY)],
+    schedule=DailyAt(hour=9),
+    enabled=False))
+
+register(Endpoint(
+    name="breathing_rate",
+    url="/1/user/-/br/date/{date}.json",
+    range_url="/1/user/-/br/date/{start}/{end}.json",
+    max_range_days=30,
+    split_range=split_records_by_date("br"),
+    tables=[(db_tables.BreathingRate, parser_schemas.BREATHING_RATE)],
+    schedule=DailyAt(hour=9),
+    enabled=False))
+
+register(Endpoint(
+    name="skin_temperature",
+    url="/1/user/-/temp/skin/date/{date}.json",
+    range_url="/1/user/-/temp/skin/date/{start}/{end}.json",
+    max_range_days=30,
+    split_range=split_records_by_date("tempSkin"),
+    tables=[(db_tables.SkinTemperature, parser_schemas.SKIN_TEMPERATURE)],
+    schedule=DailyAt(hour=9),
+    enabled=False))
+
+register(Endpoint(
+    name="weight",
+    url="/1/user/-/body/log/weight/date/{date}.json",
+    range_url="/1/user/-/body/log/weight/date/{start}/{end}.json",
+    max_range_days=31,
+    split_range=split_records_by_date("weight", date_key="date"),
+    tables=[(db_tables.Weight, parser_schemas.WEIGHT)],
+    schedule=Every(6 * 60 * 60),
+    enabled=False))
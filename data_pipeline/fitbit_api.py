@@ -2,26 +2,89 @@
 A Fitbit class handling all requests interactions with the Fitbit web API.
 See https://dev.fitbit.com/build/reference/web-api/ for details.
 """
+import asyncio
+import json_decoder
+import metrics
 import requests
+import threading
 import time
 import datetime
 from db_tables import FitbitCredentials
+from rate_limiter import RateLimiter
+
+try:  # only needed by AsyncFitbit
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+def http_pool(max_connections=10):
+    """A requests session keeping up to max_connections connections to the
+    API alive, which can be shared by the Fitbit instances of many users
+    calling from as many threads.
+    """
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                            pool_maxsize=max_connections)
+    http = requests.Session()
+    http.mount("https://", adapter)
+    http.mount("http://", adapter)
+    return http
 
 
 class Fitbit:
     """A wrapper class for calling the Fitbit web API via oauth2, handling
     the authentication, rate limiting and token refresh process automatically.
+    A single instance can be shared by several threads.
+
+    Resources are requested by url, or by path from the API base url (e.g.
+    "/1/user/-/profile.json"). The base url can point to a local emulator of
+    the API instead (see fitbit_emulator.py).
+
+    Each instance calls the API for one user, with the credentials of row
+    user_id of the fitbit_credentials table, and its own rate limiter since
+    Fitbit limits calls per user. Instances of many users can share a single
+    pool of HTTP connections, passed as http (see http_pool).
 
     See https://dev.fitbit.com/build/reference/web-api/ for details.
     """
 
-    def __init__(self, session, seconds_between_calls=1, verbose=False):
+    base_url = "https://api.fitbit.com"
+
+    def __init__(self, session, seconds_between_calls=1, verbose=False,
+                 rate_limiter=None, decoder=json_decoder.decode, timeout=60,
+                 base_url=None, user_id=1, http=None):
         self.session = session
+        self.user_id = user_id
         self.seconds_between_calls = seconds_between_calls
         self.verbose = verbose
+        self.timeout = timeout  # seconds to wait on a response
+
+        if base_url is not None:
+            self.base_url = base_url.rstrip("/")
+        self.token_url = self.base_url + "/oauth2/token"
+
+
+        # Function decoding the raw bytes of response payloads.
+        self.decoder = decoder
+
+        # Rate limiter throttling calls to the hourly API budget. It can be
+        # passed along to share a single budget between Fitbit instances.
+        if rate_limiter is None:
+            rate_limiter = RateLimiter(min_interval=seconds_between_calls,
+                                       verbose=verbose)
+        self.rate_limiter = rate_limiter
+
+        # Lock making sure threads sharing this instance refresh tokens once.
+        self._token_lock = threading.Lock()
+
+        # Pooled HTTP session, keeping connections to the API alive.
+        if http is None:
+            http = self._make_http()
+        self.http = http
 
         # fetch API credentials from database
-        fitbit_credentials = self.session.query(FitbitCredentials).get(1)
+        fitbit_credentials = self.session.query(FitbitCredentials).get(
+                                                                self.user_id)
 
         self.client_id = fitbit_credentials.client_id
         self.client_secret = fitbit_credentials.client_secret
@@ -31,37 +94,22 @@ class Fitbit:
 
         self.session.commit()
 
-    def __wait_for_api_rate_limit_refresh(self):
-        """
-        Sleep until next hour, plus five minutes to allow the API rate limit to
-        refresh. Called when API rate limit is reached.
-        """
-        offset = 5 	# number of minutes past the hour as offset
-
-        delta = datetime.timedelta(hours=1)
-        now = datetime.datetime.now()
-        next_hour = (now + delta).replace(microsecond=0, second=0, minute=0)
-
-        # add some minutes to be safe
-        next_hour += datetime.timedelta(minutes=offset)
+    def _make_http(self):
+        return http_pool()
 
-        # sleep until next hour
-        if self.verbose:
-            time_of_refresh = next_hour.strftime("%H:%M:%S")
-            print("Hitting API rate limit. Sleeping until {time}".format(
-                                                        time=time_of_refresh))
-
-        sleep_seconds = (next_hour - now).seconds
-
-        # sleep until next hour
-        time.sleep(sleep_seconds)
+    def resource_url(self, url):
+        """Full url of a resource, given by url or by path."""
+        if url.startswith("/"):
+            return self.base_url + url
+        return url
 
-    def __update_static_tokens(self, tokens_dict):
+    def _update_static_tokens(self, tokens_dict):
         """
         Updates token data in database. This is for when access_token
         expires and new tokens are fetched from the api.
         """
-        fitbit_credentials = self.session.query(FitbitCredentials).get(1)
+        fitbit_credentials = self.session.query(FitbitCredentials).get(
+                                                                self.user_id)
 
         fitbit_credentials.access_token = tokens_dict["access_token"]
         fitbit_credentials.refresh_token = tokens_dict["refresh_token"]
@@ -77,59 +125,206 @@ class Fitbit:
         """
 
         # Fetch new token dict from Fitbit server
-        response = requests.post(url='https://api.fitbit.com/oauth2/token',
-                                 data={"client_id": self.client_id,
-                                       "grant_type": "refresh_token",
-                                       "refresh_token": self.refresh_token
-                                       },
-                                 auth=(self.client_id, self.client_secret)
-                                 )
-
-        # Check if rate limit is reached, if so sleep and try again.
+        response = self.http.post(url=self.token_url,
+                                  data=self._refresh_token_data(),
+                                  auth=(self.client_id, self.client_secret),
+                                  timeout=self.timeout
+                                  )
+
+        # If the rate limit is reached, hold further calls until its reset.
+        # Errors are raised as requests.HTTPError, and retried by the caller
+        # (see retry.py).
         if response.status_code == 429:  # api rate limit reached
-            self.__wait_for_api_rate_limit_refresh()
-            self.refresh_tokens()
+            self.rate_limiter.on_rate_limited(response.headers)
 
-        elif response.status_code != 200:
-            raise Exception(response.status_code)
+        response.raise_for_status()
 
-        else:
-            tokens = response.json()
+        self._store_tokens(response.json())
 
-            # Store tokens' time of expiry so we know when to refresh again
-            expires_in = float(tokens['expires_in'])
-            tokens['expires_at'] = time.time() + expires_in
+    def _refresh_token_data(self):
+        return {"client_id": self.client_id,
+                "grant_type": "refresh_token",
+                "refresh_token": self.refresh_token
+                }
 
-            # Update everything with new token data
-            self.access_token = tokens['access_token']
-            self.refresh_token = tokens['refresh_token']
-            self.expires_at = tokens['expires_at']
-            self.__update_static_tokens(tokens)
+    def _store_tokens(self, tokens):
+        """Keep the tokens freshly fetched from the API, in attributes and in
+        the database.
+        """
+        # Store tokens' time of expiry so we know when to refresh again
+        expires_in = float(tokens['expires_in'])
+        tokens['expires_at'] = time.time() + expires_in
+
+        # Update everything with new token data
+        self.access_token = tokens['access_token']
+        self.refresh_token = tokens['refresh_token']
+        self.expires_at = tokens['expires_at']
+        self._update_static_tokens(tokens)
+
+    def _access_token_expired(self):
+        return (not self.expires_at) or (time.time() >= float(self.expires_at))
 
     def get_resource(self, url):
         """
-        Wrapper for requests.get method, passing along access token. First
-        checks if access_token exists or has expired, and refresh it if needed.
+        Wrapper for the requests GET method, passing along access token, and
+        returning the decoded payload. First checks if access_token exists or
+        has expired, and refresh it if needed. Raises requests.HTTPError for
+        error responses, 429 included: calls are retried by the caller (see
+        retry.py), and held by the rate limiter until the budget resets.
         """
         # Check access token is still valid.
-        if (not self.expires_at) or (time.time() >= float(self.expires_at)):
-            self.refresh_tokens()
+        if self._access_token_expired():
+            with self._token_lock:
+                # Another thread may have refreshed it while we waited.
+                if self._access_token_expired():
+                    self.refresh_tokens()
 
-        # Wait a few seconds before next call.
-        # This is to prevent continuously hitting the rate limit.
-        time.sleep(self.seconds_between_calls)
+        # Wait for our turn within the API rate limit.
+        self.rate_limiter.acquire()
 
         # Send in request.
+        url = self.resource_url(url)
         if self.verbose:
             now = datetime.datetime.now().strftime("%H:%M:%S %h %d")
             print("API call at {time} ~ {url}".format(time=now, url=url))
 
         headers = {'Authorization': 'Bearer {}'.format(self.access_token)}
-        response = requests.request('GET', url=url, headers=headers)
+        with metrics.timer("api_request_seconds"):
+            try:
+                response = self.http.get(url=url, headers=headers,
+                                         timeout=self.timeout)
+            except requests.exceptions.RequestException:
+                metrics.inc("api_requests_total", status="error")
+                raise
+
+        metrics.inc("api_requests_total", status=str(response.status_code))
+        metrics.inc("api_response_bytes_total", len(response.content))
+
+        # Keep track of the remaining budget served with the response.
+        self.rate_limiter.update(response.headers)
 
-        # Check if rate limit is reached, if so sleep and try again.
+        # If the rate limit is reached, hold further calls until its reset.
         if response.status_code == 429:
-            self.__wait_for_api_rate_limit_refresh()
-            response = self.get_resource(url=url)
+            self.rate_limiter.on_rate_limited(response.headers)
+
+        response.raise_for_status()
+
+        return self.decoder(response.content)
+
+
+class AsyncFitbit(Fitbit):
+    """Asyncio counterpart of the Fitbit class, with the same authentication,
+    rate limiting and token refresh handling. Requests go through a single
+    pooled keep-alive aiohttp session, and can be issued concurrently: the
+    rate limiter lets them through as long as budget remains, and token
+    refresh is serialized so that concurrent requests only refresh once.
+
+    Use as an async context manager, which opens and closes the HTTP session:
+
+        async with AsyncFitbit(session) as fitbit:
+            payload = await fitbit.get_resource(url)
+    """
+
+    def __init__(self, session, seconds_between_calls=1, verbose=False,
+                 rate_limiter=None, decoder=json_decoder.decode, timeout=60,
+                 base_url=None, max_connections=10, user_id=1):
+        if aiohttp is None:
+            raise Exception("AsyncFitbit requires the aiohttp package.")
+
+        super().__init__(session, seconds_between_calls, verbose, rate_limiter,
+                         decoder, timeout, base_url, user_id)
+        self.max_connections = max_connections
+
+        # Needs a running event loop, and is created on open().
+        self._async_token_lock = None
+
+    def _make_http(self):
+        # The aiohttp session needs a running event loop: it is created on
+        # open(), rather than a requests pool left unused.
+        return None
+
+    async def open(self):
+        connector = aiohttp.TCPConnector(limit=self.max_connections)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        self.http = aiohttp.ClientSession(connector=connector,
+                                          timeout=timeout)
+        self._async_token_lock = asyncio.Lock()
+
+    async def close(self):
+        await self.http.close()
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def refresh_tokens(self):
+        """
+        Fetch a new token dictionary from Fitbit API, and refresh the token
+        attributes (access_token, refresh_token, expires_at) as well as their
+        database instance.
+        """
+        auth = aiohttp.BasicAuth(self.client_id, self.client_secret)
+        headers = {'Authorization': auth.encode()}
+        async with self.http.post(self.token_url,
+                                  data=self._refresh_token_data(),
+                                  headers=headers) as response:
+
+            # If the rate limit is reached, hold further calls until its
+            # reset. Errors are retried by the caller (see retry.py).
+            if response.status == 429:  # api rate limit reached
+                self.rate_limiter.on_rate_limited(response.headers)
+
+            response.raise_for_status()
+
+            tokens = await response.json()
+
+        self._store_tokens(tokens)
+
+    async def get_resource(self, url):
+        """
+        Send a GET request to the API, passing along access token, and return
+        the decoded JSON payload. First checks if access_token exists or has
+        expired, and refresh it if needed. Raises aiohttp.ClientResponseError
+        for error responses, 429 included, as Fitbit.get_resource does.
+        """
+        # Check access token is still valid.
+        if self._access_token_expired():
+            async with self._async_token_lock:
+                # Another request may have refreshed it while we waited.
+                if self._access_token_expired():
+                    await self.refresh_tokens()
+
+        # Wait for our turn within the API rate limit.
+        await self.rate_limiter.acquire_async()
+
+        # Send in request.
+        url = self.resource_url(url)
+        if self.verbose:
+            now = datetime.datetime.now().strftime("%H:%M:%S %h %d")
+            print("API call at {time} ~ {url}".format(time=now, url=url))
+
+        headers = {'Authorization': 'Bearer {}'.format(self.access_token)}
+        with metrics.timer("api_request_seconds"):
+            try:
+                async with self.http.get(url, headers=headers) as response:
+                    content = await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                metrics.inc("api_requests_total", status="error")
+                raise
+
+        metrics.inc("api_requests_total", status=str(response.status))
+        metrics.inc("api_response_bytes_total", len(content))
+
+        # Keep track of the remaining budget served with the response.
+        self.rate_limiter.update(response.headers)
+
+        # If the rate limit is reached, hold further calls until its reset.
+        if response.status == 429:
+            self.rate_limiter.on_rate_limited(response.headers)
+
+        response.raise_for_status()
 
-        return response
+        return self.decoder(content)
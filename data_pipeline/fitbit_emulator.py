@@ -0,0 +1,319 @@
+"""
+A local emulator of the Fitbit web API, for load and integration testing of
+the pipeline without the real API and its 150 calls per hour.
+
+It serves generated data for the profile endpoint and each endpoint of the
+pipeline's registry (see emulator_payloads.py), refreshes OAuth tokens, and
+enforces a rate limit with the Fitbit-Rate-Limit-* headers and 429s. Latency
+and errors can be injected, from a seeded random generator, or on given paths
+for deterministic tests.
+
+Point the pipeline at it with its base url, e.g.:
+
+    python3 data_pipeline/fitbit_emulator.py --port 8080 --limit 1000
+    python3 data_pipeline/run_pipeline.py --api_base_url http://127.0.0.1:8080
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+import argparse
+import emulator_payloads
+import json
+import random
+import threading
+import time
+import uuid
+
+
+class FitbitEmulator:
+    """Serve the Fitbit web API from a background thread.
+
+    limit:          calls allowed per rate limit window, of window_seconds
+                    (an hour on the real API), for each access token, i.e.
+                    for each user as on the real API.
+    latency:        seconds each call takes, plus up to latency_jitter.
+    error_rate:     share of calls failing with a 500, 502 or 503 status, or
+                    with a connection closed without answer.
+    faults:         path substrings mapped to lists of faults, the next of
+                    which is served instead of the answer on each GET to a
+                    matching path: an error status, "reset" to close the
+                    connection without answer, or "slow" to close it after
+                    slow_seconds of real time, e.g. past the client's timeout.
+    token_lifetime: seconds before an access token expires.
+    access_token, refresh_token:
+                    tokens accepted until the first refresh. When None, any
+                    token is. Refreshed tokens replace them, refresh tokens
+                    being single use as on the real API.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, limit=150,
+                 window_seconds=3600, latency=0, latency_jitter=0,
+                 error_rate=0, token_lifetime=28800, access_token=None,
+                 refresh_token=None, member_since="2020-01-01", seed=0,
+                 faults=None, slow_seconds=1, clock=time.time,
+                 sleep=time.sleep):
+        self.limit = limit
+        self.window_seconds = window_seconds
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.faults = faults or {}
+        self.slow_seconds = slow_seconds
+        self.token_lifetime = token_lifetime
+        self.member_since = member_since
+
+        # Time functions, which can be replaced to simulate time in tests.
+        self.clock = clock
+        self.sleep = sleep
+
+        self.access_token = access_token
+        self.access_token_expires_at = None  # no expiry until a refresh
+        self.refresh_token = refresh_token
+
+        # Counts of requests by outcome.
+        self.stats = {"requests": 0, "success": 0, "rate_limited": 0,
+                      "errors": 0, "unauthorized": 0, "not_found": 0,
+                      "token_refresh": 0}
+        self.paths = []            # paths of the GET requests answered
+        self.client_ports = set()  # one per connection opened to it
+
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+        self._windows = {}  # access token: [window, calls in that window]
+
+        self._server = ThreadingHTTPServer((host, port),
+                                           self._make_handler())
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return "http://{host}:{port}".format(host=host, port=port)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def serve_forever(self):
+        """Serve from the calling thread, until interrupted."""
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+
+    def handle_get(self, path, headers):
+        """Answer a GET request, returning the status code, headers and
+        JSON body to send, or None to close the connection without answer.
+        """
+        delay, fault = self._draw_latency_and_fault(path)
+        if delay:
+            self.sleep(delay)
+
+        # A slow answer comes too late for the client anyway.
+        if fault == "slow":
+            time.sleep(self.slow_seconds)
+
+        with self._lock:
+            self.stats["requests"] += 1
+
+            if fault is not None:
+                self.stats["errors"] += 1
+                if fault in ("reset", "slow"):
+                    return None
+                return fault, {}, _error_body(_error_type(fault))
+
+            if not self._authorized(headers.get("Authorization", "")):
+                self.stats["unauthorized"] += 1
+                return 401, {}, _error_body("expired_token")
+
+            status, rate_headers = self._count_call(
+                                        headers.get("Authorization", ""))
+            if status == 429:
+                self.stats["rate_limited"] += 1
+                rate_headers["Retry-After"] = rate_headers[
+                                                    "Fitbit-Rate-Limit-Reset"]
+                return 429, rate_headers, _error_body("system")
+
+        try:
+            payload = emulator_payloads.api_payload(path, self.member_since)
+        except ValueError:  # unreadable dates
+            payload = None
+
+        with self._lock:
+            if payload is None:
+                self.stats["not_found"] += 1
+                return 404, rate_headers, _error_body("not_found")
+
+            self.stats["success"] += 1
+            self.paths.append(path)
+            return 200, rate_headers, payload
+
+    def handle_token_refresh(self, form):
+        """Answer a token refresh request, with its form data."""
+        with self._lock:
+            grant_type = form.get("grant_type", [None])[0]
+            refresh_token = form.get("refresh_token", [None])[0]
+
+            if grant_type != "refresh_token" or (
+                    self.refresh_token is not None
+                    and refresh_token != self.refresh_token):
+                return 400, {}, _error_body("invalid_grant")
+
+            self.stats["token_refresh"] += 1
+            self.access_token = uuid.uuid4().hex
+            self.refresh_token = uuid.uuid4().hex
+            self.access_token_expires_at = self.clock() + self.token_lifetime
+
+            return 200, {}, {"access_token": self.access_token,
+                             "refresh_token": self.refresh_token,
+                             "expires_in": self.token_lifetime,
+                             "token_type": "Bearer",
+                             "user_id": "EMULATED"}
+
+    def _authorized(self, authorization):
+        if self.access_token is None:
+            return True
+
+        if authorization != "Bearer " + self.access_token:
+            return False
+
+        return (self.access_token_expires_at is None
+                or self.clock() < self.access_token_expires_at)
+
+    def _draw_latency_and_fault(self, path):
+        """Draw the latency of a call, and its fault if it is to fail: the
+        next fault given for the path if any, or a random one.
+        """
+        with self._lock:
+            delay = self.latency
+            if self.latency_jitter:
+                delay += self._random.uniform(0, self.latency_jitter)
+
+            fault = None
+            for key, faults in self.faults.items():
+                if key in path and faults:
+                    fault = faults.pop(0)
+                    break
+
+            if fault is None and self.error_rate \
+                    and self._random.random() < self.error_rate:
+                fault = self._random.choice([500, 502, 503, "reset"])
+
+        return delay, fault
+
+    def _count_call(self, authorization):
+        """Count a call of the access token in its current rate limit window,
+        returning the status code and rate limit headers to answer with.
+        Called with the lock held.
+        """
+        now = self.clock()
+        window = int(now // self.window_seconds)
+
+        counts = self._windows.setdefault(authorization, [window, 0])
+        if counts[0] != window:
+            counts[:] = [window, 0]
+
+        seconds_to_reset = int((window + 1) * self.window_seconds - now)
+
+        status = 429
+        if counts[1] < self.limit:
+            counts[1] += 1
+            status = 200
+
+        headers = {
+            "Fitbit-Rate-Limit-Limit": str(self.limit),
+            "Fitbit-Rate-Limit-Remaining": str(self.limit - counts[1]),
+            "Fitbit-Rate-Limit-Reset": str(seconds_to_reset)
+        }
+        return status, headers
+
+    def _make_handler(self):
+        emulator = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            # keep connections alive between requests, without delaying
+            # small writes on them
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                with emulator._lock:
+                    emulator.client_ports.add(self.client_address[1])
+
+                answer = emulator.handle_get(self.path, self.headers)
+                if answer is None:
+                    self.close_connection = True
+                    return
+
+                self._send(*answer)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                form = parse_qs(self.rfile.read(length).decode())
+
+                if self.path.split("?")[0] != "/oauth2/token":
+                    self._send(404, {}, _error_body("not_found"))
+                    return
+
+                self._send(*emulator.handle_token_refresh(form))
+
+            def _send(self, status, headers, payload):
+                body = json.dumps(payload, separators=(",", ":")).encode()
+
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def _error_type(status):
+    """The errorType of the Fitbit web API for an error status."""
+    return {400: "validation", 401: "expired_token", 403: "insufficient_scope",
+            404: "not_found", 429: "system"}.get(status, "server_error")
+
+
+def _error_body(error_type):
+    """An error payload, in the format of the Fitbit web API."""
+    return {"errors": [{"errorType": error_type, "message": error_type}],
+            "success": False}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("-p", "--port", type=int, default=8080)
+    parser.add_argument("--limit", type=int, default=150,
+                        help="calls allowed per rate limit window")
+    parser.add_argument("--window_seconds", type=int, default=3600,
+                        help="length of the rate limit window")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="seconds each call takes")
+    parser.add_argument("--latency_jitter", type=float, default=0,
+                        help="random seconds added to each call's latency")
+    parser.add_argument("--error_rate", type=float, default=0,
+                        help="share of calls failing (5xx or reset)")
+    parser.add_argument("--token_lifetime", type=int, default=28800,
+                        help="seconds before access tokens expire")
+    parser.add_argument("--member_since", default="2020-01-01",
+                        help="user start date served with the profile")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of the latency and error draws")
+    args = parser.parse_args()
+
+    emulator = FitbitEmulator(**vars(args))
+    print("Emulating the Fitbit web API on {}".format(emulator.url))
+    emulator.serve_forever()
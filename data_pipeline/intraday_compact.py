@@ -0,0 +1,150 @@
+"""
+Compact storage of the intraday tables, as (day_id, second_of_day, value)
+rows with the date stored once per day in the intraday_day table, in place
+of full date and time DateTime columns on every sample.
+
+Day ids are days since 1970-01-01, so that they can be computed from dates
+without any lookup. Compatibility views expose the compact tables under the
+column names of the original tables.
+"""
+from sqlalchemy import text
+import db_diff
+import db_tables
+import db_upsert
+import numpy as np
+import pandas as pd
+
+
+# Compact counterpart of each intraday table, by ORM table name, with the
+# columns of values they store.
+COMPACT_TABLES = {
+    "ActivitiesStepsIntraday": (db_tables.ActivitiesStepsIntradayCompact,
+                                ["num_steps"]),
+    "HeartRateIntraday": (db_tables.HeartRateIntradayCompact,
+                          ["bpm"]),
+    "SleepIntraday": (db_tables.SleepIntradayCompact,
+                      ["duration_seconds", "sleep_stage"])
+}
+
+
+def day_ids(dates):
+    """Return the days since 1970-01-01 of an array of dates."""
+    days = np.asarray(dates, dtype="datetime64[ns]").astype("datetime64[D]")
+    return days.astype(np.int64)
+
+
+def to_compact(dataframe, value_columns):
+    """Turn a parsed intraday dataframe (date column, indexed by time) into
+    its compact format, indexed by (day_id, second_of_day).
+    """
+    dates = dataframe["date"].values.astype("datetime64[D]")
+    seconds = (dataframe.index.values.astype("datetime64[s]")
+               - dates.astype("datetime64[s]")).astype(np.int64)
+
+    columns = {"day_id": dates.astype(np.int64), "second_of_day": seconds}
+    for column in value_columns:
+        columns[column] = dataframe[column].values
+
+    return pd.DataFrame(columns).set_index(["day_id", "second_of_day"])
+
+
+def from_compact(dataframe, value_columns):
+    """Inverse of to_compact: turn a compact dataframe, indexed by (day_id,
+    second_of_day), back into the parsed intraday format.
+    """
+    day_id = dataframe.index.get_level_values("day_id").values
+    second = dataframe.index.get_level_values("second_of_day").values
+
+    dates = day_id.astype("datetime64[D]").astype("datetime64[ns]")
+    times = dates + second.astype("timedelta64[s]")
+
+    columns = {"date": dates}
+    for column in value_columns:
+        columns[column] = dataframe[column].values
+
+    return pd.DataFrame(columns, index=pd.Index(times, name="time"))
+
+
+def upsert_compact(session, tablename, dataframe, user_id):
+    """Write a user's parsed intraday dataframe to the compact counterpart of
+    the table, adding its dates to the intraday_day table. Nothing is
+    committed here. Returns the counts of db_upsert.upsert_dataframe.
+    """
+    table, value_columns = COMPACT_TABLES[tablename]
+
+    compact = to_compact(dataframe, value_columns).assign(user_id=user_id)
+    upsert_days(session, dataframe["date"].unique())
+
+    return db_upsert.upsert_dataframe(session, table, compact)
+
+
+def write_compact_day(session, tablename, dataframe, user_id, date,
+                      batch_size=1000):
+    """Write a user's parsed intraday dataframe of a single day to the
+    compact counterpart of the table, as changes to the rows stored for that
+    day (see db_diff.py), deleting the day's rows if the dataframe is None or
+    empty. Nothing is committed here. Returns the counts of
+    db_diff.write_day.
+    """
+    table, value_columns = COMPACT_TABLES[tablename]
+    scope = {"user_id": user_id, "day_id": int(day_ids([date])[0])}
+
+    if dataframe is None or dataframe.empty:
+        return db_diff.write_day(session, table, None, scope, date,
+                                 batch_size)
+
+    compact = to_compact(dataframe, value_columns).assign(user_id=user_id)
+    upsert_days(session, [date])
+
+    return db_diff.write_day(session, table, compact, scope, date,
+                             batch_size)
+
+
+def upsert_days(session, dates):
+    """Add the dates missing from the intraday_day table."""
+    dates = pd.to_datetime(dates).normalize().unique()
+    days = pd.DataFrame({"date": dates},
+                        index=pd.Index(day_ids(dates), name="id"))
+
+    db_upsert.upsert_dataframe(session, db_tables.IntradayDay, days)
+
+
+def create_compatibility_views(engine):
+    """Create (or replace) a view over each compact table, exposing it with
+    the user_id, date, time and value columns of the original table, as
+    <original table name>_compat.
+    """
+    dialect = engine.dialect.name
+
+    with engine.begin() as connection:
+        for tablename, (table, value_columns) in COMPACT_TABLES.items():
+            original = getattr(db_tables, tablename).__tablename__
+            view = original + "_compat"
+
+            connection.execute(text("DROP VIEW IF EXISTS " + view))
+            connection.execute(text(_view_statement(
+                        dialect, view, table.__tablename__, value_columns)))
+
+
+def _view_statement(dialect, view, compact_tablename, value_columns):
+    """Build the CREATE VIEW statement of a compatibility view, in the
+    syntax of the database dialect.
+    """
+    if dialect == "mysql":
+        time = "TIMESTAMPADD(SECOND, c.second_of_day, d.date)"
+    elif dialect == "sqlite":
+        time = "datetime(d.date, c.second_of_day || ' seconds')"
+    elif dialect == "postgresql":
+        time = "d.date + c.second_of_day * INTERVAL '1 second'"
+    else:
+        raise Exception(
+            "Compatibility views are not supported for dialect {}.".format(
+                                                                    dialect))
+
+    values = ", ".join("c." + column for column in value_columns)
+
+    return ("CREATE VIEW {view} AS "
+            "SELECT c.user_id AS user_id, d.date AS date, {time} AS time, "
+            "{values} "
+            "FROM {table} c JOIN intraday_day d ON d.id = c.day_id").format(
+                view=view, time=time, values=values, table=compact_tablename)
@@ -0,0 +1,132 @@
+"""
+Decoding of Fitbit API payloads, using orjson when installed and the standard
+json module otherwise.
+
+Intraday heart rate and steps datasets are extracted straight into columns,
+without building the list of one dict per minute which the JSON decoders
+would give. The parsers accept either form.
+"""
+import json
+import numpy as np
+
+try:  # optional fast decoder
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Keys of the intraday datasets extracted into columns.
+COLUMNAR_DATASET_KEYS = ["activities-heart-intraday",
+                         "activities-steps-intraday"]
+
+
+class ColumnarDataset:
+    """An intraday dataset held as columns: a "time" list of "hh:mm:ss"
+    strings and an int64 "value" array, in place of a list of
+    {"time", "value"} dicts.
+    """
+
+    def __init__(self, times, values):
+        self.columns = {"time": times, "value": values}
+
+    def __len__(self):
+        return len(self.columns["time"])
+
+    def __eq__(self, other):
+        """Equal to datasets with the same points, in either format."""
+        if isinstance(other, ColumnarDataset):
+            other = other.to_records()
+        return self.to_records() == other
+
+    def get(self, key):
+        """Return the column under key, or None if there is none."""
+        return self.columns.get(key)
+
+    def to_records(self):
+        """Return the dataset in the format served by the API."""
+        return [{"time": time, "value": int(value)}
+                for time, value in zip(self.columns["time"],
+                                       self.columns["value"])]
+
+
+def loads(content):
+    """Decode a JSON document (bytes or str) with the fastest decoder
+    available.
+    """
+    if orjson is not None:
+        return orjson.loads(content)
+
+    return json.loads(content)
+
+
+def decode(content):
+    """Decode an API payload, extracting its intraday heart rate or steps
+    dataset into a ColumnarDataset when it has one.
+    """
+    if isinstance(content, str):
+        content = content.encode()
+
+    for key in COLUMNAR_DATASET_KEYS:
+        marker = b'"' + key.encode() + b'"'
+        if marker in content:
+            payload = _decode_with_columnar_dataset(content, marker, key)
+            if payload is not None:
+                return payload
+
+    return loads(content)
+
+
+def default(obj):
+    """Encoder hook turning columnar datasets back into API format, for use
+    as json.dumps(payload, default=default).
+    """
+    if isinstance(obj, ColumnarDataset):
+        return obj.to_records()
+
+    raise TypeError("Object of type {} is not JSON serializable".format(
+                                                        type(obj).__name__))
+
+
+def _decode_with_columnar_dataset(content, marker, key):
+    """Decode the payload with the dataset under key extracted into columns.
+    Return None if the dataset isn't in the expected format, to fall back on
+    a plain decode.
+    """
+    start = content.find(b'"dataset":[', content.find(marker))
+    if start == -1:
+        return None
+
+    start += len(b'"dataset":[')
+    end = content.find(b"]", start)  # data points hold no brackets
+    if end == -1:
+        return None
+
+    # Data points are served as {"time":"hh:mm:ss","value":n}. Stripping
+    # their keys and braces leaves a flat array of alternating times and
+    # values, which decodes without building a dict per point.
+    dataset = content[start:end]
+    flat = (dataset.replace(b'{"time":', b"")
+                   .replace(b',"value":', b",")
+                   .replace(b"}", b""))
+    try:
+        flat = loads(b"[" + flat + b"]")
+    except ValueError:  # points in another format
+        return None
+
+    times, values = flat[0::2], np.array(flat[1::2])
+    if len(times) != dataset.count(b"{") or len(times) != len(values):
+        return None
+
+    if len(values) and values.dtype.kind != "i":  # values must be ints
+        return None
+
+    columns = ColumnarDataset(times, values.astype(np.int64, copy=False))
+
+    # Decode the rest of the payload, with an empty dataset in place.
+    payload = loads(content[:start] + content[end:])
+    try:
+        payload[key]["dataset"] = columns
+    except (KeyError, TypeError):
+        return None
+
+    return payload
@@ -0,0 +1,40 @@
+"""
+Bound on the memory held by parsed dataframes waiting to be written, so that
+fetching and parsing can't run arbitrarily far ahead of the database writes,
+e.g. in backfills of several years of data.
+"""
+import threading
+
+
+class MemoryBudget:
+    """Bytes of parsed dataframes allowed in flight between parsing and
+    writing. acquire() blocks while they would go over max_bytes, unless
+    nothing is held, so that a single day larger than the budget still goes
+    through. A single instance can be shared across threads, e.g. by the
+    Loaders of all users.
+    """
+
+    def __init__(self, max_bytes=256 * 2**20):
+        self.max_bytes = max_bytes
+        self.held = 0
+        self.peak = 0  # most bytes held at once
+        self._condition = threading.Condition()
+
+    def acquire(self, num_bytes):
+        with self._condition:
+            while self.held and self.held + num_bytes > self.max_bytes:
+                self._condition.wait()
+
+            self.held += num_bytes
+            self.peak = max(self.peak, self.held)
+
+    def release(self, num_bytes):
+        with self._condition:
+            self.held -= num_bytes
+            self._condition.notify_all()
+
+
+def frames_bytes(df_dict):
+    """Bytes held by a day's parsed dataframes, by table name."""
+    return sum(int(df.memory_usage(index=True, deep=True).sum())
+               for df in df_dict.values() if df is not None)
@@ -0,0 +1,276 @@
+"""
+Pipeline metrics: counters and latency histograms around the hot paths
+(API calls, rate limiting, parsing, database writes), to tell where the time
+of a run went.
+
+Metrics are kept in a process wide registry, and exposed as Prometheus text
+(served over HTTP by serve()) or as a JSON file. Each run also adds a row of
+totals to the pipeline_runs table, see run_summary().
+"""
+from db_tables import PipelineRun
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from sqlalchemy.orm import sessionmaker
+import contextlib
+import datetime
+import json
+import os
+import threading
+import time
+
+
+# Upper bounds of the latency histogram buckets, in seconds.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60, float("inf"))
+
+
+class Histogram:
+    """Counts of observations per bucket, with their sum and count."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self):
+        """Counts of observations up to each bucket bound, as in Prometheus."""
+        counts, total = [], 0
+        for count in self.counts:
+            total += count
+            counts.append(total)
+        return counts
+
+
+class Registry:
+    """Counters and histograms, by name and labels. A single instance can be
+    shared across threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}    # (name, labels): value
+        self.histograms = {}  # (name, labels): Histogram
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """Observe the seconds spent in the with block, errors included."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def totals(self):
+        """Return the value of each counter, and the sum and count of each
+        histogram (as name_sum and name_count), summed over their labels.
+        """
+        totals = {}
+        with self._lock:
+            for (name, _), value in self.counters.items():
+                totals[name] = totals.get(name, 0) + value
+
+            for (name, _), histogram in self.histograms.items():
+                for suffix, value in [("_sum", histogram.sum),
+                                      ("_count", histogram.count)]:
+                    totals[name + suffix] = totals.get(name + suffix, 0) \
+                                            + value
+        return totals
+
+    def to_prometheus(self):
+        """Render all metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append("# TYPE {} counter".format(name))
+                for (key_name, labels), value in sorted(
+                                                    self.counters.items()):
+                    if key_name == name:
+                        lines.append("{}{} {}".format(
+                                        name, _format_labels(labels), value))
+
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append("# TYPE {} histogram".format(name))
+                for (key_name, labels), histogram in sorted(
+                            self.histograms.items(), key=lambda item: item[0]):
+                    if key_name != name:
+                        continue
+
+                    for bound, count in zip(histogram.buckets,
+                                            histogram.cumulative_counts()):
+                        le = "+Inf" if bound == float("inf") else str(bound)
+                        lines.append("{}_bucket{} {}".format(
+                            name, _format_labels(labels + (("le", le),)),
+                            count))
+
+                    lines.append("{}_sum{} {}".format(
+                                name, _format_labels(labels), histogram.sum))
+                    lines.append("{}_count{} {}".format(
+                                name, _format_labels(labels), histogram.count))
+
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self):
+        """All metrics as a JSON serializable dict."""
+        with self._lock:
+            counters = [{"name": name, "labels": dict(labels), "value": value}
+                        for (name, labels), value in self.counters.items()]
+
+            histograms = [{"name": name, "labels": dict(labels),
+                           "buckets": [str(bound) for bound in h.buckets],
+                           "counts": h.cumulative_counts(),
+                           "sum": h.sum, "count": h.count}
+                          for (name, labels), h in self.histograms.items()]
+
+        return {"counters": counters, "histograms": histograms}
+
+    def write_json(self, path):
+        """Write all metrics to a JSON file, replacing it in one move so that
+        readers never see a partial file.
+        """
+        metrics = self.to_dict()
+        metrics["updated_at"] = datetime.datetime.now().isoformat()
+
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(metrics, f, indent=2)
+        os.replace(temp_path, path)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+
+    return "{" + ",".join('{}="{}"'.format(key, value)
+                          for key, value in labels) + "}"
+
+
+# The registry of the process, and shortcuts to it.
+REGISTRY = Registry()
+
+
+def inc(name, value=1, **labels):
+    REGISTRY.inc(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    REGISTRY.observe(name, value, **labels)
+
+
+def timer(name, **labels):
+    return REGISTRY.timer(name, **labels)
+
+
+def serve(port, registry=REGISTRY, host="127.0.0.1"):
+    """Serve the metrics as Prometheus text on any GET path of the port,
+    from a background thread. Only local clients can connect by default:
+    pass host="" to listen on all interfaces, e.g. for a remote Prometheus.
+    Return the HTTP server, to shutdown() it.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            body = registry.to_prometheus().encode()
+
+            self.send_response(200)
+            self.send_header("Content-Type",
+                             "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# Columns of the pipeline_runs table, and the totals they are taken from.
+RUN_SUMMARY_COLUMNS = {
+    "api_calls": ["api_requests_total"],
+    "api_bytes": ["api_response_bytes_total"],
+    "rows_written": ["rows_written_total"],
+    "rows_inserted": ["rows_inserted_total"],
+    "rows_updated": ["rows_updated_total"],
+    "rows_deleted": ["rows_deleted_total"],
+    "rows_unchanged": ["rows_unchanged_total"],
+    "failed_jobs": ["failed_jobs_total"],
+    "http_seconds": ["api_request_seconds_sum"],
+    "rate_limit_sleep_seconds": ["rate_limit_sleep_seconds_total"],
+    "retry_sleep_seconds": ["retry_sleep_seconds_total"],
+    "parse_seconds": ["parse_seconds_sum"],
+    "db_seconds": ["sink_write_seconds_sum", "db_commit_seconds_sum",
+                   "update_range_seconds_sum"]
+}
+
+
+@contextlib.contextmanager
+def run_summary(session, run_type, metrics_file=None, user_id=None,
+                registry=REGISTRY):
+    """Add a row to the pipeline_runs table with the metric totals of the
+    run in the with block, and its error if it failed. The metrics are also
+    written to metrics_file, if given. Runs of a single user are marked with
+    their user_id.
+    """
+    started_at = datetime.datetime.now()
+    start = time.perf_counter()
+    before = registry.totals()
+    error = None
+
+    try:
+        yield
+
+    except Exception as e:
+        error = repr(e)[:500]
+        raise
+
+    finally:
+        after = registry.totals()
+        row = PipelineRun(run_type=run_type, user_id=user_id,
+                          started_at=started_at,
+                          duration_seconds=time.perf_counter() - start,
+                          error=error)
+
+        for column, names in RUN_SUMMARY_COLUMNS.items():
+            value = sum(after.get(name, 0) - before.get(name, 0)
+                        for name in names)
+            setattr(row, column, value)
+
+        # A session of its own, whatever the state of the run's session.
+        summary_session = sessionmaker(bind=session.get_bind())()
+        try:
+            summary_session.add(row)
+            summary_session.commit()
+        finally:
+            summary_session.close()
+
+        if metrics_file is not None:
+            registry.write_json(metrics_file)
@@ -0,0 +1,530 @@
+"""
+Declarative schemas of the tables parsed from Fitbit API responses, and the
+single routine building any table's dataframe from its schema.
+
+Each schema lists where the table's records sit in the response, and for
+each column the key of its raw values in a record, its dtype and an optional
+transform. parse_table then builds each column in one pass over the records,
+straight into a numpy array of the target dtype, and assembles the dataframe
+from these arrays at once.
+"""
+from json_decoder import ColumnarDataset
+import logging
+import numpy as np
+import pandas as pd
+
+
+# We store the sleep stage as an int rather than a str, for memory reasons.
+SLEEP_STAGE_ID = {
+    "deep": 1,          # normal expected data
+    "light": 2,         #
+    "rem": 3,           #
+    "wake": 4,          #
+    "asleep": 5,        # default values served
+    "restless": 6,      #
+    "awake": 7          #
+}
+
+
+class Field:
+    """A column of a parsed table.
+
+    source:    key of the column's raw values in each record, as a dotted path
+               for nested dicts (e.g. "stages.deep"), a list of such keys when
+               the transform combines several, or None for a column which
+               only depends on the date of the response.
+    dtype:     "int64", "float64", "bool", "str" or "datetime64[ns]".
+    transform: optional function of the raw values (one list per source)
+               and the response date, returning the column's values.
+    """
+
+    def __init__(self, name, dtype, source=None, transform=None):
+        self.name = name
+        self.dtype = dtype
+        self.transform = transform
+
+        if source is None:
+            self.sources = []
+        elif isinstance(source, str):
+            self.sources = [source]
+        else:
+            self.sources = list(source)
+
+        # Compile each source path into a function collecting its values.
+        self._getters = [_compile_getter(path) for path in self.sources]
+
+    def raw_values(self, records):
+        return [getter(records) for getter in self._getters]
+
+
+class BadResponseFormat(Exception):
+    """Raised when a response isn't shaped as its endpoint serves them, e.g.
+    not a decoded JSON payload: the day mustn't be taken as empty.
+    """
+
+
+class TableSchema:
+    """How to parse one database table out of an API response.
+
+    records: function returning the list of records (dicts) of the table in
+             the response, one per row, or a ColumnarDataset. May raise
+             KeyError or TypeError when the response isn't in the expected
+             format.
+    index:   Field of the table's primary key, passed as index.
+    fields:  Fields of the other columns, in the table's order.
+    sort_by: optional column names to sort rows by. Rows with a duplicate
+             index are then dropped, keeping the last one.
+    """
+
+    def __init__(self, name, records, index, fields, sort_by=None):
+        self.name = name
+        self.records = records
+        self.index = index
+        self.fields = fields
+        self.sort_by = sort_by
+
+
+def parse_table(schema, response, date):
+    """Build the schema's table from a response served for that date, as a
+    dataframe indexed by the primary key. Return None if the response holds
+    no record for the table, e.g. lacks its key. Raises BadResponseFormat if
+    the response can't be read at all.
+    """
+    try:
+        records = schema.records(response)
+
+    except KeyError as e:
+        logging.warning("No {table} records on {date}: missing {e!r}"
+                        .format(table=schema.name, date=date, e=e))
+        return None
+
+    except (TypeError, AttributeError) as e:
+        raise BadResponseFormat("Bad response format for {table} on {date}: "
+                                "{e!r}".format(table=schema.name, date=date,
+                                               e=e)) from e
+
+    if not records:
+        return None
+
+    num_rows = len(records)
+    columns = {}
+    for field in [schema.index] + schema.fields:
+        columns[field.name] = _build_column(schema, field, records, date,
+                                            num_rows)
+
+    if schema.sort_by:
+        columns = _sort_and_drop_duplicates(columns, schema.sort_by,
+                                            schema.index.name)
+
+    index = pd.Index(columns.pop(schema.index.name), name=schema.index.name)
+    return pd.DataFrame(columns, index=index, copy=False)
+
+
+def _build_column(schema, field, records, date, num_rows):
+    """Build the field's column as a numpy array of num_rows values. Columns
+    whose source is missing from all records are null; columns which fail
+    conversion are null too, and the failure is logged.
+    """
+    raw_values = field.raw_values(records)
+
+    # Source missing from all records: a column of nulls.
+    if raw_values and all(_all_none(values) for values in raw_values):
+        return np.full(num_rows, None, dtype=object)
+
+    try:
+        if field.transform is not None:
+            values = field.transform(*raw_values, date)
+        else:
+            values = raw_values[0]
+
+        return _to_array(values, field.dtype, num_rows)
+
+    except (KeyError, TypeError, ValueError) as e:
+        logging.warning("Could not parse {table}.{column} on {date}: {e!r}"
+                        .format(table=schema.name, column=field.name,
+                                date=date, e=e))
+        return np.full(num_rows, None, dtype=object)
+
+
+def _to_array(values, dtype, num_rows):
+    """Convert values to a numpy array of the given dtype, keeping missing
+    values as null: nan for numbers (hence a float64 column for ints with
+    missing values), NaT for datetimes and None otherwise.
+    """
+    # A single value (e.g. the response date) fills the whole column.
+    if np.ndim(values) == 0:
+        if dtype.startswith("datetime64"):
+            values = pd.Timestamp(values).to_datetime64()
+        return np.full(num_rows, values, dtype=dtype)
+
+    if dtype == "str":
+        array = np.empty(num_rows, dtype=object)
+        array[:] = values
+        return array
+
+    if dtype.startswith("datetime64"):
+        return np.asarray(values, dtype=dtype)
+
+    if isinstance(values, list) and None in values:
+        if dtype in ("int64", "float64"):
+            return np.array(values, dtype="float64")
+
+        array = np.empty(num_rows, dtype=object)
+        array[:] = values
+        return array
+
+    array = np.asarray(values)
+
+    # Ints computed as floats keep their nan, if any, as a float64 column.
+    if dtype == "int64" and array.dtype.kind == "f":
+        if np.isnan(array).any():
+            return array
+        return array.astype("int64")
+
+    return array.astype(dtype, copy=False)
+
+
+def _sort_and_drop_duplicates(columns, sort_by, index_name):
+    """Sort all columns by the given column names (a stable sort), then drop
+    the rows with a duplicate index, keeping the last one.
+    """
+    order = np.lexsort([columns[name] for name in reversed(sort_by)])
+    columns = {name: values[order] for name, values in columns.items()}
+
+    index = columns[index_name]
+    keep = np.ones(len(index), dtype=bool)
+    keep[:-1] = index[1:] != index[:-1]
+
+    return {name: values[keep] for name, values in columns.items()}
+
+
+def _compile_getter(path):
+    """Return a function collecting the values under a (dotted) key path in
+    a list of records, with None where the key is missing. The values of a
+    ColumnarDataset are its column under that key.
+    """
+    keys = path.split(".")
+
+    if len(keys) == 1:
+        key = keys[0]
+
+        def get_values(records):
+            if isinstance(records, ColumnarDataset):
+                column = records.get(key)
+                return [None] * len(records) if column is None else column
+
+            return [record.get(key) for record in records]
+
+    else:
+        def get_values(records):
+            values = []
+            for record in records:
+                for key in keys:
+                    record = record.get(key) if isinstance(record,
+                                                           dict) else None
+                values.append(record)
+            return values
+
+    return get_values
+
+
+def _all_none(values):
+    if isinstance(values, np.ndarray):  # columns hold no None
+        return False
+    return all(value is None for value in values)
+
+
+# ----------------------------- TRANSFORMS ------------------------------------
+def response_date(date):
+    """Stamp each row with the date of the response."""
+    return date
+
+
+def time_of_day_to_datetime(times, date):
+    """Turn "hh:mm:ss" strings into datetimes on the response date. Parsed
+    as fixed width digits in a single numpy pass when well formed.
+    """
+    day = pd.Timestamp(date).to_datetime64().astype("datetime64[s]")
+
+    try:
+        chars = "".join(times).encode("ascii")
+    except (TypeError, UnicodeEncodeError):
+        chars = b""
+
+    chars = np.frombuffer(chars, dtype=np.uint8)
+    chars = chars.reshape(-1, 8) if len(chars) == 8 * len(times) else None
+
+    # uint8 digits, where characters below "0" wrap around above 9
+    digits = chars - np.uint8(ord("0")) if chars is not None else None
+    well_formed = (digits is not None
+                   and (chars[:, [2, 5]] == ord(":")).all()
+                   and (digits[:, [0, 1, 3, 4, 6, 7]] <= 9).all())
+
+    if not well_formed:  # let pandas parse (or reject) what it can
+        date_string = pd.Timestamp(date).strftime("%Y-%m-%d")
+        return pd.to_datetime([date_string + " " + t for t in times]).values
+
+    hours = digits[:, 0] * 10 + digits[:, 1].astype(np.int64)
+    minutes = digits[:, 3] * 10 + digits[:, 4].astype(np.int64)
+    seconds = digits[:, 6] * 10 + digits[:, 7].astype(np.int64)
+    seconds += hours * 3600 + minutes * 60
+
+    return (day + seconds.astype("timedelta64[s]")).astype("datetime64[ns]")
+
+
+def iso_to_datetime(timestamps, date):
+    """Turn ISO 8601 strings into datetimes, e.g. "2021-07-24T05:29:00.000"."""
+    try:
+        return np.array(timestamps, dtype="datetime64[ms]")
+    except ValueError:
+        return pd.to_datetime(timestamps).values
+
+
+def start_datetime(start_dates, start_times, date):
+    """Combine "yyyy-mm-dd" dates and "hh:mm" times into datetimes."""
+    return pd.to_datetime([d + " " + t
+                           for d, t in zip(start_dates, start_times)]).values
+
+
+def milliseconds_to_minutes(durations, date):
+    return np.array(durations, dtype="float64") / 60000
+
+
+def end_datetime(start_dates, start_times, durations, date):
+    """Start datetime plus the duration, truncated to whole minutes."""
+    start = start_datetime(start_dates, start_times, date)
+    minutes = milliseconds_to_minutes(durations, date).astype("int64")
+    return start + minutes.astype("timedelta64[m]")
+
+
+def sleep_stage_id(levels, date):
+    return [SLEEP_STAGE_ID.get(level) for level in levels]
+
+
+# ------------------------------ RECORDS --------------------------------------
+def activities_records(response):
+    return response["activities"]
+
+
+def summary_records(response):
+    summary = response["summary"]
+    return [summary] if summary else []
+
+
+def intraday_records(key):
+    def records(response):
+        return response[key]["dataset"]
+    return records
+
+
+def list_records(key):
+    def records(response):
+        return response[key]
+    return records
+
+
+def spo2_records(response):
+    """The single day SpO2 response is the day's record itself, or empty."""
+    return [response] if response.get("value") else []
+
+
+def sleep_levels_records(response):
+    """Gather the intraday sleep data of all sleep records of the night.
+
+    Each record represents a "chunk" of sleep during the night, and we get
+    multiple records for nights with broken sleep. Each record's intraday
+    data comes in 3 types:
+
+      - Short cycles: Short "wake" periods (<= 180 sec).
+                      Listed under "shortData" key.
+
+      - Long cycles:  Light, deep, rem, wake periods (> 180 sec).
+                      Listed under "data" key.
+
+      - "Default values":
+                      Awake, restless, asleep.
+                      Served when a sleep period (dataset) is too
+                      short (~1 hour), or when sensor data quality
+                      is poor.
+                      Listed under "data" key.
+    """
+    levels_records = []
+    for sleep_record in response["sleep"]:
+        levels = sleep_record["levels"]
+
+        if "data" in levels:  # Long cycles and default values.
+            levels_records.extend(levels["data"])
+
+        if "shortData" in levels:  # Short cycles.
+            levels_records.extend(levels["shortData"])
+
+    return levels_records
+
+
+def sleep_summary_records(response):
+    """The night's summary, with the list of sleep interruption times added.
+
+    Nights without staged sleep data give no summary row.
+    """
+    summary = response["summary"]
+    if "stages" not in summary:
+        return []
+
+    # Sleep interruption times are the end times of each sleep record, but
+    # the last one (when I wake up), semicolon separated. If there are no
+    # sleep interruptions, a null value is recorded.
+    break_times = []
+    sleep_records = response.get("sleep", [])
+
+    if len(sleep_records) > 1:  # if sleep is broken
+        break_times = [record["endTime"] for record in sleep_records
+                       if "endTime" in record]
+
+    break_times.sort(key=lambda x: pd.to_datetime(x))
+    if break_times:
+        break_times.pop()
+
+    return [dict(summary, sleepBreakTimes=";".join(break_times) or None)]
+
+
+# ------------------------------ SCHEMAS --------------------------------------
+ACTIVITIES = TableSchema(
+    name="Activities",
+    records=activities_records,
+    index=Field("logId", "int64", "logId"),
+    fields=[
+        Field("activityId", "int64", "activityId"),
+        Field("activityParentId", "int64", "activityParentId"),
+        Field("activityParentName", "str", "activityParentName"),
+        Field("name", "str", "name"),
+        Field("description", "str", "description"),
+        Field("hasStartTime", "bool", "hasStartTime"),
+        Field("isFavorite", "bool", "isFavorite"),
+        Field("hasActiveZoneMinutes", "bool", "hasActiveZoneMinutes"),
+        Field("date", "datetime64[ns]", transform=response_date),
+        Field("startDateTime", "datetime64[ns]", ["startDate", "startTime"],
+              start_datetime),
+        Field("endDateTime", "datetime64[ns]",
+              ["startDate", "startTime", "duration"], end_datetime),
+        Field("durationMinutes", "int64", "duration", milliseconds_to_minutes),
+        Field("steps", "int64", "steps"),
+        Field("calories", "int64", "calories"),
+    ])
+
+ACTIVITIES_DAILY_SUMMARY = TableSchema(
+    name="ActivitiesDailySummary",
+    records=summary_records,
+    index=Field("date", "datetime64[ns]", transform=response_date),
+    fields=[Field(name, "int64", name) for name in [
+        "activeScore",
+        "activityCalories",
+        "caloriesBMR",
+        "caloriesOut",
+        "marginalCalories",
+        "sedentaryMinutes",
+        "lightlyActiveMinutes",
+        "fairlyActiveMinutes",
+        "veryActiveMinutes",
+        "restingHeartRate",
+        "steps"]
+    ])
+
+ACTIVITIES_STEPS_INTRADAY = TableSchema(
+    name="ActivitiesStepsIntraday",
+    records=intraday_records("activities-steps-intraday"),
+    index=Field("time", "datetime64[ns]", "time", time_of_day_to_datetime),
+    fields=[
+        Field("date", "datetime64[ns]", transform=response_date),
+        Field("num_steps", "int64", "value"),
+    ])
+
+HEART_RATE_INTRADAY = TableSchema(
+    name="HeartRateIntraday",
+    records=intraday_records("activities-heart-intraday"),
+    index=Field("time", "datetime64[ns]", "time", time_of_day_to_datetime),
+    fields=[
+        Field("date", "datetime64[ns]", transform=response_date),
+        Field("bpm", "int64", "value"),
+    ])
+
+SLEEP_INTRADAY = TableSchema(
+    name="SleepIntraday",
+    records=sleep_levels_records,
+    index=Field("time", "datetime64[ns]", "dateTime", iso_to_datetime),
+    fields=[
+        Field("date", "datetime64[ns]", transform=response_date),
+        Field("duration_seconds", "int64", "seconds"),
+        Field("sleep_stage", "int64", "level", sleep_stage_id),
+    ],
+    # Since we aggregate multiple sleep records into one, there may be
+    # overlaps coming from the short cycles, e.g.:
+    #   - time: 11:45:00 --> stage: 2, duration 1800
+    #   - time: 11:45:00 --> stage: 4, duration 30
+    # We keep a single sleep stage for each time, prioritising long cycles.
+    sort_by=["time", "duration_seconds"])
+
+SLEEP_DAILY_SUMMARY = TableSchema(
+    name="SleepDailySummary",
+    records=sleep_summary_records,
+    index=Field("date", "datetime64[ns]", transform=response_date),
+    fields=[
+        Field("totalMinutesAsleep", "int64", "totalMinutesAsleep"),
+        Field("totalTimeInBed", "int64", "totalTimeInBed"),
+        Field("deepMinutes", "int64", "stages.deep"),
+        Field("lightMinutes", "int64", "stages.light"),
+        Field("remMinutes", "int64", "stages.rem"),
+        Field("wakeMinutes", "int64", "stages.wake"),
+        Field("totalSleepRecords", "int64", "totalSleepRecords"),
+        Field("sleepBreakTimes", "str", "sleepBreakTimes"),
+    ])
+
+SPO2_DAILY_SUMMARY = TableSchema(
+    name="Spo2DailySummary",
+    records=spo2_records,
+    index=Field("date", "datetime64[ns]", transform=response_date),
+    fields=[
+        Field("spo2Avg", "float64", "value.avg"),
+        Field("spo2Min", "float64", "value.min"),
+        Field("spo2Max", "float64", "value.max"),
+    ])
+
+HEART_RATE_VARIABILITY = TableSchema(
+    name="HeartRateVariability",
+    records=list_records("hrv"),
+    index=Field("date", "datetime64[ns]", transform=response_date),
+    fields=[
+        Field("dailyRmssd", "float64", "value.dailyRmssd"),
+        Field("deepRmssd", "float64", "value.deepRmssd"),
+    ])
+
+BREATHING_RATE = TableSchema(
+    name="BreathingRate",
+    records=list_records("br"),
+    index=Field("date", "datetime64[ns]", transform=response_date),
+    fields=[
+        Field("breathingRate", "float64", "value.breathingRate"),
+    ])
+
+SKIN_TEMPERATURE = TableSchema(
+    name="SkinTemperature",
+    records=list_records("tempSkin"),
+    index=Field("date", "datetime64[ns]", transform=response_date),
+    fields=[
+        # Variation from the user's baseline, in degrees.
+        Field("nightlyRelative", "float64", "value.nightlyRelative"),
+        Field("logType", "str", "logType"),
+    ])
+
+WEIGHT = TableSchema(
+    name="Weight",
+    records=list_records("weight"),
+    index=Field("logId", "int64", "logId"),
+    fields=[
+        Field("date", "datetime64[ns]", transform=response_date),
+        Field("dateTime", "datetime64[ns]", ["date", "time"],
+              start_datetime),
+        Field("weight", "float64", "weight"),
+        Field("bmi", "float64", "bmi"),
+        Field("fat", "float64", "fat"),
+        Field("source", "str", "source"),
+    ])
@@ -1,40 +1,119 @@
 """
 Data pipeline classes.
 """
-from fitbit_api import Fitbit
-from sqlalchemy import func
-from sqlalchemy.inspection import inspect
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, wait
+from fitbit_api import AsyncFitbit, Fitbit, http_pool
+from memory_budget import MemoryBudget, frames_bytes
+from response_store import ResponseStore
+from scheduler import Scheduler
+from sinks import DatabaseSink, ParquetSink
 from sqlalchemy.orm import sessionmaker
-import contextlib
+import asyncio
+import backfill
+import collections
 import datetime
 import db_connection
 import db_tables
+import endpoints
 import logging
-import numpy as np
+import metrics
 import pandas as pd
+import parser_schemas
+import queue
 import requests
+import retry
+import sync_state
+import threading
 import time
 
 
+# Errors failing a single (endpoint, dates) job, which is then given up on
+# while the other jobs go on, along with the API's refusals (see fails_job).
+JOB_ERRORS = (retry.RetriesExhausted, retry.Stopped,
+              parser_schemas.BadResponseFormat)
+
+
+def fails_job(error):
+    """Whether a job's error only fails that job: e.g. a 403 for an OAuth
+    scope missing from the user's token fails their calls to that endpoint,
+    not to the others.
+    """
+    return isinstance(error, JOB_ERRORS) or retry.is_client_error(error)
+
+
 class Pipeline:
 
-    def __init__(self, seconds_between_calls=24, verbose=False):
+    def __init__(self, seconds_between_calls=0, workers=1, use_async=False,
+                 replay=False, compact_intraday=False, sinks=("database",),
+                 backfill=False, oldest_first=False, daemon=False,
+                 metrics_file=None, metrics_port=None,
+                 metrics_host="127.0.0.1", api_base_url=None, user_ids=None,
+                 user_workers=1, parse_processes=1, max_buffered_mb=256,
+                 endpoint_names=None, verbose=False):
         self.seconds_between_calls = seconds_between_calls
+        self.workers = workers
+        self.use_async = use_async
+        self.replay = replay
+        self.backfill = backfill          # resumable full history download
+        self.oldest_first = oldest_first  # backfill order
+        self.daemon = daemon  # keep running, updating endpoints on schedule
+        self.metrics_file = metrics_file  # JSON file of metrics, if any
+        self.metrics_port = metrics_port  # port serving metrics, if any
+        self.metrics_host = metrics_host  # interface it listens on
+        self.api_base_url = api_base_url  # e.g. of a local API emulator
+        self.user_workers = user_workers  # users synced at once
+        self.parse_processes = parse_processes  # parsers of stored responses
+        self.max_buffered_mb = max_buffered_mb  # parsed data waiting to write
+        self.endpoint_names = endpoint_names  # None for the default ones
+        self.compact_intraday = compact_intraday
+        self.sinks = sinks  # names of the sinks receiving parsed data
         self.verbose = verbose
-        self.engine = db_connection.create_engine()
+
+        # The asyncio mode only runs updates: the daemon and backfill modes
+        # go through the threaded Loader, which can't call AsyncFitbit.
+        if self.use_async and (self.daemon or self.backfill):
+            raise Exception("The asyncio mode can't be combined with the "
+                            "daemon or backfill modes.")
+
+        # A single pool of database connections for all users, sized for the
+        # users synced at once, each with a writer thread when workers > 1.
+        sessions_per_user = 2 if self.workers > 1 else 1
+        self.engine = db_connection.create_engine(
+                    pool_size=max(5, self.user_workers * sessions_per_user + 1))
 
         # Add session to handle talking to database.
-        Session = sessionmaker(bind=self.engine)
-        self.session = Session()
+        self.Session = sessionmaker(bind=self.engine)
+        self.session = self.Session()
+
+        # Sync every user with credentials, unless given some.
+        if user_ids is None:
+            user_ids = [row.id for row in self.session.query(
+                                        db_tables.FitbitCredentials.id)]
+            self.session.commit()
+        self.user_ids = user_ids
+
+        # A single pool of HTTP connections to the API for all users.
+        self.http = http_pool(
+                    max_connections=max(10, self.user_workers * self.workers))
 
-        # Add fitbit api wrapper instance.
-        self.fitbit = Fitbit(self.session,
-                             self.seconds_between_calls,
-                             self.verbose)
+        # Write parsed data to the database tables and/or to a Parquet
+        # archive under project_path/parquet.
+        sinks = []
+        if "database" in self.sinks:
+            sinks.append(DatabaseSink(self.compact_intraday))
+        if "parquet" in self.sinks:
+            sinks.append(ParquetSink("/absolute/path/to/project/folder/"
+                                     "/parquet"))
+
+        # A single bound on the parsed data waiting to be written, for all
+        # users.
+        self.memory_budget = MemoryBudget(self.max_buffered_mb * 2**20)
 
         # Pipeline components:
-        # - Loader fetches web API data;
-        self.loader = Loader(self.session, self.fitbit)
+        # - Loaders fetch web API data, one per user.
+        self.loaders = [self._make_loader(user_id, sinks)
+                        for user_id in self.user_ids]
 
         # Log info in a monthly txt file under project_path/logs.
         logfile = ("/absolute/path/to/project/folder/"
@@ -49,764 +128,915 @@ class Pipeline:
                             format='%(message)s'
                             )
 
+        # Serve metrics in Prometheus text format, e.g. for the daemon mode.
+        if self.metrics_port is not None:
+            metrics.serve(self.metrics_port, host=self.metrics_host)
+
+    def _make_loader(self, user_id, sinks):
+        """Build the Loader of a user, with a database session and a Fitbit
+        client of their own: the client has its own rate limiter, Fitbit
+        limiting calls per user, and shares the pipeline's HTTP pool.
+        """
+        session = self.Session()
+
+        # Add fitbit api wrapper instance, asyncio based if requested. The
+        # aiohttp pool of AsyncFitbit is opened per run, and not shared.
+        if self.use_async:
+            fitbit = AsyncFitbit(session, self.seconds_between_calls,
+                                 self.verbose, base_url=self.api_base_url,
+                                 user_id=user_id)
+        else:
+            fitbit = Fitbit(session, self.seconds_between_calls, self.verbose,
+                            base_url=self.api_base_url, user_id=user_id,
+                            http=self.http)
+
+        # Keep raw API responses under project_path/raw_responses, to rebuild
+        # tables from them without calling the API.
+        response_store = ResponseStore("/absolute/path/to/project/folder/"
+                                       "/raw_responses", user_id=user_id)
+
+        return Loader(session, fitbit, self.workers, response_store, sinks,
+                      retry.Retrier(verbose=self.verbose), user_id=user_id,
+                      parse_processes=self.parse_processes,
+                      memory_budget=self.memory_budget,
+                      endpoint_names=self.endpoint_names)
+
     def run(self):
         try:
-            self.loader.run()
-            self.transformer.run()
-
+            if self.daemon:
+                self.run_daemon()
+
+            # Add a row of metric totals to the pipeline_runs table.
+            elif self.replay:
+                with metrics.run_summary(self.session, "replay",
+                                         self.metrics_file):
+                    self._run_users(lambda loader: loader.replay())
+            elif self.backfill:
+                with metrics.run_summary(self.session, "backfill",
+                                         self.metrics_file):
+                    self._run_users(lambda loader: loader.backfill(
+                                        newest_first=not self.oldest_first,
+                                        verbose=self.verbose))
+            elif self.use_async:
+                with metrics.run_summary(self.session, "async",
+                                         self.metrics_file):
+                    self._run_users(lambda loader: loader.run_async())
+            else:
+                with metrics.run_summary(self.session, "update",
+                                         self.metrics_file):
+                    self._run_users(lambda loader: loader.run())
+
+        # Failed calls are retried by the Loader (see retry.py), one request
+        # at a time. Errors reaching here aren't worth retrying: log them, and
+        # leave the work left to the next run, which resumes from the sync
+        # watermarks.
         except requests.exceptions.RequestException as e:
             if self.verbose:
                 print(e)
-                print("Sleeping 5 minutes then trying again.")
 
             # Log time and exception raised.
             time_now = datetime.datetime.now().strftime("%H:%M:%S %h %d, %Y")
             logging.error(
                     "{time} - {error}".format(time=time_now, error=e))
 
-            # Sleep 5min then retry.
-            time.sleep(300)
-            self.run()
 
+    def _run_users(self, function):
+        """Call function with the Loader of each user, user_workers users at
+        a time. A user's errors are logged, and leave the others to go on.
+        """
+        def run_user(loader):
+            try:
+                function(loader)
 
-class Loader:
+            except Exception as e:
+                loader.session.rollback()
+
+                time_now = datetime.datetime.now().strftime(
+                                                        "%H:%M:%S %h %d, %Y")
+                logging.error("{time} - user {user_id} - {error}".format(
+                            time=time_now, user_id=loader.user_id, error=e))
+                if self.verbose:
+                    print(e)
+
+        if self.user_workers > 1:
+            with ThreadPoolExecutor(max_workers=self.user_workers) as executor:
+                list(executor.map(run_user, self.loaders))
+        else:
+            for loader in self.loaders:
+                run_user(loader)
+
+    def run_daemon(self):
+        """Keep updating each endpoint of each user on its schedule (see
+        scheduler.py) until SIGTERM or SIGINT, reusing this pipeline's
+        engine, sessions and Fitbit clients throughout.
+        """
+        Scheduler(self.loaders, verbose=self.verbose,
+                  metrics_file=self.metrics_file,
+                  workers=self.user_workers).run_forever()
 
-    def __init__(self, session, fitbit):
+        for loader in self.loaders:
+            loader.session.close()
+        self.session.close()
+        self.engine.dispose()
+
+
+class Loader:
+    """Fetch, parse and write the data of one user, the user_id of their
+    row of credentials, with the user's Fitbit client. Loaders of several
+    users can share a database engine, given sessions of their own.
+    """
+
+    def __init__(self, session, fitbit, workers=1, response_store=None,
+                 sinks=None, retrier=None, user_id=1, parse_processes=1,
+                 memory_budget=None, endpoint_names=None):
         self.session = session
         self.fitbit = fitbit
+        self.user_id = user_id
+        self.workers = workers  # number of fetching threads, 1 to disable
+        self.response_store = response_store  # raw responses cache, if any
+
+        # Number of processes parsing stored responses in replays (and in
+        # backfills, for the days stored), 1 to parse in this process.
+        self.parse_processes = parse_processes
+
+        # Bound on the parsed data waiting to be written, when fetching or
+        # parsing runs ahead of writing, see memory_budget.py.
+        if memory_budget is None:
+            memory_budget = MemoryBudget()
+        self.memory_budget = memory_budget
+
+        # Retries of failed API calls, see retry.py.
+        if retrier is None:
+            retrier = retry.Retrier()
+        self.retrier = retrier
+
+        # (endpoint name, dates) jobs given up on in the last run, if any.
+        self.failed_jobs = []
+
+        # Set by stop(), to leave the jobs not started yet, and to cut short
+        # the retry and rate limit waits of those in flight.
+        self._stop_event = threading.Event()
+        self.retrier.stop_event = self._stop_event
+        if getattr(fitbit, "rate_limiter", None) is not None:
+            fitbit.rate_limiter.stop_event = self._stop_event
+
+        # Sinks receiving the parsed dataframes, see sinks.py.
+        if sinks is None:
+            sinks = [DatabaseSink()]
+        self.sinks = sinks
         self.parser = ResponseParser()
 
-        # General config data to help load & update tables.
-        # Store API endpoint urls and which database tables 
-        # to insert the result into. 
-        self._api_to_database_pathway_data = {
-            "activities": {
-                "api_endpoint_url": ("https://api.fitbit.com/1/user/-/"
-                                     "activities/date/{date}.json"),
-                "db_tables": {
-                    "Activities": db_tables.Activities,
-                    "ActivitiesDailySummary": db_tables.ActivitiesDailySummary
-                    },
-            },
-            "steps": {
-                "api_endpoint_url": ("https://api.fitbit.com/1/user/-/"
-                                     "activities/steps/date/{date}/1d.json"),
-                "db_tables": {
-                   "ActivitiesStepsIntraday": db_tables.ActivitiesStepsIntraday
-                },
-            },
-            "heart_rate": {
-                "api_endpoint_url": ("https://api.fitbit.com/1/user/-/"
-                                     "activities/heart/date/{date}/1d.json"),
-                "db_tables": {
-                    "HeartRateIntraday": db_tables.HeartRateIntraday
-                },
-            },
-            "sleep": {
-                "api_endpoint_url": ("https://api.fitbit.com/1.2/user/-/"
-                                     "sleep/date/{date}.json"),
-                "db_tables": {
-                    "SleepDailySummary": db_tables.SleepDailySummary,
-                    "SleepIntraday": db_tables.SleepIntraday
-                },
-            },
-        }
+        # API endpoints synced, by name, see endpoints.py.
+        self.endpoints = endpoints.get_endpoints(endpoint_names)
+
+    def run(self, endpoint_names=None):
+
+        # Fetch updated data from each endpoint synced, or from the given
+        # ones only, among those synced (e.g. when scheduled for all users).
+        if endpoint_names is not None:
+            endpoint_names = [name for name in endpoint_names
+                              if name in self.endpoints]
+
+        self.run_jobs(self._get_update_jobs(endpoint_names))
+
+    def stop(self):
+        """Stop the current run (from another thread, or a signal handler)
+        once the jobs in flight are written, or left if waiting on a retry or
+        the rate limit. Each day being committed on its own, the days left
+        are fetched by the next run.
+        """
+        self._stop_event.set()
+
+    def run_jobs(self, jobs, rewind=True):
+        """Fetch, parse and write the given (endpoint name, dates) jobs, each
+        fetched with a single request. Failed requests are retried on their
+        own; jobs still failing after that are given up on, leaving their
+        days to the next run, while the other jobs go on. The watermarks are
+        moved back before the days given up on, unless rewind is False: the
+        backfill queue keeps its days pending instead.
+        """
+        self.retrier.budget.reset()
+        failed_jobs = []
+
+        # Jobs given up on are rewound even when a later job raises, as
+        # later days may have advanced the watermarks past them.
+        try:
+            if self.workers > 1:
+                self._run_concurrent(jobs, failed_jobs)
 
-    def run(self):
+            else:
+                for endpoint_name, window in jobs:
+                    if self._stop_event.is_set():
+                        break
+
+                    # Fetch and parse that window, as one dict of dataframes
+                    # per day.
+                    try:
+                        parsed_days = self._fetch_and_parse(endpoint_name,
+                                                            window)
+                    except Exception as e:
+                        if not fails_job(e):
+                            raise
+                        failed_jobs.append((endpoint_name, window, e))
+                        continue
+
+                    for date, df_dict in parsed_days:
+                        self._write_parsed_response(endpoint_name, df_dict,
+                                                    date)
+
+        finally:
+            self._give_up_on(failed_jobs, rewind)
+
+    def backfill(self, newest_first=True, verbose=False):
+        """Fetch the whole history since the user start date, through the
+        persistent queue of backfill.py: days already done, by an earlier
+        backfill or by a regular run, are skipped, so that an interrupted
+        backfill resumes where it stopped. Days are fetched from the newest
+        when newest_first is set, so that recent data is usable first.
+        """
+        user_info = self.session.query(db_tables.FitbitUserInfo).get(
+                                                                self.user_id)
+        self.session.commit()
+
+        endpoint_names = list(self.endpoints)
+        backfill.plan(self.session, self.user_id, endpoint_names,
+                      user_info.start_date, datetime.date.today())
 
-        # Fetch updated data from each api endpoint currently handled.
-        api_endpoints = self._api_to_database_pathway_data.keys()
+        jobs = self._get_backfill_jobs(newest_first)
+
+        # Days whose final response is stored need no API call: replay them
+        # first, 30 days of an endpoint at a time, parsed in processes if so
+        # configured.
+        stored_dates, api_jobs = {}, []
+        for endpoint_name, window in jobs:
+            if self._all_final_stored(endpoint_name, window):
+                stored_dates.setdefault(endpoint_name, []).extend(window)
+            else:
+                api_jobs.append((endpoint_name, window))
+
+        self._replay_jobs([(endpoint_name, dates[i:i + 30])
+                           for endpoint_name, dates in stored_dates.items()
+                           for i in range(0, len(dates), 30)])
+        jobs = api_jobs
+
+        progress = backfill.Progress(num_calls=len(jobs))
+
+        # Run in batches, reporting progress after each. The days given up on
+        # stay pending in the queue, for the next backfill: rewinding the
+        # watermarks would have the next update fetch every day since.
+        batch_size = max(10, 2 * self.workers)
+        failed_jobs = []  # of all batches
+        for i in range(0, len(jobs), batch_size):
+            if self._stop_event.is_set():
+                break
+
+            batch = jobs[i:i + batch_size]
+            try:
+                self.run_jobs(batch, rewind=False)
+            finally:
+                failed_jobs.extend(self.failed_jobs)
+                self.failed_jobs = list(failed_jobs)
+
+            progress.update(len(batch))
+            report = "User {user_id} - {report}".format(
+                        user_id=self.user_id,
+                        report=progress.report(*backfill.count_items(
+                                                self.session, self.user_id)))
+            self.session.commit()
+
+            logging.info(report)
+            if verbose:
+                print(report)
+
+    def replay(self, days_per_job=30):
+        """Rebuild every table from the raw responses in the response store,
+        without any API call, days_per_job days of an endpoint at a time.
+        """
+        jobs = []
+        for endpoint_name in self.endpoints:
+            dates = self.response_store.dates(endpoint_name)
+            jobs.extend((endpoint_name, dates[i:i + days_per_job])
+                        for i in range(0, len(dates), days_per_job))
+
+        self._replay_jobs(jobs)
+
+    def _replay_jobs(self, jobs):
+        """Read, parse and write the stored responses of the given
+        (endpoint name, dates) jobs.
+
+        With parse_processes > 1, jobs are read and parsed by a pool of
+        processes, which send back the parsed dataframes (pickled, i.e. as
+        their numpy buffers) rather than this process decoding and parsing
+        them on a single core. Jobs are written here as they come back, in
+        their order, while the processes parse the next ones. No more jobs
+        are in flight than the memory budget holds, going by the largest
+        job parsed so far.
+        """
+        if self.parse_processes <= 1:
+            for endpoint_name, dates in jobs:
+                if self._stop_event.is_set():
+                    break
+
+                for date in dates:
+                    response = self.response_store.get(endpoint_name, date)
+                    df_dict = self._parse_response(endpoint_name, response,
+                                                   date)
+                    self._write_parsed_response(endpoint_name, df_dict, date)
+            return
 
-        for endpoint_name in api_endpoints:
-            self._update_database_from_api_endpoint(endpoint_name)
+        with ProcessPoolExecutor(max_workers=self.parse_processes) as pool:
+            # Keep a bounded number of jobs in flight, so that parsed data
+            # doesn't pile up in memory when writing falls behind.
+            pending = collections.deque()
+            jobs = iter(jobs)
+            max_job_bytes = 0
+
+            while True:
+                max_in_flight = 2 * self.parse_processes
+                if max_job_bytes:
+                    max_in_flight = max(1, min(
+                            max_in_flight,
+                            self.memory_budget.max_bytes // max_job_bytes))
+
+                while len(pending) < max_in_flight:
+                    job = next(jobs, None)
+                    if job is None or self._stop_event.is_set():
+                        break
+
+                    endpoint_name, dates = job
+                    pending.append((endpoint_name, pool.submit(
+                                    parse_stored_responses,
+                                    self.response_store, endpoint_name,
+                                    dates)))
+
+                if not pending:
+                    break
+
+                endpoint_name, future = pending.popleft()
+                parsed_days = future.result()
+
+                job_bytes = sum(frames_bytes(df_dict)
+                                for _, df_dict, _ in parsed_days)
+                max_job_bytes = max(max_job_bytes, job_bytes)
+
+                self.memory_budget.acquire(job_bytes)
+                try:
+                    for date, df_dict, seconds in parsed_days:
+                        metrics.observe("parse_seconds", seconds,
+                                        endpoint=endpoint_name)
+                        self._write_parsed_response(endpoint_name, df_dict,
+                                                    date)
+                finally:
+                    self.memory_budget.release(job_bytes)
+
+                # Let the job go before the next ones are submitted.
+                del parsed_days
+
+            # Leave the jobs not started yet when stopped.
+            for _, future in pending:
+                future.cancel()
+
+    def _give_up_on_unwritten(self, jobs, written, failed_jobs, error):
+        """After an error aborting a run whose days are written out of order,
+        add the days of the jobs left unwritten (but not already given up on)
+        to failed_jobs, so that the watermarks are moved back before the
+        earliest of them: later days may have advanced the watermarks past
+        them.
+        """
+        given_up = {(endpoint_name, date)
+                    for endpoint_name, window, _ in failed_jobs
+                    for date in window}
+
+        for endpoint_name, window in jobs:
+            dates = [date for date in window
+                     if (endpoint_name, date) not in written
+                     and (endpoint_name, date) not in given_up]
+            if dates:
+                failed_jobs.append((endpoint_name, dates, error))
+
+    def _give_up_on(self, failed_jobs, rewind=True):
+        """Log the jobs given up on, and move the watermarks of their tables
+        back before their first day (if rewind), so that the next run fetches
+        them again even if later days were written. Jobs stopped while
+        waiting are rewound the same way, but aren't counted as failures.
+        """
+        self.failed_jobs = [(endpoint_name, window)
+                            for endpoint_name, window, error in failed_jobs
+                            if not isinstance(error, retry.Stopped)]
+        metrics.inc("failed_jobs_total", len(self.failed_jobs))
+
+        for endpoint_name, window, error in failed_jobs:
+            if not isinstance(error, retry.Stopped):
+                logging.error("Giving up on {endpoint} of user {user_id} "
+                              "from {start} to {end}: {error}".format(
+                                endpoint=endpoint_name, user_id=self.user_id,
+                                start=window[0].date(), end=window[-1].date(),
+                                error=error))
+
+            if not rewind:
+                continue
+
+            tables_dict = self.endpoints[endpoint_name].db_tables
+            for tablename in tables_dict:
+                sync_state.rewind_watermark(self.session, self.user_id,
+                                            endpoint_name, tablename,
+                                            window[0])
 
-    def _update_database_from_api_endpoint(self, endpoint_name):
+        self.session.commit()
+
+    def _run_concurrent(self, jobs, failed_jobs):
+        """Fetch and parse all (endpoint, dates) jobs in a pool of worker
+        threads, sharing the Fitbit client and its rate limiter, while a
+        single writer thread inserts the parsed dataframes with its own
+        database session. Network, parsing and database writes then overlap.
+        Jobs are planned up front, while the main session is free. Jobs
+        given up on are added to failed_jobs.
+        """
+        # The queue is bounded, in days and in bytes by the memory budget,
+        # so that parsed data doesn't pile up in memory when writing falls
+        # behind.
+        write_queue = queue.Queue(maxsize=2 * self.workers)
+        writer_errors = []
+        written = set()  # (endpoint name, date) pairs written
+        writer = threading.Thread(target=self._write_from_queue,
+                                  args=(write_queue, writer_errors, written))
+        writer.start()
+
+        try:
+            try:
+                with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                    pending = {}  # future: (endpoint name, window)
+
+                    for endpoint_name, window in jobs:
+                        if self._stop_event.is_set():
+                            break
+
+                        future = executor.submit(self._fetch_and_parse,
+                                                 endpoint_name, window)
+                        pending[future] = (endpoint_name, window)
+
+                        # Keep a bounded number of jobs in flight.
+                        if len(pending) >= 2 * self.workers:
+                            done, _ = wait(pending,
+                                           return_when=FIRST_COMPLETED)
+                            self._queue_parsed_jobs(done, pending,
+                                                    write_queue, failed_jobs)
+
+                    self._queue_parsed_jobs(list(pending), pending,
+                                            write_queue, failed_jobs)
+
+            finally:
+                write_queue.put(None)  # tell the writer we are done
+                writer.join()
+
+            if writer_errors:
+                raise writer_errors[0]
+
+        except Exception as e:
+            self._give_up_on_unwritten(jobs, written, failed_jobs, e)
+            raise
+
+    def run_async(self, concurrency=10):
+        """Entry point of the asyncio mode, for a Loader built with an
+        AsyncFitbit client. Up to `concurrency` requests are in flight at
+        once, within the rate limit, while responses are parsed and written
+        as they come in.
+        """
+        asyncio.run(self._run_async(concurrency))
+
+    async def _run_async(self, concurrency):
+
+        jobs = self._get_update_jobs()
+        semaphore = asyncio.Semaphore(concurrency)
+        loop = asyncio.get_running_loop()
+
+        self.retrier.budget.reset()
+        failed_jobs = []
+        written = set()  # (endpoint name, date) pairs written
+
+        async def fetch(endpoint_name, window):
+            async with semaphore:
+                try:
+                    responses = await self._fetch_responses_async(
+                                                    endpoint_name, window)
+                except Exception as e:
+                    if not fails_job(e):
+                        raise
+                    failed_jobs.append((endpoint_name, window, e))
+                    responses = None
+
+            return endpoint_name, window, responses
+
+        # A single writer thread, with a session of its own, parses and
+        # writes the responses one job at a time, while the event loop keeps
+        # the next requests going.
+        Session = sessionmaker(bind=self.session.get_bind())
+        writer_session = Session()
+        writer = ThreadPoolExecutor(max_workers=1)
+
+        try:
+            async with self.fitbit:
+                tasks = [asyncio.ensure_future(fetch(endpoint_name, window))
+                         for endpoint_name, window in jobs]
+
+                try:
+                    for task in asyncio.as_completed(tasks):
+                        endpoint_name, window, responses = await task
+                        if responses is None:  # given up on
+                            continue
+
+                        try:
+                            await loop.run_in_executor(
+                                writer, self._parse_and_write_responses,
+                                endpoint_name, responses, window,
+                                writer_session)
+                        except JOB_ERRORS as e:
+                            failed_jobs.append((endpoint_name, window, e))
+                            continue
+
+                        written.update((endpoint_name, date)
+                                       for date in window)
+
+                except Exception as e:
+                    self._give_up_on_unwritten(jobs, written, failed_jobs, e)
+                    raise
+
+                finally:
+                    for task in tasks:
+                        task.cancel()
+
+                    writer.shutdown()
+                    writer_session.close()
+
+        finally:
+            # As in run_jobs, even when a later job raised.
+            self._give_up_on(failed_jobs)
+
+    def _parse_and_write_responses(self, endpoint_name, responses, dates,
+                                   session):
+
+        parsed_days = self._parse_responses(endpoint_name, responses, dates)
+
+        for date, df_dict in parsed_days:
+            self._write_parsed_response(endpoint_name, df_dict, date, session)
+
+    def _get_update_jobs(self, endpoint_names=None):
+        """Return the (endpoint name, dates) pairs to fetch, for all endpoints
+        or the given ones, each fetched with a single request.
+        """
+        if endpoint_names is None:
+            endpoint_names = list(self.endpoints)
+
+        jobs = []
+        for endpoint_name in endpoint_names:
+            for window in self._get_update_windows(endpoint_name):
+                jobs.append((endpoint_name, window))
+
+        return jobs
+
+    def _get_backfill_jobs(self, newest_first):
+        """Return the (endpoint name, dates) pairs covering the pending days
+        of the backfill queue, cutting consecutive days into the fewest
+        windows each endpoint accepts, newest (or oldest) windows first.
+        """
+        jobs = []
+        for endpoint_name, endpoint in self.endpoints.items():
+
+            dates = backfill.pending_dates(self.session, self.user_id,
+                                           endpoint_name)
+            max_range_days = endpoint.max_range_days
+
+            window = []
+            for date in dates:
+                # Start a new window on gaps, or when this one is full.
+                if window and (date - window[-1] != pd.Timedelta(days=1)
+                               or len(window) == max_range_days):
+                    jobs.append((endpoint_name, pd.DatetimeIndex(window)))
+                    window = []
+                window.append(date)
+
+            if window:
+                jobs.append((endpoint_name, pd.DatetimeIndex(window)))
 
-        # First, we need to know how the data will tread for that endpoint,
-        # from a given endpoint url to possibly multiple database tables.
-        pathway_data = self._api_to_database_pathway_data[endpoint_name]
+        self.session.commit()
 
-        url = pathway_data["api_endpoint_url"]   # fstring with {date} field
-        tables_dict = pathway_data["db_tables"]  # names and ORM table refs
+        # A stable sort keeps endpoints in order within a date.
+        if newest_first:
+            jobs.sort(key=lambda job: job[1][-1], reverse=True)
+        else:
+            jobs.sort(key=lambda job: job[1][0])
+
+        return jobs
+
+    def _queue_parsed_jobs(self, futures, pending, write_queue, failed_jobs):
+        """Hand the results of finished jobs over to the writer thread."""
+        for future in futures:
+            endpoint_name, window = pending.pop(future)
+
+            try:
+                parsed_days = future.result()
+            except Exception as e:
+                if not fails_job(e):
+                    raise
+                failed_jobs.append((endpoint_name, window, e))
+                continue
+
+            # The writer releases each day's bytes once written.
+            for date, df_dict in parsed_days:
+                num_bytes = frames_bytes(df_dict)
+                self.memory_budget.acquire(num_bytes)
+                write_queue.put((endpoint_name, df_dict, date, num_bytes))
+
+    def _write_from_queue(self, write_queue, errors, written):
+        """Writer thread: insert parsed dataframes from the queue until the
+        None sentinel, using a session of its own, adding the (endpoint name,
+        date) pairs written to the written set. After an error, keep draining
+        the queue so that the main thread never blocks on it.
+        """
+        Session = sessionmaker(bind=self.session.get_bind())
+        session = Session()
 
+        try:
+            while True:
+                item = write_queue.get()
+                if item is None:
+                    return
+
+                endpoint_name, df_dict, date, num_bytes = item
+                try:
+                    if not errors:
+                        self._write_parsed_response(
+                                        endpoint_name, df_dict, date, session)
+                        written.add((endpoint_name, date))
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    self.memory_budget.release(num_bytes)
+
+        finally:
+            session.close()
+
+    def _get_update_windows(self, endpoint_name):
+        """Return the dates to update for the endpoint, cut into the fewest
+        consecutive windows the endpoint accepts in a single request.
+        """
         # Get date range from time of last update (or user start date if empty).
-        query_dates = self._get_update_date_range_from_tables(tables_dict)
+        with metrics.timer("update_range_seconds", endpoint=endpoint_name):
+            query_dates = self._get_update_date_range(endpoint_name)
+
+        # Cut the range into the fewest windows the endpoint accepts.
+        max_range_days = self.endpoints[endpoint_name].max_range_days
+        windows = [query_dates[i:i + max_range_days]
+                   for i in range(0, len(query_dates), max_range_days)]
+
+        return windows
+
+    def _fetch_and_parse(self, endpoint_name, dates):
+        """Fetch the endpoint's data over consecutive dates and parse it.
+        Return a list of (date, df_dict) pairs, where df_dict holds the
+        (tablename, df) pairs parsed for that day.
+        """
+        # Fetch responses for that window, as one response per day.
+        responses = self._fetch_responses(endpoint_name, dates)
+
+        return self._parse_responses(endpoint_name, responses, dates)
 
-        for date in query_dates: 
+    def _parse_responses(self, endpoint_name, responses, dates):
 
-            # Fetch response for that day.
-            date_string = date.strftime("%Y-%m-%d")
-            response = self.fitbit.get_resource(url.format(date=date_string))
-            response = response.json()  # TODO (Future): Want Fitbit to handle this?
+        parsed_days = []
+        for date in dates:
 
             # Treat response, returning a dict of (tablename, df) pairs.
-            df_dict = self._parse_response(endpoint_name, response, date)
+            df_dict = self._parse_response(endpoint_name, responses[date], date)
+            parsed_days.append((date, df_dict))
 
-            # Insert each df into the db, updating current date's values if any.
-            for tablename in df_dict: 
+        return parsed_days
 
-                df = df_dict[tablename] 
-                table = tables_dict[tablename] 
+    def _write_parsed_response(self, endpoint_name, df_dict, date,
+                               session=None):
+        """Write a day's parsed dataframes to each sink, and advance the sync
+        watermarks of the endpoint's tables to that date, all in a single
+        database transaction.
+        """
+        # Writer threads pass their own session along.
+        session = session or self.session
 
-                self._insert_dataframe_in_table(df, table, date) 
+        tables_dict = self.endpoints[endpoint_name].db_tables
 
-    def _get_update_date_range_from_tables(self, tables_dict):
+        try:
+            # Write each df to the sinks, updating current date's values if any.
+            for tablename in df_dict:
 
-        # End points for our date range.
-        start_date = None
-        end_date = datetime.date.today()
+                df = df_dict[tablename]
+                table = tables_dict[tablename]
 
-        # Each table needs to be updated from its maximal date to today;
-        # we'll find the earliest such date overall.
-        for table_name in tables_dict:
-            table = tables_dict[table_name]
+                for sink in self.sinks:
+                    with metrics.timer("sink_write_seconds",
+                                       sink=type(sink).__name__):
+                        counts = sink.write(session, table, df, date,
+                                            self.user_id)
 
-            # Check if non-empty first, then fetch last available date.
-            if self.session.query(table).first():
-                last_date = self.session.query(func.max(table.date)).scalar()
-                self.session.commit()
+                    # The database sink counts the rows it changed.
+                    if counts:
+                        self._count_changes(tablename, counts)
 
-            # If empty, return user start date.
-            else:
-                row = self.session.query(db_tables.FitbitUserInfo).first()
-                self.session.commit()
-                last_date = row.start_date
+            # The day was fetched, whether or not it had data for each table.
+            for tablename in tables_dict:
+                sync_state.advance_watermark(session, self.user_id,
+                                             endpoint_name, tablename, date)
 
-            # Replace start_date if empty, or if an earlier date is found.
-            if not start_date or last_date < start_date:
-                start_date = last_date
+            # The day is done, if a backfill has it queued.
+            backfill.mark_done(session, self.user_id, endpoint_name, date)
 
-        # Due to sync issues, we'll start the update back from a day prior.
-        # Some API endpoints serve default value data (such as 0) until they
-        # get fresh data from the phone/fitbit bracelet, so we need to go back
-        # a bit to insure accurate data.
-        padding_day = datetime.timedelta(days=1)
+            with metrics.timer("db_commit_seconds"):
+                session.commit()
 
-        # We'll need the user start date to make sure our range is valid.
-        row = self.session.query(db_tables.FitbitUserInfo).first()
-        self.session.commit()
-        user_start_date = row.start_date
+        except Exception:
+            session.rollback()
+            raise
 
-        # Start the update a day prior, if possible.
-        if user_start_date < start_date:
-            start_date -= padding_day
+    def _count_changes(self, tablename, counts):
+        for change, num_rows in counts.items():
+            metrics.inc("rows_{}_total".format(change), num_rows,
+                        table=tablename)
 
-        date_range = pd.date_range(start=start_date, end=end_date)
-        return date_range
+        metrics.inc("rows_written_total", counts["inserted"]
+                    + counts["updated"] + counts["deleted"], table=tablename)
 
-    def _parse_response(self, endpoint_name, response, date):
+    def _fetch_responses(self, endpoint_name, dates):
+        """Fetch the endpoint's data over consecutive dates, using a single
+        request. Return a dict of (date, response) pairs, splitting range
+        responses back into the single day format expected by the parsers.
+        """
+        responses = self._get_final_stored_responses(endpoint_name, dates)
+        if responses is not None:
+            return responses
 
-        if endpoint_name == "activities":
-            return self.parser.parse_activities_response(response, date)
+        endpoint = self.endpoints[endpoint_name]
+        url = endpoint.get_url(dates)
 
-        if endpoint_name == "steps":
-            return self.parser.parse_steps_response(response, date)
+        response = self.retrier.call(self.fitbit.get_resource, url)
 
-        if endpoint_name == "heart_rate":
-            return self.parser.parse_heart_rate_response(response, date)
+        responses = endpoint.split_response_by_date(response, dates)
+        self._store_responses(endpoint_name, responses)
+        return responses
 
-        if endpoint_name == "sleep":
-            return self.parser.parse_sleep_response(response, date)
+    async def _fetch_responses_async(self, endpoint_name, dates):
+        """Asyncio counterpart of _fetch_responses, using an AsyncFitbit."""
+        responses = self._get_final_stored_responses(endpoint_name, dates)
+        if responses is not None:
+            return responses
 
-        else:
-            raise Exception(
-                "Endpoint name has no corresponding parse_response method.")
+        endpoint = self.endpoints[endpoint_name]
+        url = endpoint.get_url(dates)
 
-    def _insert_dataframe_in_table(self, dataframe, table, date):
+        response = await self.retrier.call_async(self.fitbit.get_resource,
+                                                 url)
 
-        if dataframe is None:
-            return
+        responses = endpoint.split_response_by_date(response, dates)
+        self._store_responses(endpoint_name, responses)
+        return responses
 
-        # Input validation: we turn all nan to None, which are inserted as null.
-        df = dataframe.replace([np.nan], [None])
+    def _get_final_stored_responses(self, endpoint_name, dates):
+        """Return the stored (date, response) pairs for these dates if they
+        are all final according to the endpoint's freshness policy, so that
+        they need not be fetched again. Return None otherwise.
+        """
+        if not self._all_final_stored(endpoint_name, dates):
+            return None
 
-        # Set primary key as its own column, since we receive it as index.
-        primary_key = inspect(table).primary_key[0].name
-        df[primary_key] = df.index
+        return {date: self.response_store.get(endpoint_name, date)
+                for date in dates}
 
-        # We'll split the dataframe into two parts, based on which
-        # primary keys already present in the database for that date.
-        current_keys = self._get_primary_keys_from_table_on_date(table, date)
-        df_known_keys = df[df[primary_key].isin(current_keys)]
-        df_unknown_keys = df[~df[primary_key].isin(current_keys)]
+    def _all_final_stored(self, endpoint_name, dates):
+        """Whether the stored responses for these dates are all final."""
+        final_after_days = self.endpoints[endpoint_name].final_after_days
 
-        # We'll update the data for known keys using delete-write pattern.
-        current_rows = df_known_keys.to_dict("records")
-        for row in current_rows:
+        if self.response_store is None or final_after_days is None:
+            return False
 
-            old_entry = self.session.query(table).get(row[primary_key])
-            self.session.delete(old_entry)
+        return all(self.response_store.is_final(endpoint_name, date,
+                                                final_after_days)
+                   for date in dates)
 
-            new_entry = table(**row)
-            self.session.add(new_entry)
+    def _store_responses(self, endpoint_name, responses):
 
-            self.session.commit()
+        if self.response_store is None:
+            return
 
-        # Then we insert the new data.
-        new_rows = df_unknown_keys.to_dict("records")  
-        for row in new_rows:
-            entry = table(**row)
-            self.session.add(entry)
-            self.session.commit()
+        for date, response in responses.items():
+            self.response_store.put(endpoint_name, date, response)
 
-    def _get_primary_keys_from_table_on_date(self, table, date):
+    def seed_sync_state(self):
+        """Migration for databases filled before sync watermarks existed:
+        seed the watermark of each table lacking one from its latest date.
+        """
+        for endpoint_name in self.endpoints:
+            self._get_watermarks(endpoint_name)
 
-        # Find the primary key's name.
-        primary_key = inspect(table).primary_key[0].name
+    def _get_watermarks(self, endpoint_name):
+        """Return a dict of (tablename, watermark) pairs for the endpoint's
+        tables, with None for tables which hold no data yet. Tables without
+        a watermark are seeded from their data, once.
+        """
+        tables_dict = self.endpoints[endpoint_name].db_tables
 
-        # Get all values for that date.
-        result = self.session.query(table).filter(table.date == date)
+        watermarks = sync_state.get_watermarks(self.session, self.user_id,
+                                               endpoint_name)
 
-        if result:
-            db_keys = [getattr(row, primary_key) for row in result]
-            return db_keys
+        missing = [name for name in tables_dict if name not in watermarks]
+        for tablename in missing:
+            watermarks[tablename] = sync_state.seed_watermark(
+                        self.session, self.user_id, endpoint_name, tablename,
+                        tables_dict[tablename])
 
-        # If no values then return empty list.
-        return []
+        self.session.commit()
+        return watermarks
 
+    def _get_update_date_range(self, endpoint_name):
 
-class ResponseParser:
+        # End points for our date range.
+        end_date = datetime.date.today()
 
-    def __init__(self):
-        pass
+        # We'll need the user start date to make sure our range is valid.
+        row = self.session.query(db_tables.FitbitUserInfo).get(self.user_id)
+        user_start_date = row.start_date
 
-    def parse_activities_response(self, response, date):
+        # Each table needs to be updated from its watermark to today (or from
+        # the user start date if empty); we'll find the earliest such date.
+        watermarks = self._get_watermarks(endpoint_name)
+        start_date = min(watermark or user_start_date
+                         for watermark in watermarks.values())
 
-        # First, define template types for the dataframes to be extracted.
-        # We'll construct the response dataframes from these templates,
-        # and use them for type validation and type conversion.
-        activities_types = {
-            "logId": "int64",
-            "activityId": "int64",
-            "activityParentId": "int64",
-            "activityParentName": "str",
-            "name": "str",
-            "description": "str",
-            "hasStartTime": "bool",
-            "isFavorite": "bool",
-            "hasActiveZoneMinutes": "bool",
-            "date": "datetime64[ns]",
-            "startDateTime": "datetime64[ns]",
-            "endDateTime": "datetime64[ns]",
-            "durationMinutes": "int64",
-            "steps": "int64",
-            "calories": "int64"
-        }
-        summary_types = {
-            "date": "datetime64[ns]",
-            "activeScore": "int64",
-            "activityCalories": "int64",
-            "caloriesBMR": "int64",
-            "caloriesOut": "int64",
-            "marginalCalories": "int64",
-            "sedentaryMinutes": "int64",
-            "lightlyActiveMinutes": "int64",
-            "fairlyActiveMinutes": "int64",
-            "veryActiveMinutes": "int64",
-            "restingHeartRate": "int64",
-            "steps": "int64"
-        }
-
-        # 1. Build activities dataframe:
-        # First, we extract the relevant data (i.e. subdicts) and parse it into
-        # a first dataframe. This provides a first test of the response format.
-        df_response = None
-        try:  
-            activities = response["activities"]
-            if activities:
-                df_response = pd.DataFrame(activities)
-
-        except:  # Log bad response format (parse failure).
-            pass  # TODO (Future): add logging here.
-
-        # We construct our dataframe from this one, adding data validation.
-        df_activities = None
-        if df_response is not None:
-
-            # Initialise null dataframe with appropriate shape and columns.
-            num_rows = len(df_response.index)
-            df_activities = pd.DataFrame(data=None, index=range(num_rows))
-
-            for column in activities_types.keys():
-                df_activities[column] = None
-
-            # Fill in columns, handling type checks and conversions:
-            # First, some columns are extracted directly, adding type checks.
-            for column in ["logId",
-                           "activityId",
-                           "activityParentId",
-                           "activityParentName",
-                           "name",
-                           "description",
-                           "hasStartTime",
-                           "isFavorite",
-                           "hasActiveZoneMinutes",
-                           "steps",
-                           "calories"]:
-
-                with contextlib.suppress(KeyError, TypeError):
-                    df_activities[column] = df_response[column].astype(
-                                                    activities_types[column])
-
-            # The following columns need additional transformation:
-            # startDateTime, duration, endDateTime
-            with contextlib.suppress(KeyError, TypeError):  # startDateTime
-                new_col = df_response["startDate"]+" "+df_response["startTime"]
-                df_activities["startDateTime"] = pd.to_datetime(new_col)
-
-            with contextlib.suppress(KeyError, TypeError):  # duration
-                # convert duration column from millisec to minutes
-                millisecs_in_a_minute = 60000
-                column = "durationMinutes"
-                df_activities[column] = df_response["duration"]
-                df_activities[column] /= millisecs_in_a_minute
-                df_activities[column] = df_activities[column].astype(
-                                                    activities_types[column])
-
-            with contextlib.suppress(KeyError, TypeError):  # endDateTime
-                timedeltas = df_activities["durationMinutes"].apply(
-                                    lambda x: datetime.timedelta(minutes=x))
-
-                df_activities["endDateTime"] = df_activities["startDateTime"]
-                df_activities["endDateTime"] += timedeltas
-
-            # Next, we datestamp the dataframe.
-            df_activities["date"] = date
-
-            # Finally we pass the primary key as index, for standardization.
-            df_activities.set_index("logId", inplace=True)
-
-        # 2. Build summary dataframe:
-        # Similarly, we first extract relevant data into a first dataframe,
-        # then build our dataframe from it with a layer of validation. 
-        df_response = None
-        try: 
-            summary = response["summary"]
-            if summary:
-                # delete all sub-dicts to get a single dict
-                del summary["distances"]
-                del summary["heartRateZones"]
-
-                df_response = pd.DataFrame(summary, index=[0])
-
-        except:  # Log bad response format (parse failure).
-            pass  # TODO (Future): add logging here.
-
-        # Construct our dataframe, converting the response dataframe. 
-        df_summary = None
-        if df_response is not None:
-
-
-            # Initialise null dataframe with appropriate shape and columns.
-            num_rows = len(df_response.index)
-            df_summary = pd.DataFrame(data=None, index=range(num_rows))
-
-            for column in summary_types.keys():
-                df_summary[column] = None
-
-            # Fill in columns, handling type checks and conversions.
-            # All columns are extracted directly, adding type checks.
-            for column in ["activeScore",
-                           "activityCalories",
-                           "caloriesBMR",
-                           "caloriesOut",
-                           "marginalCalories",
-                           "sedentaryMinutes",
-                           "lightlyActiveMinutes",
-                           "fairlyActiveMinutes",
-                           "veryActiveMinutes",
-                           "restingHeartRate",
-                           "steps"]:
-
-                with contextlib.suppress(KeyError, TypeError):
-                    df_summary[column] = df_response[column].astype(
-                                                    summary_types[column])
-
-            # Next, we datestamp the dataframe.
-            df_summary["date"] = date
-
-            # Finally we pass the primary key as index, for standardization.
-            df_summary.set_index("date", inplace=True)
-
-        # 3. Format the return object as a dict: 
-        # We pair each df with the name of its intended table as key. 
-        df_dict = {
-            "Activities": df_activities, 
-            "ActivitiesDailySummary": df_summary 
-        }
-
-        return df_dict
+        # Due to sync issues, we'll start the update back from a day prior.
+        # Some API endpoints serve default value data (such as 0) until they
+        # get fresh data from the phone/fitbit bracelet, so we need to go back
+        # a bit to insure accurate data.
+        padding_day = datetime.timedelta(days=1)
 
-    def parse_steps_response(self, response, date):
+        # Start the update a day prior, if possible.
+        if user_start_date < start_date:
+            start_date -= padding_day
 
-        # First, define a template type for the dataframe to be extracted.
-        # We'll construct the response dataframe from this template,
-        # and we'll use it for type validation and type conversion. 
-        steps_types = {
-            "date": "datetime64[ns]",
-            "time": "datetime64[ns]",
-            "num_steps": "int64"
-        }
-
-        # 1. Build steps dataframe:
-        # First, we extract the relevant data (i.e. subdicts) and parse it into
-        # first dataframe. This provides a first test of the response format.
-        df_response = None
-        try:  
-            steps_intraday = response["activities-steps-intraday"]["dataset"]
-            if steps_intraday:
-                df_response = pd.DataFrame(steps_intraday)
-
-        except:  # Log bad response format.
-            pass  # TODO (Future): add logging here.
-
-        # We construct our dataframe from this one, adding data validation.
-        df_steps = None
-        if df_response is not None:
-
-            # Initialise null dataframe with appropriate shape and columns.
-            num_rows = len(df_response.index)
-            df_steps = pd.DataFrame(data=None, index=range(num_rows))
-
-            for column in steps_types.keys():
-                df_steps[column] = None
-
-            # Fill in columns, handling type checks and conversions.
-            with contextlib.suppress(KeyError, TypeError):  # time
-                # The time column in response is string in format hh:mm:ss
-                # we append the yyyy-mm-dd part of the date to it
-                # then convert to datetime
-                date_string = date.strftime("%Y-%m-%d")
-                df_steps["time"] = date_string + " " + df_response["time"]
-                df_steps["time"] = df_steps["time"].astype(steps_types["time"])
-
-            with contextlib.suppress(KeyError, TypeError):  # num_steps
-                df_steps["num_steps"] = df_response["value"].astype(
-                                                    steps_types["num_steps"])
-
-            # Next, we datestamp the dataframe.
-            df_steps["date"] = date
-
-            # Finally we pass the primary key as index, for standardization.
-            df_steps.set_index("time", inplace=True)
-
-        # 2. Format the return object as a dict: 
-        # We pair the df with the name of its intended table as key.
-        df_dict = {
-            "ActivitiesStepsIntraday": df_steps 
-        }
-
-        return df_dict
+        date_range = pd.date_range(start=start_date, end=end_date)
+        return date_range
 
-    def parse_heart_rate_response(self, response, date):
+    def _parse_response(self, endpoint_name, response, date):
 
-        # First, define a template type for the dataframe to be extracted.
-        # We'll construct the response dataframe from this template,
-        # and we'll use it for type validation and type conversion. 
-        heart_types = {
-            "date": "datetime64[ns]",
-            "time": "datetime64[ns]",
-            "bpm": "int64"
-        }
-
-        # 1. Build heart rate dataframe:
-        # First, we extract the relevant data (i.e. subdicts) and parse it into
-        # first dataframe. This provides a first test of the response format.
-        df_response = None
-        try:
-            heart_intraday = response["activities-heart-intraday"]["dataset"]
-            if heart_intraday:
-                df_response = pd.DataFrame(heart_intraday)
+        with metrics.timer("parse_seconds", endpoint=endpoint_name):
+            return self.parser.parse(endpoint_name, response, date)
 
-        except:  # Log bad response format.
-            pass  # TODO (Future): add logging here.
 
-        # We construct our dataframe from this one, adding data validation.
-        df_heart = None
-        if df_response is not None:
+def parse_stored_responses(response_store, endpoint_name, dates):
+    """Parser process of the replays: read the endpoint's stored responses
+    for the dates, and parse them. Return a list of (date, df_dict, seconds)
+    triples, with the seconds spent parsing each day.
+    """
+    parser = ResponseParser()
 
-            # Initialise null dataframe with appropriate shape and columns.
-            num_rows = len(df_response.index)
-            df_heart = pd.DataFrame(data=None, index=range(num_rows))
+    parsed_days = []
+    for date in dates:
+        response = response_store.get(endpoint_name, date)
 
-            for column in heart_types.keys():
-                df_heart[column] = None
+        start = time.perf_counter()
+        df_dict = parser.parse(endpoint_name, response, date)
+        parsed_days.append((date, df_dict, time.perf_counter() - start))
 
-            # Fill in columns, handling type checks and conversions.
-            with contextlib.suppress(KeyError, TypeError):  # time
-                # The time column in response is string in format hh:mm:ss.
-                # We append the yyyy-mm-dd part of the date to it,
-                # then convert to datetime.
-                date_string = date.strftime("%Y-%m-%d")
-                df_heart["time"] = date_string + " " + df_response["time"]
-                df_heart["time"] = df_heart["time"].astype(heart_types["time"])
+    return parsed_days
 
-            with contextlib.suppress(KeyError, TypeError):  # bpm
-                df_heart["bpm"] = df_response["value"].astype(
-                                                            heart_types["bpm"])
 
-            # Next, we datestamp the dataframe.
-            df_heart["date"] = date
+class ResponseParser:
+    """Parse API responses into dataframes, one per database table, indexed
+    by the table's primary key. Tables are described declaratively in
+    parser_schemas, each column being built in a single vectorized pass, and
+    endpoints list the tables of their responses (see endpoints.py).
+    """
 
-            # Finally we pass the primary key as index, for standardization.
-            df_heart.set_index("time", inplace=True)
+    def __init__(self):
+        pass
 
-        # 2. Format the return object as a dict:
-        # We pair the df with the name of its intended table as key. 
-        df_dict = {
-            "HeartRateIntraday": df_heart 
-        }
+    def parse(self, endpoint_name, response, date):
+        """Parse the response of any registered endpoint, returning a dict of
+        (tablename, df) pairs.
+        """
+        if endpoint_name not in endpoints.ENDPOINTS:
+            raise Exception(
+                  "Endpoint name has no corresponding registered endpoint.")
 
-        return df_dict
+        return endpoints.ENDPOINTS[endpoint_name].parse(response, date)
 
-    def parse_sleep_response(self, response, date):
+    # Parsers of the original endpoints, by name.
+    def parse_activities_response(self, response, date):
+        return self.parse("activities", response, date)
 
-        # First, define template types for the dataframes to be extracted.
-        # We'll construct the response dataframes from these templates,
-        # and use them for type validation and type conversion.
-        intraday_types = {
-            "date": "datetime64[ns]",
-            "time": "datetime64[ns]",
-            "duration_seconds": "int64",
-            "sleep_stage": "int64" 
-        }
-        summary_types = {
-            "date": "datetime64[ns]",
-            "totalMinutesAsleep": "int64",
-            "totalTimeInBed": "int64",
-            "deepMinutes": "int64",
-            "lightMinutes": "int64",
-            "remMinutes": "int64",
-            "wakeMinutes": "int64",
-            "totalSleepRecords": "int64",
-            "sleepBreakTimes": "str" 
-        }
-
-        # 1. Build the intraday dataframe: 
-        # First, we extract the relevant data (i.e. subdicts) and parse it into
-        # a first dataframe. This provides a first test of the response format. 
-        df_response = None
-        try: 
-            # First, get the list of datasets; each represents a "chunk"
-            # of sleep during the night, and we'll get multiple datasets 
-            # for nights with broken sleep. 
-            datasets_list = response["sleep"]
-
-            # Each dataset contains the intraday data under the "levels" key. 
-            # This data comes in 3 types:
-            # 
-            #   - Short cycles: Short "wake" periods (<= 180 sec). 
-            #                   Listed under "shortData" key.
-            # 
-            #   - Long cycles:  Light, deep, rem, wake periods (> 180 sec).
-            #                   Listed under "data" key.
-            # 
-            #   - "Default values":  
-            #                   Awake, restless, asleep. 
-            #                   Served when a sleep period (dataset) is too
-            #                   short (~1 hour), or when sensor data quality 
-            #                   is poor. 
-            #                   Listed under "data" key.
-            #
-            # Each of these levels dataset is a list of dicts. We assemble
-            # all of them together and parse them into a dataframe.
-
-            levels_datasets = [] 
-            for dataset in datasets_list: 
-                levels = dataset["levels"]
-
-                if "data" in levels:  # Long cycles and default values.
-                    levels_datasets.extend(levels["data"]) 
-
-                if "shortData" in levels:  # Short cycles.
-                    levels_datasets.extend(levels["shortData"])  
-
-            df_response = pd.DataFrame(levels_datasets)  
-
-        except:  # Log bad response format.
-            pass  # TODO (Future): add logging here. 
-
-        # Next, we construct a plain dataframe from the template.
-        # We then populate it using the above dataframe, adding a layer
-        # of data validation and type conversion.  
-        df_intraday = None
-        if df_response is not None: 
-
-            # Initialise null dataframe with appropriate shape and columns.
-            num_rows = len(df_response.index) 
-            df_intraday = pd.DataFrame(data=None, index=range(num_rows)) 
-
-            for column in intraday_types.keys():
-                df_intraday[column] = None
-
-            # Fill in columns, handling type checks and conversions. 
-            with contextlib.suppress(KeyError, TypeError):  # time
-                df_intraday["time"] = df_response["dateTime"].astype(
-                                                    intraday_types["time"]
-                                                    )
-                
-            with contextlib.suppress(KeyError, TypeError):  # duration_seconds
-                df_intraday["duration_seconds"] = df_response["seconds"].astype(
-                                                    intraday_types["duration_seconds"]
-                                                    )
-
-            # We convert the sleep stage from str to an int, for memory reasons. 
-            sleep_stage_id = {
-                "deep": 1,          # normal expected data
-                "light": 2,         #
-                "rem": 3,           #
-                "wake": 4,          #
-                "asleep": 5,        # default values served
-                "restless": 6,      #
-                "awake": 7          # 
-            }
-            with contextlib.suppress(KeyError, TypeError):  # sleep_stage 
-                df_intraday["sleep_stage"] = df_response["level"].map(
-                                                            sleep_stage_id
-                                                            )
-
-            # Validation: only one sleep stage exists for each time.
-            # Since we aggregated multiple sleep datasets into one
-            # there may be overlaps coming from the short cycles, e.g.:
-            #   - time: 11:45:00 --> stage: 2, duration 1800
-            #   - time: 11:45:00 --> stage: 4, duration 30 
-            # 
-            # Here we choose a single sleep stage for each duplicate,
-            # prioritising long cycles over others.  
-            df_intraday.sort_values(by=["time", "duration_seconds"],
-                                    ascending=[True, True],
-                                    inplace=True)
-            df_intraday.drop_duplicates(
-                subset='time', keep="last", inplace=True)
-
-
-            # Next, we timestamp the dataset to that day. 
-            df_intraday["date"] = date 
-
-            # Finally we pass the primary key as index, for standardization.
-            df_intraday.set_index("time", inplace=True) 
-
-
-        # 2. Build the summary dataframe: 
-        # Similarly to 1, we extract the relevant data into a first dataframe.
-        # Then we populate a new dataframe from our template, adding a layer
-        # of data validation and type conversion. 
-        df_response = None 
-        try:
-            summary = response["summary"]  
-
-            # The summary dict has a single subdict containing the time
-            # spent in each stage. We flatten this dict by bringing the stages
-            # values up one level. 
-            for stage_name in summary["stages"]:
-                summary[stage_name] = summary["stages"][stage_name] 
-
-            summary = {k: v for k, v in summary.items() if v != "stages"}
-
-            # This dict is supposed to contain the raw data for all columns, 
-            # except for:
-            #   - "date" which we pass manually at the end, and for 
-            #   - "sleepBreakTimes" which we'll have to assemble.  
-            df_response = pd.DataFrame(summary, index=[0])  
-            
-        except:  # Log bad response format (parse failure).
-            pass  # TODO (Future): add logging here.
-
-        # Construct our dataframe, converting the response dataframe. 
-        df_summary = None
-        if df_response is not None: 
-
-            # Initialise null dataframe with appropriate shape and columns.
-            num_rows = len(df_response.index) 
-            df_summary = pd.DataFrame(data=None, index=range(num_rows))
-
-            for column in summary_types.keys():
-                df_summary[column] = None
-
-            # Fill in columns, handling type checks and conversions. 
-            with contextlib.suppress(KeyError, TypeError):  # totalMinutesAsleep
-                col = "totalMinutesAsleep"
-                df_summary[col] = df_response[col].astype(summary_types[col])
-
-            with contextlib.suppress(KeyError, TypeError):  # totalTimeInBed
-                col = "totalTimeInBed"
-                df_summary[col] = df_response[col].astype(summary_types[col])
-
-            with contextlib.suppress(KeyError, TypeError):  # totalSleepRecords
-                col = "totalSleepRecords"
-                df_summary[col] = df_response[col].astype(summary_types[col])
-
-            with contextlib.suppress(KeyError, TypeError):  # deepMinutes
-                df_summary["deepMinutes"] = df_response["deep"].astype(
-                                                    summary_types["deepMinutes"]
-                                                    )
-
-            with contextlib.suppress(KeyError, TypeError):  # remMinutes
-                df_summary["remMinutes"] = df_response["rem"].astype(
-                                                    summary_types["remMinutes"]
-                                                    )
-
-            with contextlib.suppress(KeyError, TypeError):  # lightMinutes
-                df_summary["lightMinutes"] = df_response["light"].astype(
-                                                    summary_types["lightMinutes"]
-                                                    )
-
-            with contextlib.suppress(KeyError, TypeError):  # wakeMinutes
-                df_summary["wakeMinutes"] = df_response["wake"].astype(
-                                                    summary_types["wakeMinutes"]
-                                                    )
-
-            # Now, we collect a list of sleep interruption times in the
-            # sleepBreakTimes column. We'll extract it from the sleep
-            # datasets which we looked at above. 
-            # If there are no sleep interruption, a null value is recorded.
-            sleepBreakTimes_list = []
-
-            try:  # Read response data again. 
-                datasets_list = response["sleep"] 
-
-                if len(datasets_list) > 1:  # if sleep is broken
-
-                    for dataset in datasets_list: 
-                        try: 
-                            end_time = dataset["endTime"] 
-                            sleepBreakTimes_list.append(end_time) 
-                        except:
-                            pass
-
-            except:
-                pass
-
-            # We have many sleep interruption times for a given night;
-            # sort them from earliest to latest. 
-            sleepBreakTimes_list.sort(key=lambda x: pd.to_datetime(x)) 
-            
-            # Remove last timestamp: this is when I wake up.
-            if sleepBreakTimes_list:
-                sleepBreakTimes_list.pop()
-
-            # Assemble the result into a semicolon separated string. 
-            sleepBreakTimes = None
-            if sleepBreakTimes_list:
-                sleepBreakTimes = ";".join(sleepBreakTimes_list) 
-                df_summary["sleepBreakTimes"] = sleepBreakTimes 
-
-            # Next, we datastamp the dataframe.
-            df_summary["date"] = date  
-
-            # Reorder columns.
-            df_summary = df_summary[list(summary_types.keys())]
-
-            # Finally we pass the primary key as index, for standardization.
-            df_summary.set_index("date", inplace=True) 
-             
-
-        # 3. Format the return object as a dict: 
-        # We pair each df with the name of its intended table as key.
-        df_dict = {
-            "SleepIntraday": df_intraday,
-            "SleepDailySummary": df_summary
-        }
-
-        return df_dict
+    def parse_steps_response(self, response, date):
+        return self.parse("steps", response, date)
+
+    def parse_heart_rate_response(self, response, date):
+        return self.parse("heart_rate", response, date)
+
+    def parse_sleep_response(self, response, date):
+        return self.parse("sleep", response, date)
 
+    def split_sleep_range_response(self, response, dates):
+        return endpoints.split_sleep_range_response(response, dates)
@@ -0,0 +1,242 @@
+"""
+Read-side queries over the warehouse tables for downstream consumers, e.g.
+dashboards, in place of ad-hoc SQL over the raw intraday rows:
+
+    query = Query(session)
+    hourly = query.heart_rate(1, "2021-07-01", "2021-07-31", "hour")
+    nights = query.sleep_stages(1, "2021-07-01", "2021-07-31")
+
+Ranges are of dates, both included. Aggregates are read from the rollup
+tables kept by the pipeline (see rollups.py), and results are kept in an LRU
+cache for ttl_seconds, so that hot ranges are served without querying the
+database again. Results are pandas dataframes, or Arrow tables with
+as_arrow=True, which requires the pyarrow package.
+"""
+from db_tables import ActivitiesDailySummary, ActivitiesStepsIntraday
+from db_tables import ActivitiesStepsIntradayCompact, ActivitiesStepsRollup
+from db_tables import HeartRateRollup, SleepStageRollup
+import collections
+import intraday_compact
+import pandas as pd
+import parser_schemas
+import rollups
+import threading
+import time
+
+try:  # only needed for results as Arrow tables
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+class LRUCache:
+    """Values by key, up to max_entries of them, the least recently used
+    being evicted first. Values expire ttl_seconds after they were put. A
+    single instance can be shared across threads.
+    """
+
+    def __init__(self, max_entries=128, ttl_seconds=300, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()  # key: (value, expires_at)
+
+    def get(self, key):
+        """Return the value of the key, or None if missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] <= self.clock():
+                del self._entries[key]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, self.clock() + self.ttl_seconds)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class Query:
+    """Queries over the tables of a database session. compact_intraday
+    reads raw intraday data from the compact intraday tables instead.
+    """
+
+    def __init__(self, session, compact_intraday=False, cache_size=128,
+                 ttl_seconds=300, clock=time.monotonic):
+        self.session = session
+        self.compact_intraday = compact_intraday
+        self.cache = LRUCache(cache_size, ttl_seconds, clock)
+
+    def heart_rate(self, user_id, start, end, resolution="hour",
+                   as_arrow=False):
+        """Heart rate by minute, hour or day: the bpm_min, bpm_max, bpm_mean
+        and num_samples of each period, indexed by its start time.
+        """
+        _check_resolution(resolution, rollups.RESOLUTIONS)
+
+        columns = [HeartRateRollup.time, HeartRateRollup.bpm_min,
+                   HeartRateRollup.bpm_max, HeartRateRollup.bpm_mean,
+                   HeartRateRollup.num_samples]
+
+        return self._cached("heart_rate", user_id, start, end, resolution,
+                            as_arrow, self._read_rollup, HeartRateRollup,
+                            columns)
+
+    def steps(self, user_id, start, end, resolution="hour", as_arrow=False):
+        """Steps by minute, hour or day: the num_steps of each period,
+        indexed by its start time.
+        """
+        _check_resolution(resolution, rollups.RESOLUTIONS)
+
+        # Steps are stored by minute in the intraday tables.
+        if resolution == "minute":
+            return self._cached("steps", user_id, start, end, resolution,
+                                as_arrow, self._read_steps_intraday)
+
+        columns = [ActivitiesStepsRollup.time,
+                   ActivitiesStepsRollup.num_steps]
+
+        return self._cached("steps", user_id, start, end, resolution,
+                            as_arrow, self._read_rollup,
+                            ActivitiesStepsRollup, columns)
+
+    def sleep_stages(self, user_id, start, end, as_arrow=False):
+        """Minutes spent in each sleep stage per night, indexed by date, with
+        a column per stage.
+        """
+        return self._cached("sleep_stages", user_id, start, end, None,
+                            as_arrow, self._read_sleep_stages)
+
+    def resting_heart_rate(self, user_id, start, end, as_arrow=False):
+        """Daily resting heart rate, as computed by Fitbit, indexed by date."""
+        return self._cached("resting_heart_rate", user_id, start, end, None,
+                            as_arrow, self._read_resting_heart_rate)
+
+    def clear_cache(self):
+        """Forget all results, e.g. after the pipeline wrote new data."""
+        self.cache.clear()
+
+    def _cached(self, name, user_id, start, end, resolution, as_arrow, read,
+                *args):
+        """Return the result of read(user_id, start, end, resolution, *args)
+        from the cache, reading it first if missing.
+        """
+        start = pd.Timestamp(start).normalize()
+        end = pd.Timestamp(end).normalize()
+
+        key = (name, user_id, start, end, resolution)
+        result = self.cache.get(key)
+        if result is None:
+            try:
+                result = read(user_id, start, end, resolution, *args)
+            finally:
+                # End the read transaction, so that the next reads see the
+                # data written since (e.g. under MySQL's repeatable reads).
+                self.session.rollback()
+
+            self.cache.put(key, result)
+
+        if as_arrow:
+            if pyarrow is None:
+                raise Exception("Results as Arrow tables require the pyarrow "
+                                "package.")
+            return pyarrow.Table.from_pandas(result)
+
+        # Cached frames are shared, hand out copies.
+        return result.copy()
+
+    def _read(self, columns, conditions, index):
+        """Read the columns of the rows matching the conditions into a
+        dataframe indexed by the index column(s).
+        """
+        if isinstance(index, str):
+            index = [index]
+
+        names = [column.key for column in columns]
+        order = [columns[names.index(name)] for name in index]
+        rows = self.session.query(*columns).filter(*conditions) \
+                           .order_by(*order).all()
+
+        df = pd.DataFrame.from_records(rows, columns=names)
+        for name in ["time", "date"]:
+            if name in df.columns:
+                df[name] = pd.to_datetime(df[name])
+
+        return df.set_index(index)
+
+    def _read_rollup(self, user_id, start, end, resolution, table, columns):
+        return self._read(columns, [table.user_id == user_id,
+                                    table.resolution == resolution,
+                                    table.time >= start,
+                                    table.time < end + pd.Timedelta(days=1)],
+                          "time")
+
+    def _read_steps_intraday(self, user_id, start, end, resolution):
+
+        if not self.compact_intraday:
+            table = ActivitiesStepsIntraday
+            return self._read([table.time, table.num_steps],
+                              [table.user_id == user_id,
+                               table.time >= start,
+                               table.time < end + pd.Timedelta(days=1)],
+                              "time")
+
+        table = ActivitiesStepsIntradayCompact
+        first, last = intraday_compact.day_ids([start, end])
+        compact = self._read(
+                        [table.day_id, table.second_of_day, table.num_steps],
+                        [table.user_id == user_id,
+                         table.day_id >= int(first),
+                         table.day_id <= int(last)],
+                        ["day_id", "second_of_day"])
+
+        return intraday_compact.from_compact(compact, ["num_steps"])[
+                                                                ["num_steps"]]
+
+    def _read_sleep_stages(self, user_id, start, end, resolution):
+        table = SleepStageRollup
+        seconds = self._read([table.date, table.sleep_stage,
+                              table.duration_seconds],
+                             [table.user_id == user_id,
+                              table.date >= start, table.date <= end],
+                             ["date", "sleep_stage"])
+
+        minutes = (seconds["duration_seconds"] / 60).unstack(fill_value=0)
+
+        # Stages by name, in the order of their ids.
+        stage_names = {id: name for name, id
+                       in parser_schemas.SLEEP_STAGE_ID.items()}
+        minutes = minutes.rename(columns=stage_names)
+        minutes.columns.name = None
+        return minutes
+
+    def _read_resting_heart_rate(self, user_id, start, end, resolution):
+        table = ActivitiesDailySummary
+        return self._read([table.date, table.restingHeartRate],
+                          [table.user_id == user_id,
+                           table.date >= start, table.date <= end],
+                          "date")
+
+
+def _check_resolution(resolution, resolutions):
+    if resolution not in resolutions:
+        raise Exception("Unknown resolution {}, expected one of {}.".format(
+                                        resolution, ", ".join(resolutions)))
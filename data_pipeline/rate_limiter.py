@@ -0,0 +1,145 @@
+"""
+A token bucket rate limiter for the Fitbit web API, kept in sync with the
+Fitbit-Rate-Limit-* headers served with every response.
+See https://dev.fitbit.com/build/reference/web-api/developer-guide/application-design/#Rate-Limits
+"""
+import asyncio
+import datetime
+import metrics
+import retry
+import threading
+import time
+
+
+class RateLimiter:
+    """Throttle Fitbit API calls to the user's hourly budget.
+
+    Calls go through in bursts as long as budget remains, then wait exactly
+    until the budget resets. The budget is tracked locally and corrected from
+    the Fitbit-Rate-Limit-Remaining and Fitbit-Rate-Limit-Reset headers after
+    each response. A single instance can be shared across threads.
+    """
+
+    def __init__(self, limit=150, min_interval=0, verbose=False,
+                 clock=time.time, sleep=None, stop_event=None):
+        self.limit = limit                # calls per hour allowed by Fitbit
+        self.min_interval = min_interval  # minimal seconds between calls
+        self.verbose = verbose
+
+        # Waits for the budget, up to an hour, are cut short when stop_event
+        # is set (the Loader passes its own), raising retry.Stopped.
+        if stop_event is None:
+            stop_event = threading.Event()
+        self.stop_event = stop_event
+
+        # Time functions, which can be replaced to simulate time in tests.
+        self.clock = clock
+        self.sleep = sleep or self._wait
+
+        self._lock = threading.Lock()
+        self._remaining = limit  # optimistic until the first response
+        self._reset_at = None    # unknown until the first response
+        self._last_call = None
+
+    def acquire(self):
+        """Block until a call can be made within the rate limit, and take it
+        from the budget. Raises retry.Stopped when stopped while waiting.
+        """
+        while True:
+            wait = self.reserve()
+            if wait <= 0:
+                return
+
+            metrics.inc("rate_limit_sleep_seconds_total", wait)
+            self.sleep(wait)
+            self._check_stopped()
+
+    async def acquire_async(self):
+        """Asyncio counterpart of acquire, sleeping without blocking the
+        event loop.
+        """
+        while True:
+            wait = self.reserve()
+            if wait <= 0:
+                return
+
+            metrics.inc("rate_limit_sleep_seconds_total", wait)
+            await retry.wait_async(wait, self.stop_event)
+            self._check_stopped()
+
+    def reserve(self):
+        """Take a call from the budget if one is available now, returning 0.
+        Otherwise take nothing and return the number of seconds to wait
+        before trying again.
+        """
+        with self._lock:
+            now = self.clock()
+
+            # The budget is refilled when the rate limit window resets.
+            if self._reset_at is not None and now >= self._reset_at:
+                self._remaining = self.limit
+                self._reset_at = None
+
+            # Keep the minimal spacing between calls, if any.
+            if self._last_call is not None and self.min_interval:
+                spacing_wait = self._last_call + self.min_interval - now
+                if spacing_wait > 0:
+                    return spacing_wait
+
+            if self._remaining > 0:
+                self._remaining -= 1
+                self._last_call = now
+                return 0
+
+            # Budget spent: wait until the reset.
+            if self._reset_at is None:
+                self._reset_at = self._next_hour(now)
+
+            if self.verbose:
+                reset_time = datetime.datetime.fromtimestamp(self._reset_at)
+                print("Hitting API rate limit. Sleeping until {time}".format(
+                                        time=reset_time.strftime("%H:%M:%S")))
+
+            return self._reset_at - now
+
+    def update(self, headers):
+        """Sync the budget with the rate limit headers of a response."""
+        remaining = headers.get("Fitbit-Rate-Limit-Remaining")
+        reset = headers.get("Fitbit-Rate-Limit-Reset")
+
+        with self._lock:
+            now = self.clock()
+
+            if remaining is not None:
+                self._remaining = int(remaining)
+
+            if reset is not None:
+                self._reset_at = now + int(reset)
+
+    def on_rate_limited(self, headers):
+        """Empty the budget after a 429 response, until the time of reset
+        given in the response headers (or the next hour when missing).
+        """
+        reset = headers.get("Fitbit-Rate-Limit-Reset",
+                            headers.get("Retry-After"))
+
+        with self._lock:
+            now = self.clock()
+            self._remaining = 0
+
+            if reset is not None:
+                self._reset_at = now + int(reset)
+            else:
+                self._reset_at = self._next_hour(now)
+
+    @staticmethod
+    def _next_hour(now):
+        """Timestamp of the next hour, when Fitbit resets the rate limit."""
+        return (now // 3600 + 1) * 3600
+
+    def _wait(self, seconds):
+        self.stop_event.wait(seconds)
+
+    def _check_stopped(self):
+        if self.stop_event.is_set():
+            raise retry.Stopped("Stopped while waiting for the rate limit.")
@@ -0,0 +1,166 @@
+"""
+A content-addressed store of raw Fitbit API responses on disk, so that tables
+can be rebuilt from past responses without calling the API again.
+"""
+import datetime
+import gzip
+import hashlib
+import json
+import json_decoder
+import os
+import pandas as pd
+import uuid
+
+
+# User owning the references of single-user stores.
+LEGACY_USER_ID = 1
+
+
+class ResponseStore:
+    """Keep the raw JSON response of each (endpoint, date) pair on disk.
+
+    Responses are stored once per distinct content, as gzip compressed JSON
+    files named after the sha256 of that content, and each (endpoint, date)
+    pair refers to one of them along with its time of fetch:
+
+        root/objects/3f/3fa2...e1.json.gz
+        root/refs/heart_rate/2021-07-24.json  ->  {"hash": ..., "fetched_at": ...}
+
+    The references of a user's store are kept apart, under
+    root/refs/user_id=<user_id>, while objects are shared by all users.
+    References of single-user stores, directly under root/refs, belong to
+    user 1 (as do the rows of single-user databases, see build_db.py): they
+    are moved under root/refs/user_id=1 when that user's store is opened.
+
+    Files are written atomically, so a single store can be shared by threads.
+    """
+
+    def __init__(self, root, user_id=None):
+        self.root = root
+        self.user_id = user_id
+
+        if user_id == LEGACY_USER_ID:
+            self._migrate_legacy_refs()
+
+    def put(self, endpoint_name, date, response, fetched_at=None):
+        """Store the response served by the endpoint for that date, replacing
+        any previous one.
+        """
+        if fetched_at is None:
+            fetched_at = datetime.datetime.now()
+
+        content = json.dumps(response, sort_keys=True, separators=(",", ":"),
+                             default=json_decoder.default).encode()
+        content_hash = hashlib.sha256(content).hexdigest()
+
+        # Identical responses (e.g. days without data) are only stored once.
+        object_path = self._object_path(content_hash)
+        if not os.path.exists(object_path):
+            self._write_atomic(object_path, gzip.compress(content))
+
+        ref = {"hash": content_hash,
+               "fetched_at": fetched_at.strftime("%Y-%m-%dT%H:%M:%S")}
+        self._write_atomic(self._ref_path(endpoint_name, date),
+                           json.dumps(ref).encode())
+
+    def get(self, endpoint_name, date):
+        """Return the stored response for that endpoint and date, or None."""
+        ref = self.get_ref(endpoint_name, date)
+        if ref is None:
+            return None
+
+        with open(self._object_path(ref["hash"]), "rb") as f:
+            return json_decoder.decode(gzip.decompress(f.read()))
+
+    def get_ref(self, endpoint_name, date):
+        """Return the {"hash", "fetched_at"} reference of the stored response
+        for that endpoint and date, or None.
+        """
+        try:
+            with open(self._ref_path(endpoint_name, date)) as f:
+                return json.load(f)
+
+        except FileNotFoundError:
+            return None
+
+    def dates(self, endpoint_name):
+        """Return the sorted dates with a stored response for the endpoint."""
+        folder = os.path.join(self._refs_root(), endpoint_name)
+        if not os.path.isdir(folder):
+            return []
+
+        dates = [pd.to_datetime(filename[:-len(".json")])
+                 for filename in os.listdir(folder)
+                 if filename.endswith(".json")]
+
+        return sorted(dates)
+
+    def is_final(self, endpoint_name, date, final_after_days):
+        """Whether the stored response for that date can be trusted never to
+        change, i.e. was fetched at least final_after_days days after it.
+        Fitbit keeps serving partial data until the bracelet syncs, so a
+        response fetched on the day itself is never final.
+        """
+        ref = self.get_ref(endpoint_name, date)
+        if ref is None:
+            return False
+
+        fetched_at = pd.to_datetime(ref["fetched_at"])
+        days_after = (fetched_at.normalize() - pd.to_datetime(date)).days
+
+        return days_after >= final_after_days
+
+    def _migrate_legacy_refs(self):
+        """Move the references of a single-user store, i.e. the endpoint
+        folders directly under root/refs, to this user's references. A
+        reference the user already has is newer, and kept.
+        """
+        legacy_root = os.path.join(self.root, "refs")
+        if not os.path.isdir(legacy_root):
+            return
+
+        for endpoint_name in os.listdir(legacy_root):
+            folder = os.path.join(legacy_root, endpoint_name)
+            if endpoint_name.startswith("user_id=") \
+                    or not os.path.isdir(folder):
+                continue
+
+            user_folder = os.path.join(self._refs_root(), endpoint_name)
+            os.makedirs(user_folder, exist_ok=True)
+
+            for filename in os.listdir(folder):
+                path = os.path.join(folder, filename)
+                user_path = os.path.join(user_folder, filename)
+
+                if os.path.exists(user_path) or not filename.endswith(".json"):
+                    os.remove(path)
+                else:
+                    os.replace(path, user_path)
+
+            os.rmdir(folder)
+
+    def _object_path(self, content_hash):
+        return os.path.join(self.root, "objects", content_hash[:2],
+                            content_hash + ".json.gz")
+
+    def _refs_root(self):
+        if self.user_id is None:
+            return os.path.join(self.root, "refs")
+
+        return os.path.join(self.root, "refs",
+                            "user_id={}".format(self.user_id))
+
+    def _ref_path(self, endpoint_name, date):
+        filename = pd.to_datetime(date).strftime("%Y-%m-%d") + ".json"
+        return os.path.join(self._refs_root(), endpoint_name, filename)
+
+    @staticmethod
+    def _write_atomic(path, data):
+        """Write to a temporary file first, then move it in place."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        temp_path = "{path}.{id}.tmp".format(path=path, id=uuid.uuid4().hex)
+        with open(temp_path, "wb") as f:
+            f.write(data)
+
+        os.replace(temp_path, path)
@@ -0,0 +1,247 @@
+"""
+Retries of failed Fitbit API calls, with jittered exponential backoff.
+
+Errors are sorted into classes (timeouts, connection resets, 5xx server
+errors, 429 rate limiting), each retried under its own policy. A retry budget
+shared by all calls of a run bounds the total number of retries, so that a
+long outage fails the remaining calls fast instead of backing off on each.
+Errors of no retryable class (e.g. 4xx client errors) are raised right away.
+"""
+import asyncio
+import logging
+import metrics
+import random
+import requests
+import threading
+import time
+
+try:  # only needed to classify AsyncFitbit errors
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class RetriesExhausted(Exception):
+    """Raised when a call still fails after all the retries allowed by its
+    policy or by the retry budget. The last error is kept as `error`.
+    """
+
+    def __init__(self, error, attempts):
+        super().__init__("Gave up after {n} attempt(s): {error!r}".format(
+                                                    n=attempts, error=error))
+        self.error = error
+        self.attempts = attempts
+
+
+class Stopped(Exception):
+    """Raised by a retry or rate limit wait cut short by its stop event,
+    i.e. by Loader.stop(): the call is left for the next run.
+    """
+
+
+async def wait_async(seconds, stop_event):
+    """Asyncio counterpart of stop_event.wait(seconds), without blocking the
+    event loop: the event is checked every second.
+    """
+    deadline = time.monotonic() + seconds
+    while not stop_event.is_set():
+        left = deadline - time.monotonic()
+        if left <= 0:
+            return
+
+        await asyncio.sleep(min(left, 1))
+
+
+class RetryPolicy:
+    """Make up to max_attempts calls failing with errors of the policy's
+    class, waiting a random delay of up to
+    base_delay * 2**(retry - 1) seconds, capped at max_delay, between calls
+    ("full jitter"), so that concurrent clients don't retry in lockstep.
+    """
+
+    def __init__(self, max_attempts, base_delay, max_delay):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, retry, random=random.random):
+        """Seconds to wait before the given retry (1 for the first)."""
+        cap = min(self.max_delay, self.base_delay * 2 ** (retry - 1))
+        return random() * cap
+
+
+# Policies by error class. After a 429 the rate limiter already waits until
+# the budget resets, so rate limited calls are retried without delay.
+DEFAULT_POLICIES = {
+    "timeout": RetryPolicy(max_attempts=5, base_delay=2, max_delay=60),
+    "connection": RetryPolicy(max_attempts=5, base_delay=1, max_delay=60),
+    "server_error": RetryPolicy(max_attempts=5, base_delay=5, max_delay=300),
+    "rate_limited": RetryPolicy(max_attempts=3, base_delay=0, max_delay=0)
+}
+
+
+def classify(error):
+    """Return the class of a failed call's error, one of the keys of
+    DEFAULT_POLICIES, or None if it shouldn't be retried.
+    """
+    # Timeouts first, since requests' ConnectTimeout is a ConnectionError.
+    if isinstance(error, (requests.exceptions.Timeout, asyncio.TimeoutError)):
+        return "timeout"
+
+    if isinstance(error, requests.exceptions.HTTPError):
+        status = getattr(error.response, "status_code", None)
+        return _classify_status(status)
+
+    if isinstance(error, (requests.exceptions.ConnectionError,
+                          ConnectionError)):
+        return "connection"
+
+    if aiohttp is not None:
+        if isinstance(error, aiohttp.ServerTimeoutError):
+            return "timeout"
+
+        if isinstance(error, aiohttp.ClientResponseError):
+            return _classify_status(error.status)
+
+        if isinstance(error, aiohttp.ClientConnectionError):
+            return "connection"
+
+    return None
+
+
+def is_client_error(error):
+    """Whether error is a 4xx answer other than a 429: a call the API
+    refuses (e.g. for lack of an OAuth scope), which retrying won't change.
+    """
+    status = None
+    if isinstance(error, requests.exceptions.HTTPError):
+        status = getattr(error.response, "status_code", None)
+    elif aiohttp is not None and isinstance(error,
+                                            aiohttp.ClientResponseError):
+        status = error.status
+
+    return status is not None and 400 <= status < 500 and status != 429
+
+
+def _classify_status(status):
+
+    if status == 429:
+        return "rate_limited"
+
+    if status is not None and 500 <= status < 600:
+        return "server_error"
+
+    return None
+
+
+class RetryBudget:
+    """The number of retries left to a run, shared by all its calls. A
+    single instance can be shared across threads.
+    """
+
+    def __init__(self, max_retries=50):
+        self.max_retries = max_retries
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def spend(self):
+        """Take a retry from the budget, returning False if none is left."""
+        with self._lock:
+            if self.retries >= self.max_retries:
+                return False
+
+            self.retries += 1
+            return True
+
+    def reset(self):
+        """Refill the budget, for a new run."""
+        with self._lock:
+            self.retries = 0
+
+
+class Retrier:
+    """Call functions, retrying them on errors of a retryable class under
+    its policy, within the retry budget.
+
+        retrier = Retrier()
+        payload = retrier.call(fitbit.get_resource, url)
+    """
+
+    def __init__(self, policies=None, budget=None, verbose=False,
+                 sleep=None, random=random.random, stop_event=None):
+        self.policies = dict(DEFAULT_POLICIES, **(policies or {}))
+        self.budget = budget if budget is not None else RetryBudget()
+        self.verbose = verbose
+
+        # Waits between retries are cut short when stop_event is set (the
+        # Loader passes its own), raising Stopped.
+        if stop_event is None:
+            stop_event = threading.Event()
+        self.stop_event = stop_event
+
+        # Functions which can be replaced to simulate time in tests.
+        self.sleep = sleep or self._wait
+        self.random = random
+
+    def call(self, function, *args, **kwargs):
+        """Return function(*args, **kwargs), retrying it as needed. Raises
+        RetriesExhausted when giving up on a retryable error, and Stopped
+        when stopped while waiting to retry.
+        """
+        failures = {}  # number of failures by error class
+        while True:
+            try:
+                return function(*args, **kwargs)
+
+            except Exception as e:
+                self.sleep(self._next_delay(e, failures))
+                self._check_stopped(e)
+
+    async def call_async(self, function, *args, **kwargs):
+        """Asyncio counterpart of call, for coroutine functions."""
+        failures = {}
+        while True:
+            try:
+                return await function(*args, **kwargs)
+
+            except Exception as e:
+                await wait_async(self._next_delay(e, failures),
+                                 self.stop_event)
+                self._check_stopped(e)
+
+    def _wait(self, seconds):
+        self.stop_event.wait(seconds)
+
+    def _check_stopped(self, error):
+        if self.stop_event.is_set():
+            raise Stopped("Stopped before retrying: {error!r}".format(
+                                                    error=error)) from error
+
+    def _next_delay(self, error, failures):
+        """Count the call's failure with error in failures, and return the
+        delay before retrying it, or raise if it shouldn't be retried.
+        """
+        error_class = classify(error)
+        if error_class is None:
+            raise error
+
+        failures[error_class] = failures.get(error_class, 0) + 1
+        attempts = sum(failures.values())
+
+        policy = self.policies[error_class]
+        if failures[error_class] >= policy.max_attempts \
+                or not self.budget.spend():
+            raise RetriesExhausted(error, attempts) from error
+
+        delay = policy.delay(failures[error_class], self.random)
+        metrics.inc("retries_total", error_class=error_class)
+        metrics.inc("retry_sleep_seconds_total", delay)
+
+        message = "Retry {n} after {error_class} error in {delay:.1f}s: " \
+                  "{error}".format(n=attempts, error_class=error_class,
+                                   delay=delay, error=error)
+        logging.warning(message)
+        if self.verbose:
+            print(message)
+
+        return delay
@@ -0,0 +1,211 @@
+"""
+Rollups of the intraday tables: heart rate by minute, hour and day, steps by
+hour and day, and the time spent in each sleep stage per night. They are
+computed from each day of parsed intraday data, and written with it in the
+same transaction by the DatabaseSink, so that queries over long time ranges
+read a few rollup rows rather than every raw sample (see query.py).
+
+Only the days whose intraday rows changed are rolled up again, i.e. new days
+and a padding day with new samples. rebuild_rollups recomputes all of them
+from the intraday tables, e.g. for data written before the rollups existed.
+"""
+from sqlalchemy import func
+from sqlalchemy.orm import sessionmaker
+import db_diff
+import db_tables
+import db_upsert
+import intraday_compact
+import pandas as pd
+
+
+# Rollup resolutions, with their pandas frequency.
+RESOLUTIONS = {"minute": "min", "hour": "H", "day": "D"}
+
+# Steps are served by minute, so that their minute resolution is the
+# intraday table itself.
+STEPS_RESOLUTIONS = ["hour", "day"]
+
+
+# The rollup functions take parsed intraday data (date column, indexed by
+# time) of any number of days, and of several users when it has a user_id
+# column, and compute the rollups of all of them in one pass.
+
+def heart_rate_rollup(dataframe):
+    """Min, max, mean and number of bpm samples of each period."""
+    aggregations = {"bpm_min": "min", "bpm_max": "max", "bpm_mean": "mean",
+                    "num_samples": "count"}
+    return _by_resolution(dataframe, "bpm", aggregations, list(RESOLUTIONS))
+
+
+def steps_rollup(dataframe):
+    """Number of steps of each period."""
+    return _by_resolution(dataframe, "num_steps", {"num_steps": "sum"},
+                          STEPS_RESOLUTIONS)
+
+
+def sleep_stage_rollup(dataframe):
+    """Seconds spent in each sleep stage over the night of each date."""
+    keys = _user_key(dataframe) + ["date", "sleep_stage"]
+    seconds = dataframe.groupby(keys)["duration_seconds"].sum().to_frame()
+
+    # Keep the user out of the index, as in parsed dataframes.
+    seconds = seconds.reset_index(level=_user_key(dataframe))
+    stages = seconds.index.levels[1].astype("int64")
+    seconds.index = seconds.index.set_levels(stages, level="sleep_stage")
+    return seconds
+
+
+def _by_resolution(dataframe, column, aggregations, resolutions):
+    """Aggregate the column over the periods of each resolution, by user and
+    date, and stack them indexed by (resolution, time) as in the rollup
+    tables.
+    """
+    keys = _user_key(dataframe) + ["date"]
+
+    frames = []
+    for resolution in resolutions:
+        periods = dataframe[keys + [column]].reset_index(drop=True).assign(
+                        time=dataframe.index.floor(RESOLUTIONS[resolution]))
+        grouped = periods.groupby(keys + ["time"])[column]
+        frames.append(grouped.agg(**aggregations).reset_index(level=keys))
+
+    return pd.concat(frames, keys=resolutions, names=["resolution", "time"])
+
+
+def _user_key(dataframe):
+    return ["user_id"] if "user_id" in dataframe.columns else []
+
+
+# Rollup table of each intraday table, by ORM table name, with the function
+# computing it from parsed data.
+ROLLUPS = {
+    "HeartRateIntraday": (db_tables.HeartRateRollup, heart_rate_rollup),
+    "ActivitiesStepsIntraday": (db_tables.ActivitiesStepsRollup,
+                                steps_rollup),
+    "SleepIntraday": (db_tables.SleepStageRollup, sleep_stage_rollup)
+}
+
+
+def write_rollup(session, tablename, dataframe, user_id, date,
+                 batch_size=1000):
+    """Compute the rollup of a user's day of parsed intraday data, and write
+    it as changes to the rollup rows stored for that day (see db_diff.py),
+    deleting them if the dataframe is None or empty. Nothing is committed
+    here. Returns the counts of db_diff.write_day.
+    """
+    table, rollup = ROLLUPS[tablename]
+
+    if dataframe is not None and not dataframe.empty:
+        dataframe = rollup(dataframe).assign(user_id=user_id)
+    return db_diff.write_day(session, table, dataframe,
+                             {"user_id": user_id, "date": date}, date,
+                             batch_size)
+
+
+def rebuild_rollups(engine, compact_intraday=False, days_per_chunk=30,
+                    batch_size=1000):
+    """Recompute all rollup tables from the intraday tables, or from the
+    compact intraday tables when compact_intraday is set. The days of all
+    users are rebuilt days_per_chunk days at a time: the chunk's rollup rows
+    are deleted, and its intraday rows read, rolled up in one vectorized pass
+    and inserted, in a single transaction per chunk. An interrupted rebuild
+    leaves the rollups of the chunks not reached yet as they were: run it
+    again, which starts over.
+
+    Return a dict of the number of rollup rows written to each table.
+    """
+    session = sessionmaker(bind=engine)()
+    written = {}
+
+    for tablename, (table, rollup) in ROLLUPS.items():
+        written[table.__name__] = 0
+
+        for start, end in _chunks(session, tablename, compact_intraday,
+                                  days_per_chunk):
+            try:
+                # Forget the chunk's rows and their hashes (see db_diff.py),
+                # so that days written again later are diffed against the
+                # rebuilt rows.
+                session.query(table).filter(
+                        table.date >= start, table.date < end
+                        ).delete(synchronize_session=False)
+                session.query(db_tables.DayContentHash).filter(
+                        db_tables.DayContentHash.table_name == table.__name__,
+                        db_tables.DayContentHash.date >= start,
+                        db_tables.DayContentHash.date < end
+                        ).delete(synchronize_session=False)
+
+                df = _read_intraday(session, tablename, compact_intraday,
+                                    start, end)
+                if not df.empty:
+                    written[table.__name__] += db_upsert.upsert_rows(
+                                                session, table, rollup(df),
+                                                batch_size)
+                session.commit()
+
+            except Exception:
+                session.rollback()
+                raise
+
+    session.close()
+    return written
+
+
+def _chunks(session, tablename, compact_intraday, days_per_chunk):
+    """Return the [start, end) date ranges of days_per_chunk days covering
+    the days of an intraday table and of its rollup table, so that rollup
+    rows left without intraday rows are deleted too.
+    """
+    table, _ = ROLLUPS[tablename]
+    bounds = [session.query(func.min(table.date), func.max(table.date)).one()]
+
+    if compact_intraday:
+        compact_table, _ = intraday_compact.COMPACT_TABLES[tablename]
+        first_id, last_id = session.query(func.min(compact_table.day_id),
+                                          func.max(compact_table.day_id)).one()
+        if first_id is not None:
+            bounds.append((pd.to_datetime(first_id, unit="D"),
+                           pd.to_datetime(last_id, unit="D")))
+    else:
+        intraday_table = getattr(db_tables, tablename)
+        bounds.append(session.query(func.min(intraday_table.date),
+                                    func.max(intraday_table.date)).one())
+
+    days = [pd.to_datetime(day) for bound in bounds for day in bound
+            if day is not None]
+    if not days:
+        return []  # empty tables
+
+    starts = pd.date_range(start=min(days).normalize(),
+                           end=max(days).normalize(),
+                           freq="{}D".format(days_per_chunk))
+
+    return [(start.to_pydatetime(),
+             (start + pd.Timedelta(days=days_per_chunk)).to_pydatetime())
+            for start in starts]
+
+
+def _read_intraday(session, tablename, compact_intraday, start, end):
+    """Read the rows of an intraday table from start to end (excluded), in
+    the parsed format with a user_id column.
+    """
+    if compact_intraday:
+        table, value_columns = intraday_compact.COMPACT_TABLES[tablename]
+        first_id, end_id = intraday_compact.day_ids([start, end])
+        query = session.query(table).filter(table.day_id >= int(first_id),
+                                            table.day_id < int(end_id))
+    else:
+        table = getattr(db_tables, tablename)
+        query = session.query(table).filter(table.date >= start,
+                                            table.date < end)
+
+    df = pd.read_sql(query.statement, session.get_bind())
+    if df.empty:
+        return df
+
+    if compact_intraday:
+        return intraday_compact.from_compact(
+                    df.set_index(["day_id", "second_of_day"]),
+                    ["user_id"] + value_columns)
+
+    return df.set_index("time")
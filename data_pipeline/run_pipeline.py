@@ -1,6 +1,7 @@
-from parser_utils import check_nonnegative_int
+from parser_utils import check_nonnegative_int, check_positive_int
 from pipeline import Pipeline
 import argparse
+import endpoints
 
 
 if __name__ == "__main__":
@@ -12,7 +13,102 @@ if __name__ == "__main__":
         "-s",
         "--seconds_between_calls",
         type=check_nonnegative_int,
-        help="number of seconds between fitbit api calls")
+        help="minimal number of seconds between fitbit api calls")
+
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=check_positive_int,
+        help="number of threads fetching from the fitbit api concurrently")
+
+    parser.add_argument(
+        "-a",
+        "--async",
+        dest="use_async",
+        action="store_true",
+        help="fetch from the fitbit api with asyncio and pooled connections")
+
+    parser.add_argument(
+        "-r",
+        "--replay",
+        action="store_true",
+        help="rebuild all tables from stored raw responses, without api calls")
+
+    parser.add_argument(
+        "-p",
+        "--parse_processes",
+        type=check_positive_int,
+        help="number of processes parsing stored responses in replays and "
+             "backfills")
+
+    parser.add_argument(
+        "--max_buffered_mb",
+        type=check_positive_int,
+        help="megabytes of parsed data allowed to wait for writing, for all "
+             "users (default: 256)")
+
+    parser.add_argument(
+        "-c",
+        "--compact_intraday",
+        action="store_true",
+        help="write intraday data to the compact intraday tables")
+
+    parser.add_argument(
+        "--sink",
+        dest="sinks",
+        action="append",
+        choices=["database", "parquet"],
+        help="where to write parsed data (repeat for several, "
+             "default: database)")
+
+    parser.add_argument(
+        "-e",
+        "--endpoint",
+        dest="endpoint_names",
+        action="append",
+        choices=list(endpoints.ENDPOINTS),
+        help="api endpoint to sync (repeat for several, default: "
+             + ", ".join(endpoints.get_endpoints()) + ")")
+
+    parser.add_argument(
+        "-d",
+        "--daemon",
+        action="store_true",
+        help="keep running, updating each endpoint on its own schedule, "
+             "until SIGTERM")
+
+    parser.add_argument(
+        "--metrics_file",
+        help="write pipeline metrics to this JSON file after each run")
+
+    parser.add_argument(
+        "--metrics_port",
+        type=check_positive_int,
+        help="serve pipeline metrics in Prometheus text format on this port")
+
+    parser.add_argument(
+        "--metrics_host",
+        help="interface serving the metrics, e.g. 0.0.0.0 for all of them "
+             "(default: 127.0.0.1, local clients only)")
+
+    parser.add_argument(
+        "-u",
+        "--api_base_url",
+        help="base url of the fitbit api, e.g. of a local emulator "
+             "(default: https://api.fitbit.com)")
+
+    parser.add_argument(
+        "--user",
+        dest="user_ids",
+        action="append",
+        type=check_positive_int,
+        help="id of a user to sync (repeat for several, "
+             "default: all users with credentials)")
+
+    parser.add_argument(
+        "--user_workers",
+        type=check_positive_int,
+        help="number of users synced at once")
 
     parser.add_argument(
         "-v",
@@ -22,6 +118,10 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
+    # the daemon mode fetches through the threaded Loader only
+    if args.use_async and args.daemon:
+        parser.error("-a/--async can't be combined with -d/--daemon")
+
     # turn args attributes into a dict, removing the None values
     # this way default arguments are used for Pipeline when no arg is supplied
     args = {k: v for k, v in vars(args).items() if v is not None}
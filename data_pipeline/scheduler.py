@@ -0,0 +1,218 @@
+"""
+Scheduler of the daemon mode, updating each API endpoint on its own schedule
+from a single long running process, which keeps the database engine and its
+connection pool, the API tokens and the parsers warm between updates.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import logging
+import metrics
+import signal
+import threading
+import time
+
+
+class Every:
+    """Run every `seconds` seconds."""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def next_run(self, after):
+        """Timestamp of the next run after the timestamp `after`."""
+        return after + self.seconds
+
+
+class DailyAt:
+    """Run once a day, at hour:minute local time."""
+
+    def __init__(self, hour, minute=0):
+        self.hour = hour
+        self.minute = minute
+
+    def next_run(self, after):
+        after = datetime.datetime.fromtimestamp(after)
+        run = after.replace(hour=self.hour, minute=self.minute, second=0,
+                            microsecond=0)
+        if run <= after:
+            run += datetime.timedelta(days=1)
+
+        return run.timestamp()
+
+
+class Scheduler:
+    """Update each endpoint of each user through their Loader whenever its
+    schedule is due, all endpoints being due at start. Endpoints are on the
+    schedules of their registry entries (see endpoints.py), unless given
+    schedules by endpoint name. Endpoints of a user
+    due together are updated in a single run.
+
+    With workers > 1, the runs of up to that many users go on at once, in a
+    pool of threads: each user is rescheduled as their run ends, so that a
+    user waiting on their rate limit holds up no other. Their Loaders share
+    the database engine's connection pool, with sessions of their own.
+
+    stop() (or SIGTERM/SIGINT, when run from the main thread) ends the loop:
+    each Loader finishes the job in flight, committing its last day, and
+    leaves the remaining jobs to the next start.
+
+    Each run adds a row to the pipeline_runs table, and updates the metrics
+    file if given (see metrics.py). Metrics being process wide, the totals of
+    runs going on at once include each other's.
+    """
+
+    def __init__(self, loaders, schedules=None, verbose=False,
+                 metrics_file=None, workers=1, clock=time.time, sleep=None):
+
+        # A Loader per user, or a single Loader.
+        if not isinstance(loaders, (list, tuple)):
+            loaders = [loaders]
+        self.loaders = list(loaders)
+
+        # The schedule of each endpoint synced by any of the Loaders.
+        if schedules is None:
+            schedules = {name: endpoint.schedule for loader in self.loaders
+                         for name, endpoint in loader.endpoints.items()}
+        self.schedules = schedules
+        self.verbose = verbose
+        self.metrics_file = metrics_file
+        self.workers = workers  # users updated at once, 1 to disable
+
+        # Time functions, which can be replaced to simulate time in tests.
+        # Waiting is interrupted by stop(), and by the end of a user's run.
+        self._stop_event = threading.Event()
+        self._wakeup = threading.Event()
+        self.clock = clock
+        self.sleep = sleep or self._wait
+
+        # Next run of each endpoint, for each Loader.
+        now = clock()
+        self.next_runs = [{name: now for name in self.schedules}
+                          for _ in self.loaders]
+
+        self._lock = threading.Lock()
+        self._running = set()  # indexes of the Loaders running
+
+    def run_forever(self, handle_signals=True):
+        """Run the updates as they are due, until stopped."""
+        handlers = {}
+        if handle_signals and \
+                threading.current_thread() is threading.main_thread():
+            for signum in [signal.SIGTERM, signal.SIGINT]:
+                handlers[signum] = signal.signal(signum, self._on_signal)
+
+        executor = None
+        if self.workers > 1:
+            executor = ThreadPoolExecutor(max_workers=self.workers)
+
+        try:
+            while not self.stopped():
+                now = self.clock()
+                due, next_run = self._due(now)
+
+                if not due:
+                    # Wait for the next run, or for a run to end.
+                    self.sleep(None if next_run is None else next_run - now)
+                    continue
+
+                for i, endpoint_names in due:
+                    if self.stopped():
+                        break
+
+                    with self._lock:
+                        self._running.add(i)
+
+                    if executor is None:
+                        self._run_and_reschedule(i, endpoint_names)
+                    else:
+                        executor.submit(self._run_and_reschedule, i,
+                                        endpoint_names)
+
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True)
+
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+
+    def stop(self):
+        self._stop_event.set()
+        self._wakeup.set()
+
+        for loader in self.loaders:
+            loader.stop()
+
+    def stopped(self):
+        return self._stop_event.is_set()
+
+    def _due(self, now):
+        """Return the (Loader index, endpoint names) pairs due, among the
+        Loaders not running, and the time of the next run otherwise due.
+        """
+        due, next_run = [], None
+        with self._lock:
+            for i, next_runs in enumerate(self.next_runs):
+                if i in self._running:
+                    continue
+
+                names = [name for name, time in next_runs.items()
+                         if time <= now]
+                if names:
+                    due.append((i, names))
+
+                earliest = min(next_runs.values())
+                if next_run is None or earliest < next_run:
+                    next_run = earliest
+
+        return due, next_run
+
+    def _wait(self, seconds):
+        self._wakeup.wait(seconds)
+        self._wakeup.clear()
+
+    def _on_signal(self, signum, frame):
+        logging.info("Received signal {}, stopping.".format(signum))
+        if self.verbose:
+            print("Stopping after the current job.")
+
+        self.stop()
+
+    def _run_and_reschedule(self, i, endpoint_names):
+        try:
+            self._run(self.loaders[i], endpoint_names)
+
+        finally:
+            # Schedule from the end of the run, so that slow runs don't
+            # pile up.
+            end = self.clock()
+            with self._lock:
+                for name in endpoint_names:
+                    self.next_runs[i][name] = self.schedules[name].next_run(
+                                                                        end)
+                self._running.discard(i)
+
+            self._wakeup.set()
+
+    def _run(self, loader, endpoint_names):
+        """Update the endpoints. Errors are logged, and the endpoints tried
+        again on schedule, rather than ending the daemon.
+        """
+        user_id = getattr(loader, "user_id", None)
+        if self.verbose:
+            now = datetime.datetime.now().strftime("%H:%M:%S %h %d")
+            print("{time} ~ updating {names} of user {user_id}".format(
+                                time=now, names=", ".join(endpoint_names),
+                                user_id=user_id))
+        try:
+            with metrics.run_summary(loader.session, "scheduled",
+                                     self.metrics_file, user_id=user_id):
+                loader.run(endpoint_names)
+
+        except Exception as e:
+            loader.session.rollback()
+
+            time_now = datetime.datetime.now().strftime("%H:%M:%S %h %d, %Y")
+            logging.error("{time} - user {user_id} - {error}".format(
+                            time=time_now, user_id=user_id, error=e))
+            if self.verbose:
+                print(e)
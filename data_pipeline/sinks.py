@@ -0,0 +1,118 @@
+"""
+Sinks receiving the dataframes parsed by the Loader, one day of one endpoint
+of one user at a time: the database tables, and a date-partitioned Parquet
+archive.
+
+A sink implements write(session, table, dataframe, date, user_id), writing a
+parsed dataframe for the given ORM table, date and user. The Loader commits the session
+once all sinks have written a day, along with the sync watermarks, so that
+database writes stay transactional. Writes must be idempotent, since the
+padding day is written again on every run. The database sink returns the
+counts of rows it inserted, updated, deleted and left unchanged, and keeps
+the rollups of the intraday tables.
+"""
+import db_diff
+import intraday_compact
+import os
+import rollups
+import uuid
+
+try:  # only needed by ParquetSink
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+class DatabaseSink:
+    """Upsert parsed dataframes into their database tables, or into the
+    compact intraday tables when compact_intraday is set, in chunks of up to
+    batch_size rows. The rollups of intraday tables are written along for
+    the days whose rows changed, unless rollups is unset (see rollups.py).
+    """
+
+    def __init__(self, compact_intraday=False, batch_size=1000,
+                 rollups=True):
+        self.compact_intraday = compact_intraday
+        self.batch_size = batch_size
+        self.rollups = rollups
+
+    def write(self, session, table, dataframe, date, user_id):
+        """Write a day's dataframe as changes to the rows stored for that
+        date (see db_diff.py): when re-syncing the padding day, only the rows
+        inserted, changed or deleted since are written, and a day left
+        without rows (a None or empty dataframe) has its stored rows deleted.
+        Nothing is committed here. Returns the counts of db_diff.write_day for
+        the table.
+        """
+        tablename = table.__name__
+        compact = tablename in intraday_compact.COMPACT_TABLES
+        if self.compact_intraday and compact:
+            counts = intraday_compact.write_compact_day(
+                        session, tablename, dataframe, user_id, date,
+                        self.batch_size)
+        else:
+            # The user is part of every table's key, next to the parsed
+            # index, and every parsed table has the date it was served for.
+            stored = None
+            if dataframe is not None:
+                stored = dataframe.assign(user_id=user_id)
+            counts = db_diff.write_day(session, table, stored,
+                                       {"user_id": user_id, "date": date},
+                                       date, self.batch_size)
+
+        # Days whose rows are all unchanged keep their rollups.
+        changed = counts["inserted"] + counts["updated"] + counts["deleted"]
+        if self.rollups and tablename in rollups.ROLLUPS and changed:
+            rollups.write_rollup(session, tablename, dataframe, user_id, date,
+                                 self.batch_size)
+
+        return counts
+
+
+class ParquetSink:
+    """Archive parsed dataframes as a Parquet dataset per table, with one
+    file per user and day, partitioned by user, year and month:
+
+        root/heart_rate_intraday/user_id=1/year=2021/month=07/2021-07-24.parquet
+
+    Each day's file is written to a temporary file first, then moved in
+    place, so that readers never see a partial file and writing a day again
+    replaces it. Read back with e.g. pandas.read_parquet(root + "/" + table).
+    """
+
+    def __init__(self, root):
+        if pyarrow is None:
+            raise Exception("ParquetSink requires the pyarrow package.")
+
+        self.root = root
+
+    def write(self, session, table, dataframe, date, user_id):
+        path = self.day_path(table.__tablename__, date, user_id)
+
+        # A day left without rows has its file removed.
+        if dataframe is None or dataframe.empty:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # The primary key is passed as index; store it as a column.
+        arrow_table = pyarrow.Table.from_pandas(dataframe.reset_index(),
+                                                preserve_index=False)
+
+        temp_path = "{path}.{id}.tmp".format(path=path, id=uuid.uuid4().hex)
+        try:
+            pyarrow.parquet.write_table(arrow_table, temp_path)
+            os.replace(temp_path, path)
+
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def day_path(self, tablename, date, user_id):
+        return os.path.join(self.root, tablename,
+                            "user_id={}".format(user_id),
+                            date.strftime("year=%Y"), date.strftime("month=%m"),
+                            date.strftime("%Y-%m-%d") + ".parquet")
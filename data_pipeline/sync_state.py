@@ -0,0 +1,80 @@
+"""
+Incremental sync watermarks: for each user and (endpoint, table) pair, the
+latest date whose API response was written to the table, and when it was
+written. The update date range of an endpoint is then read from a handful of
+rows, rather than from a MAX(date) scan of each of its tables.
+"""
+from db_tables import SyncState
+from sqlalchemy import func
+import datetime
+
+
+def get_watermarks(session, user_id, endpoint_name):
+    """Return a dict of (table_name, watermark) pairs for the user's tables
+    of the endpoint which have one.
+    """
+    rows = session.query(SyncState).filter(
+                            SyncState.user_id == user_id,
+                            SyncState.endpoint == endpoint_name).all()
+
+    return {row.table_name: row.watermark for row in rows}
+
+
+def advance_watermark(session, user_id, endpoint_name, table_name, date):
+    """Record that the endpoint's response for that date was written to the
+    table. The watermark only moves forward, so that days written out of
+    order (e.g. by concurrent workers) never move it back.
+
+    Nothing is committed here, so that the watermark is updated in the same
+    transaction as the data.
+    """
+    date = _to_datetime(date)
+    state = session.query(SyncState).get((user_id, endpoint_name, table_name))
+
+    if state is None:
+        state = SyncState(user_id=user_id, endpoint=endpoint_name,
+                          table_name=table_name, watermark=date)
+        session.add(state)
+
+    elif state.watermark is None or state.watermark < date:
+        state.watermark = date
+
+    state.last_success = datetime.datetime.now()
+
+
+def rewind_watermark(session, user_id, endpoint_name, table_name, date):
+    """Move the watermark back to the day before date, if it is past it, so
+    that the next update fetches that day again: e.g. after giving up on a
+    day while later days were written. Nothing is committed here.
+    """
+    date = _to_datetime(date)
+    state = session.query(SyncState).get((user_id, endpoint_name, table_name))
+
+    if state is not None and state.watermark is not None \
+            and state.watermark >= date:
+        state.watermark = date - datetime.timedelta(days=1)
+
+
+def seed_watermark(session, user_id, endpoint_name, table_name, table):
+    """Migration from the former MAX(date) scans: seed the table's watermark
+    from the latest date it holds for the user. Return the watermark, or None
+    if the user has no data in the table. Nothing is committed here.
+    """
+    last_date = session.query(func.max(table.date)).filter(
+                                        table.user_id == user_id).scalar()
+    if last_date is None:
+        return None
+
+    advance_watermark(session, user_id, endpoint_name, table_name, last_date)
+    return _to_datetime(last_date)
+
+
+def _to_datetime(date):
+    """Watermarks are stored as plain datetimes, as are all table dates."""
+    if hasattr(date, "to_pydatetime"):
+        return date.to_pydatetime()
+
+    if not isinstance(date, datetime.datetime):
+        return datetime.datetime(date.year, date.month, date.day)
+
+    return date
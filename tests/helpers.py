@@ -0,0 +1,159 @@
+"""
+Helpers shared by the tests: a fake Fitbit client, SQLite sessions with
+users and credentials, and simulated time.
+"""
+from db_tables import Base, FitbitCredentials, FitbitUserInfo
+from fitbit_api import Fitbit
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+import asyncio
+import datetime
+import db_tables
+import json
+import json_decoder
+import os
+import pandas as pd
+import retry
+import threading
+
+
+class FakeClock:
+    """Simulated time, advanced by sleeping instead of waiting."""
+
+    def __init__(self, start=0):
+        self.now = start
+        self._lock = threading.Lock()
+
+    def time(self):
+        with self._lock:
+            return self.now
+
+    def sleep(self, seconds):
+        with self._lock:
+            self.now += max(seconds, 0)
+
+
+class FakeFitbit:
+    """Serve one small generated payload per endpoint and date, decoded,
+    recording the urls called. Can be shared across threads.
+    """
+
+    def __init__(self):
+        self.urls = []
+        self._lock = threading.Lock()
+
+    def get_resource(self, url):
+        with self._lock:
+            self.urls.append(url)
+
+        # Payloads go through the decoder, as in Fitbit.get_resource.
+        content = json.dumps(self._payload(url), separators=(",", ":"))
+        return json_decoder.decode(content)
+
+    def _payload(self, url):
+
+        if "/sleep/" in url:
+            return {"sleep": []}
+
+        date = url.split("/date/")[1][:10]
+        day = int(date[-2:])
+
+        if "/heart/" in url:
+            dataset = [{"time": "00:0{}:00".format(i), "value": 60 + day + i}
+                       for i in range(3)]
+            return {"activities-heart-intraday": {"dataset": dataset}}
+
+        if "/steps/" in url:
+            dataset = [{"time": "00:0{}:00".format(i), "value": day * i}
+                       for i in range(3)]
+            return {"activities-steps-intraday": {"dataset": dataset}}
+
+        return {"activities": [],
+                "summary": {"steps": 1000 * day,
+                            "distances": [],
+                            "heartRateZones": []}}
+
+
+class FakeAsyncFitbit(FakeFitbit):
+    """Asyncio counterpart of FakeFitbit, serving decoded payloads."""
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def get_resource(self, url):
+        await asyncio.sleep(0)
+        return FakeFitbit.get_resource(self, url)
+
+
+def make_session(folder, num_days):
+    """Create a SQLite database file whose user started num_days ago."""
+    engine = create_engine("sqlite:///" + os.path.join(folder, "test.db"),
+                           connect_args={"check_same_thread": False})
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+
+    add_user(session, user_id=1, num_days=num_days)
+
+    return session
+
+
+def add_user(session, user_id, num_days):
+    """Add a user who started num_days ago."""
+    today = pd.to_datetime(datetime.date.today())
+    start_date = today - pd.Timedelta(days=num_days - 1)
+    session.add(FitbitUserInfo(id=user_id, start_date=start_date))
+    session.commit()
+
+
+def dump_tables(session):
+    tables = [db_tables.ActivitiesDailySummary,
+              db_tables.ActivitiesStepsIntraday,
+              db_tables.HeartRateIntraday]
+    return {table.__tablename__: pd.read_sql_table(table.__tablename__,
+                                                   session.get_bind())
+            for table in tables}
+
+
+def make_memory_session():
+    """Create an in-memory SQLite database, with all tables but no user."""
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    return sessionmaker(bind=engine)()
+
+
+def add_credentials(session, user_id=1, access_token="token"):
+    # valid tokens, so that no refresh is attempted
+    session.add(FitbitCredentials(id=user_id, client_id="id",
+                                  client_secret="secret",
+                                  access_token=access_token,
+                                  expires_at=str(2**40)))
+    session.commit()
+
+
+def make_fitbit(rate_limiter):
+    """A Fitbit client with valid tokens, on an in-memory database."""
+    session = make_memory_session()
+    add_credentials(session)
+    return Fitbit(session, rate_limiter=rate_limiter)
+
+
+def make_retrier(clock, max_retries=50):
+    # no jitter: always wait the full delay
+    return retry.Retrier(budget=retry.RetryBudget(max_retries),
+                         sleep=clock.sleep, random=lambda: 1.0)
+
+
+def heart_rate_day(date, bpms, start=0, freq="min", user_id=None):
+    """A day of heart rate samples, as parsed, from start minutes past
+    midnight, or as stored when given a user_id.
+    """
+    times = pd.date_range(date + pd.Timedelta(minutes=start),
+                          periods=len(bpms), freq=freq, name="time")
+    df = pd.DataFrame({"date": date, "bpm": bpms}, index=times)
+
+    if user_id is not None:
+        df.insert(0, "user_id", user_id)
+    return df
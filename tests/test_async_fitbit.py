@@ -0,0 +1,72 @@
+"""
+Tests for the asyncio Fitbit client and the HTTP connection pooling, against
+the local Fitbit API emulator.
+"""
+from db_tables import FitbitCredentials
+from fitbit_api import AsyncFitbit
+from fitbit_emulator import FitbitEmulator
+from rate_limiter import RateLimiter
+from tests.helpers import make_fitbit
+import asyncio
+import emulator_payloads
+
+
+def test_fitbit_reuses_connections():
+
+    emulator = FitbitEmulator().start()
+
+    try:
+        fitbit = make_fitbit(rate_limiter=RateLimiter())
+        for _ in range(10):
+            payload = fitbit.get_resource(emulator.url
+                                          + "/1/user/-/profile.json")
+            assert(payload == emulator_payloads.profile_response())
+
+    finally:
+        emulator.stop()
+
+    # all requests went through a single keep-alive connection
+    assert(emulator.stats["success"] == 10)
+    assert(len(emulator.client_ports) == 1)
+
+
+def test_async_fitbit_concurrent_requests():
+
+    emulator = FitbitEmulator().start()
+
+    # expired tokens, which every request will find expired at first
+    fitbit = make_fitbit(rate_limiter=None)
+    credentials = fitbit.session.query(FitbitCredentials).get(1)
+    credentials.expires_at = "0"
+    fitbit.session.commit()
+
+    async def fetch_all():
+        async_fitbit = AsyncFitbit(fitbit.session, seconds_between_calls=0,
+                                   max_connections=4)
+        async_fitbit.token_url = emulator.url + "/oauth2/token"
+
+        # no requests pool, the aiohttp session is opened below
+        assert(async_fitbit.http is None)
+
+        async with async_fitbit:
+            urls = [emulator.url + "/1/user/-/profile.json"] * 20
+            return await asyncio.gather(
+                        *[async_fitbit.get_resource(url) for url in urls])
+
+    try:
+        payloads = asyncio.run(fetch_all())
+
+    finally:
+        emulator.stop()
+
+    # ------------------ TEST 1 - All requests went through -------------------
+    assert(payloads == [emulator_payloads.profile_response()] * 20)
+    assert(emulator.stats["success"] == 20)
+
+    # ------------------ TEST 2 - Tokens were refreshed once and stored -------
+    assert(emulator.stats["token_refresh"] == 1)
+    credentials = fitbit.session.query(FitbitCredentials).get(1)
+    assert(credentials.access_token == emulator.access_token)
+
+    # ------------------ TEST 3 - Connections were pooled ---------------------
+    assert(len(emulator.client_ports) <= 4)
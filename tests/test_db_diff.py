@@ -0,0 +1,149 @@
+"""
+Unit tests for the change detection of the days written to the database.
+"""
+from db_tables import Activities, DayContentHash, HeartRateIntraday
+from db_diff import write_day
+from tests.helpers import heart_rate_day, make_memory_session
+import numpy as np
+import pandas as pd
+
+
+def stored_bpms(session):
+    rows = session.query(HeartRateIntraday).order_by(HeartRateIntraday.time)
+    return [row.bpm for row in rows]
+
+
+def test_write_day():
+
+    session = make_memory_session()
+    date = pd.to_datetime("2020-05-01")
+    scope = {"user_id": 1, "date": date}
+
+    # ------------------ TEST 1 - New day is inserted -------------------------
+    counts = write_day(session, HeartRateIntraday,
+                       heart_rate_day(date, [60, 61, 62], user_id=1), scope,
+                       date)
+    session.commit()
+
+    assert(counts == {"inserted": 3, "updated": 0, "deleted": 0,
+                      "unchanged": 0})
+    assert(stored_bpms(session) == [60, 61, 62])
+    assert(session.query(DayContentHash).one().num_rows == 3)
+
+    # ------------------ TEST 2 - Same day again is left as it is -------------
+    counts = write_day(session, HeartRateIntraday,
+                       heart_rate_day(date, [60, 61, 62], user_id=1), scope,
+                       date)
+    session.commit()
+
+    assert(counts == {"inserted": 0, "updated": 0, "deleted": 0,
+                      "unchanged": 3})
+
+    # ------------------ TEST 3 - Only changes are written --------------------
+    # 00:00 is gone, 00:01 changed, 00:02 is the same and 00:03 is new.
+    counts = write_day(session, HeartRateIntraday,
+                       heart_rate_day(date, [70, 62, 63], start=1,
+                                      user_id=1), scope, date)
+    session.commit()
+
+    assert(counts == {"inserted": 1, "updated": 1, "deleted": 1,
+                      "unchanged": 1})
+    assert(stored_bpms(session) == [70, 62, 63])
+
+    # ------------------ TEST 4 - Other days are not touched ------------------
+    other_date = pd.to_datetime("2020-05-02")
+    write_day(session, HeartRateIntraday,
+              heart_rate_day(other_date, [50], user_id=1),
+              {"user_id": 1, "date": other_date}, other_date)
+    session.commit()
+
+    assert(stored_bpms(session) == [70, 62, 63, 50])
+
+    # ------------------ TEST 5 - Rows deleted out of the pipeline ------------
+    session.query(HeartRateIntraday).filter(
+                            HeartRateIntraday.date == date).delete()
+    session.commit()
+
+    counts = write_day(session, HeartRateIntraday,
+                       heart_rate_day(date, [70, 62, 63], start=1,
+                                      user_id=1), scope, date)
+    session.commit()
+
+    assert(counts["inserted"] == 3)
+    assert(stored_bpms(session) == [70, 62, 63, 50])
+
+    # ------------------ TEST 6 - A day left empty is deleted -----------------
+    counts = write_day(session, HeartRateIntraday, None, scope, date)
+    session.commit()
+
+    assert(counts == {"inserted": 0, "updated": 0, "deleted": 3,
+                      "unchanged": 0})
+    assert(stored_bpms(session) == [50])
+    assert(session.query(DayContentHash).get(
+                        (1, "HeartRateIntraday", date)) is None)
+
+    # and written again when its rows come back
+    counts = write_day(session, HeartRateIntraday,
+                       heart_rate_day(date, [60], user_id=1), scope, date)
+    session.commit()
+
+    assert(counts["inserted"] == 1)
+    assert(stored_bpms(session) == [60, 50])
+
+
+def test_write_day_compares_stored_values():
+
+    session = make_memory_session()
+    date = pd.to_datetime("2020-05-01")
+    scope = {"user_id": 1, "date": date}
+
+    activities_dict = {
+        "user_id": [1, 1],
+        "logId": [30758911349, 30758911350],
+        "name": ["Walk", None],
+        "hasStartTime": [True, False],
+        "date": [date, date],
+        "startDateTime": [pd.to_datetime("2020-05-01 08:00:00"), pd.NaT],
+        "steps": [1200, np.nan]
+    }
+    df_activities = pd.DataFrame(activities_dict).set_index("logId")
+
+    write_day(session, Activities, df_activities, scope, date)
+    session.commit()
+
+    # ------------------ TEST 1 - Values read back compare equal --------------
+    # Without the day's hash, the rows are compared with the stored ones.
+    session.query(DayContentHash).delete()
+    session.commit()
+
+    counts = write_day(session, Activities, df_activities, scope, date)
+    session.commit()
+
+    assert(counts == {"inserted": 0, "updated": 0, "deleted": 0,
+                      "unchanged": 2})
+
+    # ------------------ TEST 2 - Changed values are updated ------------------
+    df_activities.loc[30758911350, "steps"] = 300
+    counts = write_day(session, Activities, df_activities, scope, date)
+    session.commit()
+
+    assert(counts == {"inserted": 0, "updated": 1, "deleted": 0,
+                      "unchanged": 1})
+    assert(session.query(Activities).get((1, 30758911350)).steps == 300)
+
+    # ------------------ TEST 3 - Removed activities are deleted --------------
+    counts = write_day(session, Activities, df_activities.iloc[:1], scope,
+                       date)
+    session.commit()
+
+    assert(counts["deleted"] == 1)
+    assert(session.query(Activities).count() == 1)
+
+    # down to no activity at all
+    counts = write_day(session, Activities, df_activities.iloc[:0], scope,
+                       date)
+    session.commit()
+
+    assert(counts["deleted"] == 1)
+    assert(session.query(Activities).count() == 0)
+    assert(session.query(DayContentHash).count() == 0)
@@ -0,0 +1,63 @@
+"""
+Unit tests for the schema migrations of existing databases.
+"""
+from db_tables import Base
+from sqlalchemy import create_engine, inspect
+import db_migrations
+
+
+def test_create_missing_indexes():
+
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+
+    # ------------------ TEST 1 - Index missing from an older table ----------
+    engine.execute("DROP INDEX ix_heart_rate_intraday_date")
+
+    created = db_migrations.create_missing_indexes(engine, Base.metadata)
+
+    assert(created == ["ix_heart_rate_intraday_date"])
+    indexes = inspect(engine).get_indexes("heart_rate_intraday")
+    assert([index["column_names"] for index in indexes] == [["date"]])
+
+    # ------------------ TEST 2 - Nothing left to create ---------------------
+    assert(db_migrations.create_missing_indexes(engine, Base.metadata) == [])
+
+
+def test_migrate_to_multi_user():
+
+    engine = create_engine("sqlite://")
+
+    # A database of the single user layout, with an older pipeline_runs.
+    engine.execute("CREATE TABLE heart_rate_intraday (date DATETIME, "
+                   "time DATETIME PRIMARY KEY, bpm INTEGER)")
+    engine.execute("CREATE INDEX ix_heart_rate_intraday_date "
+                   "ON heart_rate_intraday (date)")
+    engine.execute("INSERT INTO heart_rate_intraday VALUES "
+                   "('2021-07-24 00:00:00.000000', "
+                   "'2021-07-24 00:01:00.000000', 69)")
+    engine.execute("CREATE TABLE pipeline_runs (id INTEGER PRIMARY KEY, "
+                   "run_type VARCHAR(20))")
+
+    # ------------------ TEST 1 - Tables keyed by user -----------------------
+    migrated = db_migrations.migrate_to_multi_user(engine)
+    assert(migrated == ["heart_rate_intraday"])
+
+    inspector = inspect(engine)
+    key = inspector.get_pk_constraint("heart_rate_intraday")
+    assert(key["constrained_columns"] == ["user_id", "time"])
+    assert([index["name"] for index in inspector.get_indexes(
+                    "heart_rate_intraday")] == ["ix_heart_rate_intraday_date"])
+
+    rows = engine.execute("SELECT user_id, bpm FROM heart_rate_intraday")
+    assert(rows.fetchall() == [(1, 69)])
+
+    # ------------------ TEST 2 - Columns added to older tables --------------
+    added = db_migrations.add_missing_columns(engine, Base.metadata)
+    assert("pipeline_runs.user_id" in added)
+    assert("user_id" in [column["name"] for column in
+                         inspect(engine).get_columns("pipeline_runs")])
+
+    # ------------------ TEST 3 - Nothing left to migrate --------------------
+    assert(db_migrations.migrate_to_multi_user(engine) == [])
+    assert(db_migrations.add_missing_columns(engine, Base.metadata) == [])
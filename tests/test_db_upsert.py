@@ -0,0 +1,98 @@
+"""
+Unit tests for the bulk upsert of parsed dataframes into database tables.
+"""
+from db_tables import Activities, HeartRateIntraday
+from db_upsert import dataframe_to_records, iter_record_batches
+from db_upsert import upsert_dataframe
+from tests.helpers import make_memory_session
+import datetime
+import numpy as np
+import pandas as pd
+
+
+def test_upsert_dataframe():
+
+    session = make_memory_session()
+
+    # ------------------ TEST 1 - Insert in empty table -----------------------
+    date = pd.to_datetime("2020-05-01")
+    heart_dict = {
+        "user_id": [1, 1],
+        "date": [date, date],
+        "time": [pd.to_datetime("2020-05-01 00:00:00"),
+                 pd.to_datetime("2020-05-01 00:01:00")],
+        "bpm": [69, 70]
+    }
+    df_heart = pd.DataFrame(heart_dict).set_index("time")
+
+    counts = upsert_dataframe(session, HeartRateIntraday, df_heart)
+    session.commit()
+
+    assert(counts == {"inserted": 2, "updated": 0})
+    assert(session.query(HeartRateIntraday).count() == 2)
+
+    # ------------------ TEST 2 - Update known keys, insert new ones ----------
+    heart_dict = {
+        "user_id": [1, 1],
+        "date": [date, date],
+        "time": [pd.to_datetime("2020-05-01 00:01:00"),
+                 pd.to_datetime("2020-05-01 00:02:00")],
+        "bpm": [75, 80]
+    }
+    df_heart = pd.DataFrame(heart_dict).set_index("time")
+
+    # small batches, to test that counts add up across batches
+    counts = upsert_dataframe(session, HeartRateIntraday, df_heart,
+                              batch_size=1)
+    session.commit()
+
+    assert(counts == {"inserted": 1, "updated": 1})
+
+    rows = session.query(HeartRateIntraday).order_by(HeartRateIntraday.time)
+    assert([row.bpm for row in rows] == [69, 75, 80])
+
+    # ------------------ TEST 3 - Missing values are inserted as null ---------
+    activities_dict = {
+        "user_id": [1],
+        "logId": [30758911349],
+        "name": ["Walk"],
+        "date": [date],
+        "startDateTime": [pd.NaT],
+        "steps": [np.nan]
+    }
+    df_activities = pd.DataFrame(activities_dict).set_index("logId")
+
+    counts = upsert_dataframe(session, Activities, df_activities)
+    session.commit()
+
+    row = session.query(Activities).get((1, 30758911349))
+    assert(counts == {"inserted": 1, "updated": 0})
+    assert(row.name == "Walk")
+    assert(row.startDateTime is None)
+    assert(row.steps is None)
+
+    # ------------------ TEST 4 - Empty dataframe -----------------------------
+    counts = upsert_dataframe(session, HeartRateIntraday, None)
+    assert(counts == {"inserted": 0, "updated": 0})
+
+
+def test_iter_record_batches():
+
+    times = pd.date_range("2020-05-01", periods=5, freq="min", name="time")
+    df_heart = pd.DataFrame({"bpm": [60, 61, np.nan, 63, 64]}, index=times)
+
+    # ------------------ TEST 1 - Rows come in batches of bounded size --------
+    batches = iter_record_batches(df_heart, batch_size=2)
+
+    assert(not isinstance(batches, list))
+    batches = list(batches)
+    assert([len(batch) for batch in batches] == [2, 2, 1])
+
+    # ------------------ TEST 2 - Records hold python values ------------------
+    records = [record for batch in batches for record in batch]
+
+    assert(records[0] == {"time": datetime.datetime(2020, 5, 1, 0, 0),
+                          "bpm": 60})
+    assert(type(records[0]["time"]) is datetime.datetime)
+    assert(records[2]["bpm"] is None)
+    assert(records == dataframe_to_records(df_heart))
@@ -0,0 +1,170 @@
+"""
+Unit tests for the registry of API endpoints, and the endpoints it adds.
+"""
+from endpoints import Endpoint
+from fitbit_api import Fitbit
+from fitbit_emulator import FitbitEmulator
+from pipeline import Loader, ResponseParser
+from rate_limiter import RateLimiter
+from scheduler import DailyAt, Scheduler
+from tests.helpers import FakeClock, FakeFitbit, add_credentials
+from tests.helpers import make_retrier, make_session
+import db_tables
+import emulator_payloads
+import endpoints
+import pandas as pd
+import parser_schemas
+import pytest
+import tempfile
+
+
+HEALTH_ENDPOINTS = ["spo2", "hrv", "breathing_rate", "skin_temperature",
+                    "weight"]
+
+
+def test_registry():
+
+    # ------------------ TEST 1 - Endpoints synced by default -----------------
+    assert(list(endpoints.get_endpoints())
+           == ["heart_rate", "steps", "activities", "sleep"])
+
+    # others when asked for, in the order of the registry
+    assert(list(endpoints.get_endpoints(["weight", "steps"]))
+           == ["steps", "weight"])
+
+    with pytest.raises(Exception):
+        endpoints.get_endpoints(["steps", "calories"])
+
+    # ------------------ TEST 2 - Ranges need a way to split them -------------
+    with pytest.raises(Exception):
+        Endpoint("spo2_range", url="/1/user/-/spo2/date/{date}.json",
+                 tables=[], max_range_days=30)
+
+    # ------------------ TEST 3 - Registered endpoints are parsed -------------
+    endpoint = Endpoint(
+        "body_fat", url="/1/user/-/body/log/fat/date/{date}.json",
+        tables=[(db_tables.Weight, parser_schemas.TableSchema(
+                    name="Weight",
+                    records=parser_schemas.list_records("fat"),
+                    index=parser_schemas.Field("logId", "int64", "logId"),
+                    fields=[parser_schemas.Field("fat", "float64", "fat")]))])
+
+    try:
+        endpoints.register(endpoint)
+        df_dict = ResponseParser().parse(
+                    "body_fat", {"fat": [{"logId": 1, "fat": 15.5}]},
+                    pd.to_datetime("2021-07-24"))
+
+        assert(list(df_dict) == ["Weight"])
+        assert(list(df_dict["Weight"]["fat"]) == [15.5])
+        assert(endpoint.get_url([pd.to_datetime("2021-07-24")])
+               == "/1/user/-/body/log/fat/date/2021-07-24.json")
+
+    finally:
+        del endpoints.ENDPOINTS["body_fat"]
+
+
+def test_health_endpoints():
+
+    parser = ResponseParser()
+    dates = pd.date_range("2021-07-23", "2021-07-25")
+
+    for name in HEALTH_ENDPOINTS:
+        endpoint = endpoints.ENDPOINTS[name]
+        url = endpoint.get_url(dates)
+        day_url = endpoint.get_url(dates[:1])
+
+        # ------------------ TEST 1 - Range responses split by day ------------
+        responses = endpoint.split_response_by_date(
+                        emulator_payloads.api_payload(url), dates)
+
+        assert(list(responses) == list(dates))
+        assert(responses[dates[0]] == emulator_payloads.api_payload(day_url))
+
+        # ------------------ TEST 2 - Parsed into their tables ----------------
+        for date in dates:
+            df_dict = parser.parse(name, responses[date], date)
+            assert(list(df_dict) == list(endpoint.db_tables))
+
+    response = emulator_payloads.api_payload(
+                    "/1/user/-/hrv/date/2021-07-24.json")
+    df = parser.parse("hrv", response, dates[1])["HeartRateVariability"]
+
+    assert(list(df.index) == [dates[1]])
+    assert(df["dailyRmssd"].iloc[0]
+           == response["hrv"][0]["value"]["dailyRmssd"])
+
+    # ------------------ TEST 3 - Days without data ---------------------------
+    assert(parser.parse("spo2", {}, dates[0])["Spo2DailySummary"] is None)
+    assert(parser.parse("weight", {"weight": []}, dates[0])["Weight"] is None)
+
+
+def test_loader_endpoints():
+
+    with tempfile.TemporaryDirectory() as folder:
+
+        session = make_session(folder, num_days=10)
+
+        # ------------------ TEST 1 - Endpoints turned off are not called -----
+        fitbit = FakeFitbit()
+        loader = Loader(session, fitbit, endpoint_names=["steps", "sleep"])
+        loader.run()
+
+        assert(len(fitbit.urls) == 10 + 1)
+        assert(not [url for url in fitbit.urls if "/heart/" in url])
+
+        states = session.query(db_tables.SyncState).all()
+        assert({state.endpoint for state in states} == {"steps", "sleep"})
+
+        # ------------------ TEST 2 - Nor scheduled ---------------------------
+        scheduler = Scheduler(loader)
+        assert(list(scheduler.schedules) == ["steps", "sleep"])
+        assert(isinstance(scheduler.schedules["sleep"], DailyAt))
+
+        # endpoints scheduled for other users are left out
+        fitbit.urls = []
+        loader.run(["heart_rate", "steps"])
+        assert(fitbit.urls and all("/steps/" in url for url in fitbit.urls))
+
+        session.get_bind().dispose()
+
+
+def test_health_endpoints_against_emulator():
+
+    clock = FakeClock(start=0)
+    emulator = FitbitEmulator(limit=150, clock=clock.time).start()
+
+    with tempfile.TemporaryDirectory() as folder:
+        try:
+            session = make_session(folder, num_days=40)
+            add_credentials(session)
+
+            fitbit = Fitbit(session, base_url=emulator.url,
+                            rate_limiter=RateLimiter(clock=clock.time,
+                                                     sleep=clock.sleep))
+            loader = Loader(session, fitbit, retrier=make_retrier(clock),
+                            endpoint_names=HEALTH_ENDPOINTS)
+            loader.run()
+
+            # ------------------ TEST 1 - Fetched over date ranges ------------
+            assert(loader.failed_jobs == [])
+            assert(emulator.stats["success"] == 2 * len(HEALTH_ENDPOINTS))
+
+            # ------------------ TEST 2 - Written to their tables -------------
+            for table in [db_tables.Spo2DailySummary,
+                          db_tables.HeartRateVariability,
+                          db_tables.BreathingRate,
+                          db_tables.SkinTemperature]:
+                assert(session.query(table).count() == 40)
+
+            dates = pd.date_range(end=pd.to_datetime("today").normalize(),
+                                  periods=40)
+            num_weights = sum(date.toordinal() % 3 == 0 for date in dates)
+            assert(session.query(db_tables.Weight).count() == num_weights)
+
+            row = session.query(db_tables.SkinTemperature).first()
+            assert(row.logType == "dedicated_temp_sensor")
+
+        finally:
+            emulator.stop()
+            session.get_bind().dispose()
@@ -0,0 +1,202 @@
+"""
+Tests for the local Fitbit API emulator, and the pipeline run against it.
+"""
+from fitbit_api import Fitbit, http_pool
+from fitbit_emulator import FitbitEmulator
+from pipeline import Loader
+from rate_limiter import RateLimiter
+from sqlalchemy.orm import sessionmaker
+from tests.helpers import FakeClock, add_credentials, add_user
+from tests.helpers import dump_tables, make_retrier, make_session
+import db_tables
+import requests
+import tempfile
+
+
+def test_emulator_endpoints():
+
+    clock = FakeClock(start=0)
+    emulator = FitbitEmulator(limit=4, clock=clock.time,
+                              access_token="token",
+                              refresh_token="refresh").start()
+
+    def get(path, token="token"):
+        return requests.get(emulator.url + path, headers={
+                            "Authorization": "Bearer " + token})
+
+    try:
+        # ------------------ TEST 1 - Generated data --------------------------
+        response = get("/1/user/-/profile.json")
+        assert(response.status_code == 200)
+        assert(response.json()["user"]["memberSince"] == "2020-01-01")
+
+        heart = get("/1/user/-/activities/heart/date/2021-07-24/1d.json")
+        dataset = heart.json()["activities-heart-intraday"]["dataset"]
+        assert(len(dataset) == 1440)
+        assert(heart.headers["Fitbit-Rate-Limit-Remaining"] == "2")
+
+        # data only depends on the request
+        steps_path = "/1/user/-/activities/steps/date/2021-07-24/1d.json"
+        assert(get(steps_path).json() == get(steps_path).json())
+
+        # ------------------ TEST 2 - Rate limit ------------------------------
+        response = get(steps_path)
+        assert(response.status_code == 429)
+        assert(response.headers["Retry-After"] == "3600")
+
+        clock.sleep(3600)
+        assert(get(steps_path).status_code == 200)
+
+        # ------------------ TEST 3 - OAuth refresh ---------------------------
+        assert(get(steps_path, token="wrong").status_code == 401)
+
+        form = {"grant_type": "refresh_token", "refresh_token": "refresh"}
+        tokens = requests.post(emulator.url + "/oauth2/token", data=form)
+        tokens = tokens.json()
+
+        # refresh tokens are single use, and access tokens replaced
+        response = requests.post(emulator.url + "/oauth2/token", data=form)
+        assert(response.status_code == 400)
+        assert(get(steps_path).status_code == 401)
+        assert(get(steps_path, tokens["access_token"]).status_code == 200)
+
+        # and expire
+        clock.sleep(tokens["expires_in"])
+        assert(get(steps_path, tokens["access_token"]).status_code == 401)
+
+    finally:
+        emulator.stop()
+
+
+def test_emulator_faults():
+
+    emulator = FitbitEmulator(faults={"/heart/": [503, "reset", 404]})
+    emulator.start()
+
+    path = "/1/user/-/activities/{}/date/2021-07-24/1d.json"
+    heart_url = emulator.url + path.format("heart")
+    steps_url = emulator.url + path.format("steps")
+
+    try:
+        # ------------------ TEST 1 - Served in turn on matching paths --------
+        assert(requests.get(steps_url).status_code == 200)
+        assert(requests.get(heart_url).status_code == 503)
+
+        try:
+            requests.get(heart_url)
+            assert(False)
+        except requests.exceptions.ConnectionError:
+            pass
+
+        response = requests.get(heart_url)
+        assert(response.status_code == 404)
+        assert(response.json()["errors"][0]["errorType"] == "not_found")
+
+        # ------------------ TEST 2 - Then the answer -------------------------
+        assert(requests.get(heart_url).status_code == 200)
+        assert(emulator.stats["errors"] == 3)
+        assert(len(emulator.paths) == 2)
+
+    finally:
+        emulator.stop()
+
+
+def test_pipeline_against_emulator():
+
+    clock = FakeClock(start=0)
+
+    # Faults are drawn from a seeded generator, so runs are reproducible.
+    emulator = FitbitEmulator(limit=50, clock=clock.time, error_rate=0.1,
+                              seed=1, access_token="token",
+                              refresh_token="refresh").start()
+
+    with tempfile.TemporaryDirectory() as folder:
+        try:
+            session = make_session(folder, num_days=30)
+            add_credentials(session)
+
+            # expired tokens, refreshed from the emulator at first
+            credentials = session.query(db_tables.FitbitCredentials).get(1)
+            credentials.refresh_token = "refresh"
+            credentials.expires_at = "0"
+            session.commit()
+
+            fitbit = Fitbit(session, base_url=emulator.url,
+                            rate_limiter=RateLimiter(clock=clock.time,
+                                                     sleep=clock.sleep))
+            loader = Loader(session, fitbit, retrier=make_retrier(clock))
+            loader.run()
+
+            # ------------------ TEST 1 - Everything got through -------------
+            assert(loader.failed_jobs == [])
+            assert(emulator.stats["errors"] > 0)
+            assert(emulator.stats["token_refresh"] == 1)
+            assert(emulator.stats["success"] == 3 * 30 + 1)
+
+            tables = dump_tables(session)
+            assert(len(tables["heart_rate_intraday"]) == 1440 * 30)
+            assert(len(tables["activities_daily_summary"]) == 30)
+            assert(session.query(db_tables.SleepDailySummary).count() == 30)
+
+            # ------------------ TEST 2 - Within the rate limit --------------
+            # Over 50 calls with 50 per hour: the limiter waited for the
+            # reset, without ever getting a 429.
+            assert(emulator.stats["rate_limited"] == 0)
+            assert(clock.time() >= 3600)
+
+        finally:
+            emulator.stop()
+            session.get_bind().dispose()
+
+
+def test_users_against_emulator():
+
+    clock = FakeClock(start=0)
+
+    # Any token is accepted, each with a limit of its own, as Fitbit limits
+    # calls per user.
+    emulator = FitbitEmulator(limit=20, clock=clock.time).start()
+
+    with tempfile.TemporaryDirectory() as folder:
+        try:
+            session = make_session(folder, num_days=10)
+            add_user(session, user_id=2, num_days=10)
+            Session = sessionmaker(bind=session.get_bind())
+
+            http = http_pool()
+            loaders = []
+            for user_id in [1, 2]:
+                add_credentials(session, user_id, "token{}".format(user_id))
+
+                user_session = Session()
+                fitbit = Fitbit(user_session, base_url=emulator.url,
+                                user_id=user_id, http=http,
+                                rate_limiter=RateLimiter(clock=clock.time,
+                                                         sleep=clock.sleep))
+                loaders.append(Loader(user_session, fitbit, user_id=user_id))
+
+            for loader in loaders:
+                loader.run()
+
+            # ------------------ TEST 1 - Both users synced ------------------
+            heart = dump_tables(session)["heart_rate_intraday"]
+            assert(heart.groupby("user_id").size().to_dict()
+                   == {1: 1440 * 10, 2: 1440 * 10})
+
+            # ------------------ TEST 2 - Per user limits, one HTTP pool -----
+            # 31 calls each with 20 per hour: each user waited once for a
+            # reset of their own budget, the first user's calls leaving the
+            # second user's budget untouched.
+            assert(emulator.stats["rate_limited"] == 0)
+            assert(emulator.stats["success"] == 2 * 31)
+            assert(clock.time() == 2 * 3600)
+
+            assert(loaders[0].fitbit.http is loaders[1].fitbit.http)
+            assert(loaders[0].fitbit.rate_limiter
+                   is not loaders[1].fitbit.rate_limiter)
+
+        finally:
+            emulator.stop()
+            for loader in loaders:
+                loader.session.close()
+            session.get_bind().dispose()
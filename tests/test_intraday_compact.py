@@ -0,0 +1,102 @@
+"""
+Tests for the compact storage of intraday tables, and its migration.
+"""
+from pipeline import Loader
+from query import Query
+from sinks import DatabaseSink
+from tests.helpers import FakeFitbit, make_session
+import db_migrations
+import db_tables
+import intraday_compact
+import os
+import pandas as pd
+import tempfile
+
+
+def read_view(session, view):
+    df = pd.read_sql("SELECT * FROM " + view, session.get_bind(),
+                     parse_dates=["date", "time"])
+    return df.sort_values("time").reset_index(drop=True)
+
+
+def test_to_compact():
+
+    # ------------------ TEST 1 - Round trip ----------------------------------
+    date = pd.to_datetime("2021-07-24")
+    df = pd.DataFrame({
+        "date": [date, date, date],
+        "duration_seconds": [30, 600, 1800],
+        "sleep_stage": [4, 2, 1]
+        }, index=pd.Index(pd.to_datetime(["2021-07-23 23:30:00",
+                                          "2021-07-24 00:00:30",
+                                          "2021-07-24 05:29:00"]),
+                          name="time"))
+
+    value_columns = ["duration_seconds", "sleep_stage"]
+    compact = intraday_compact.to_compact(df, value_columns)
+
+    assert(list(compact.index.get_level_values("day_id")) == [18832] * 3)
+    assert(list(compact.index.get_level_values("second_of_day"))
+           == [-1800, 30, 19740])  # sleep starts the evening before
+    pd.testing.assert_frame_equal(
+                    intraday_compact.from_compact(compact, value_columns), df)
+
+
+def test_compact_intraday_tables():
+
+    with tempfile.TemporaryDirectory() as folder:
+
+        # ------------------ TEST 1 - Migration of the original tables --------
+        session = make_session(folder, num_days=10)
+        Loader(session, FakeFitbit()).run()
+
+        engine = session.get_bind()
+        copied = db_migrations.migrate_intraday_to_compact(engine,
+                                                           days_per_chunk=3)
+
+        assert(copied["HeartRateIntraday"] == 3 * 10)
+        assert(session.query(db_tables.IntradayDay).count() == 10)
+
+        original = pd.read_sql_table("heart_rate_intraday", engine)
+        original = original[["user_id", "date", "time", "bpm"]].sort_values(
+            "time")
+        pd.testing.assert_frame_equal(
+            read_view(session, "heart_rate_intraday_compat"),
+            original.reset_index(drop=True), check_dtype=False)
+
+        session.get_bind().dispose()
+        os.remove(os.path.join(folder, "test.db"))
+
+        # ------------------ TEST 2 - Loader writing compact tables -----------
+        session = make_session(folder, num_days=10)
+        Loader(session, FakeFitbit(),
+               sinks=[DatabaseSink(compact_intraday=True)]).run()
+
+        assert(session.query(db_tables.HeartRateIntraday).count() == 0)
+        assert(session.query(db_tables.HeartRateIntradayCompact).count()
+               == 3 * 10)
+
+        intraday_compact.create_compatibility_views(session.get_bind())
+        pd.testing.assert_frame_equal(
+            read_view(session, "heart_rate_intraday_compat"),
+            original.reset_index(drop=True), check_dtype=False)
+
+        # ------------------ TEST 3 - Queries of the compact tables -----------
+        today = pd.to_datetime("today").normalize()
+        steps = Query(session, compact_intraday=True).steps(
+                        1, today - pd.Timedelta(days=9), today, "minute")
+
+        assert(len(steps) == 3 * 10)
+        assert(list(steps.columns) == ["num_steps"])
+        assert(steps.index[0] == today - pd.Timedelta(days=9))
+
+        # ------------------ TEST 4 - A day left empty is deleted -------------
+        counts = intraday_compact.write_compact_day(
+                    session, "HeartRateIntraday", None, 1, today)
+        session.commit()
+
+        assert(counts["deleted"] == 3)
+        assert(session.query(db_tables.HeartRateIntradayCompact).count()
+               == 3 * 9)
+
+        session.get_bind().dispose()
@@ -0,0 +1,62 @@
+"""
+Unit tests for the decoding of API payloads, with intraday datasets
+extracted into columns.
+"""
+from json_decoder import ColumnarDataset
+from pipeline import ResponseParser
+import json
+import json_decoder
+import pandas as pd
+
+
+def test_decode():
+
+    date = pd.to_datetime("2020-05-01")
+    response = {
+        "activities-heart": [{"dateTime": "2020-05-01",
+                              "value": {"restingHeartRate": 59}}],
+        "activities-heart-intraday": {
+            "dataset": [{"time": "00:00:00", "value": 69},
+                        {"time": "17:17:00", "value": 140}],
+            "datasetInterval": 1,
+            "datasetType": "minute"}
+    }
+
+    # ------------------ TEST 1 - Compact payload: columnar dataset -----------
+    content = json.dumps(response, separators=(",", ":")).encode()
+    payload = json_decoder.decode(content)
+
+    dataset = payload["activities-heart-intraday"]["dataset"]
+    assert(isinstance(dataset, ColumnarDataset))
+    assert(list(dataset.get("value")) == [69, 140])
+    assert(payload == response)
+
+    # both formats parse to the same dataframe
+    parser = ResponseParser()
+    pd.testing.assert_frame_equal(
+        parser.parse_heart_rate_response(payload, date)["HeartRateIntraday"],
+        parser.parse_heart_rate_response(response, date)["HeartRateIntraday"])
+
+    # ------------------ TEST 2 - Encoded back to the API format --------------
+    assert(json.loads(json.dumps(payload, default=json_decoder.default))
+           == response)
+
+    # ------------------ TEST 3 - Other formats: plain decode -----------------
+    content = json.dumps(response).encode()  # with whitespace
+    payload = json_decoder.decode(content)
+    assert(isinstance(payload["activities-heart-intraday"]["dataset"], list))
+    assert(payload == response)
+
+    response["activities-heart-intraday"]["dataset"][1]["value"] = 140.5
+    content = json.dumps(response, separators=(",", ":")).encode()
+    payload = json_decoder.decode(content)
+    assert(isinstance(payload["activities-heart-intraday"]["dataset"], list))
+    assert(payload == response)
+
+    # ------------------ TEST 4 - Empty dataset -------------------------------
+    response = {"activities-steps-intraday": {"dataset": []}}
+    payload = json_decoder.decode(json.dumps(response,
+                                             separators=(",", ":")))
+    assert(len(payload["activities-steps-intraday"]["dataset"]) == 0)
+    assert(parser.parse_steps_response(payload, date)
+           ["ActivitiesStepsIntraday"] is None)
@@ -0,0 +1,428 @@
+"""
+Tests for the Loader, fetching from a fake Fitbit client into SQLite.
+"""
+from memory_budget import MemoryBudget
+from pipeline import Loader, Pipeline
+from response_store import ResponseStore
+from sqlalchemy.orm import sessionmaker
+from tests.helpers import FakeAsyncFitbit, FakeFitbit, add_user
+from tests.helpers import dump_tables, make_session
+import backfill
+import datetime
+import db_tables
+import metrics
+import os
+import pandas as pd
+import pytest
+import retry
+import tempfile
+import warnings
+
+
+def test_loader_run():
+
+    with tempfile.TemporaryDirectory() as folder:
+
+        # ------------------ TEST 1 - Sequential run --------------------------
+        session = make_session(folder, num_days=10)
+        fitbit = FakeFitbit()
+        Loader(session, fitbit).run()
+
+        sequential_tables = dump_tables(session)
+
+        # one call per day for the daily endpoints, one for the sleep range
+        assert(len(fitbit.urls) == 3 * 10 + 1)
+        assert(len(sequential_tables["heart_rate_intraday"]) == 3 * 10)
+        assert(len(sequential_tables["activities_daily_summary"]) == 10)
+
+        session.get_bind().dispose()
+        os.remove(os.path.join(folder, "test.db"))
+
+        # ------------------ TEST 2 - Concurrent run --------------------------
+        session = make_session(folder, num_days=10)
+        fitbit = FakeFitbit()
+        Loader(session, fitbit, workers=4).run()
+
+        concurrent_tables = dump_tables(session)
+
+        assert(len(fitbit.urls) == 3 * 10 + 1)
+        for name, df in sequential_tables.items():
+            pd.testing.assert_frame_equal(
+                    concurrent_tables[name].sort_values(
+                        list(df.columns)).reset_index(drop=True),
+                    df.sort_values(list(df.columns)).reset_index(drop=True))
+
+        # ------------------ TEST 3 - Re-sync from the padding day ------------
+        fitbit = FakeFitbit()
+        before = metrics.REGISTRY.totals()
+        Loader(session, fitbit, workers=4).run()
+        after = metrics.REGISTRY.totals()
+
+        # today and the padding day are fetched again, without duplicates
+        heart_urls = [url for url in fitbit.urls if "/heart/" in url]
+        assert(len(heart_urls) == 2)
+        assert(len(dump_tables(session)["heart_rate_intraday"]) == 3 * 10)
+
+        # and, being unchanged, not written again
+        assert(after["rows_written_total"] == before["rows_written_total"])
+        assert(after["rows_unchanged_total"]
+               > before.get("rows_unchanged_total", 0))
+
+        session.get_bind().dispose()
+        os.remove(os.path.join(folder, "test.db"))
+
+        # ------------------ TEST 4 - Concurrent run within a memory budget ---
+        # Days are written one at a time, fetching waiting for the writer.
+        session = make_session(folder, num_days=10)
+        budget = MemoryBudget(max_bytes=1)
+        Loader(session, FakeFitbit(), workers=4, memory_budget=budget).run()
+
+        assert(budget.held == 0)
+        for name, df in sequential_tables.items():
+            pd.testing.assert_frame_equal(
+                    dump_tables(session)[name].sort_values(
+                        list(df.columns)).reset_index(drop=True),
+                    df.sort_values(list(df.columns)).reset_index(drop=True))
+
+        session.get_bind().dispose()
+
+
+def test_loader_run_async():
+
+    with tempfile.TemporaryDirectory() as folder:
+
+        session = make_session(folder, num_days=10)
+        Loader(session, FakeFitbit()).run()
+        sequential_tables = dump_tables(session)
+        session.get_bind().dispose()
+        os.remove(os.path.join(folder, "test.db"))
+
+        session = make_session(folder, num_days=10)
+        fitbit = FakeAsyncFitbit()
+        Loader(session, fitbit).run_async(concurrency=4)
+        async_tables = dump_tables(session)
+
+        assert(len(fitbit.urls) == 3 * 10 + 1)
+        for name, df in sequential_tables.items():
+            pd.testing.assert_frame_equal(
+                    async_tables[name].sort_values(
+                        list(df.columns)).reset_index(drop=True),
+                    df.sort_values(list(df.columns)).reset_index(drop=True))
+
+        session.get_bind().dispose()
+
+
+def test_loader_fails_jobs_on_unreadable_responses():
+
+    # ------------------ TEST 1 - The asyncio mode only runs updates ----------
+    for mode in ["daemon", "backfill"]:
+        with pytest.raises(Exception):
+            Pipeline(use_async=True, **{mode: True})
+
+    with tempfile.TemporaryDirectory() as folder:
+
+        # ------------------ TEST 2 - Unreadable days aren't taken as empty ---
+        # The threaded Loader gets coroutines from an AsyncFitbit.
+        session = make_session(folder, num_days=10)
+        loader = Loader(session, FakeAsyncFitbit())
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)  # never awaited
+            loader.run()
+
+        assert(len(loader.failed_jobs) == 3 * 10 + 1)
+        assert(all(len(df) == 0 for df in dump_tables(session).values()))
+        assert(session.query(db_tables.SyncState).filter(
+                    db_tables.SyncState.watermark.isnot(None)).count() == 0)
+
+        session.get_bind().dispose()
+
+
+def test_loader_replay():
+
+    with tempfile.TemporaryDirectory() as folder:
+
+        store = ResponseStore(os.path.join(folder, "raw_responses"))
+
+        # ------------------ TEST 1 - Run, storing raw responses --------------
+        session = make_session(folder, num_days=10)
+        Loader(session, FakeFitbit(), response_store=store).run()
+        run_tables = dump_tables(session)
+        session.get_bind().dispose()
+        os.remove(os.path.join(folder, "test.db"))
+
+        assert(len(store.dates("heart_rate")) == 10)
+        assert(len(store.dates("sleep")) == 10)
+
+        # ------------------ TEST 2 - Replay into a new database --------------
+        session = make_session(folder, num_days=10)
+        fitbit = FakeFitbit()
+        Loader(session, fitbit, response_store=store).replay()
+        replay_tables = dump_tables(session)
+
+        assert(len(fitbit.urls) == 0)
+        for name, df in run_tables.items():
+            pd.testing.assert_frame_equal(replay_tables[name], df)
+
+        # ------------------ TEST 3 - Final days are not fetched again --------
+        # Delete the data along with its watermarks, and pretend all
+        # responses were fetched long after.
+        for table in [db_tables.HeartRateIntraday,
+                      db_tables.ActivitiesStepsIntraday]:
+            session.query(table).delete()
+        session.query(db_tables.SyncState).filter(
+            db_tables.SyncState.endpoint.in_(["heart_rate", "steps"])).delete(
+                                                    synchronize_session=False)
+        session.commit()
+
+        for endpoint_name in ["heart_rate", "steps"]:
+            for date in store.dates(endpoint_name):
+                response = store.get(endpoint_name, date)
+                store.put(endpoint_name, date, response,
+                          fetched_at=datetime.datetime(2100, 1, 1))
+
+        fitbit = FakeFitbit()
+        Loader(session, fitbit, response_store=store).run()
+
+        # intraday tables were rebuilt from the store only
+        assert(not [url for url in fitbit.urls if "/heart/" in url])
+        assert(not [url for url in fitbit.urls if "/steps/" in url])
+        assert(len(dump_tables(session)["heart_rate_intraday"]) == 3 * 10)
+
+        session.get_bind().dispose()
+        os.remove(os.path.join(folder, "test.db"))
+
+        # ------------------ TEST 4 - Parsing in processes --------------------
+        session = make_session(folder, num_days=10)
+        Loader(session, FakeFitbit(), response_store=store,
+               parse_processes=2).replay(days_per_job=3)
+
+        for name, df in dump_tables(session).items():
+            pd.testing.assert_frame_equal(df, run_tables[name])
+
+        # ------------------ TEST 5 - Backfill of the stored days -------------
+        # The final intraday days are replayed, the others fetched.
+        session.query(db_tables.HeartRateIntraday).delete()
+        session.commit()
+
+        fitbit = FakeFitbit()
+        Loader(session, fitbit, response_store=store,
+               parse_processes=2).backfill()
+
+        assert(not [url for url in fitbit.urls if "/heart/" in url])
+        assert(len([url for url in fitbit.urls if "/date/" in url])
+               == 10 + 1)  # activities by day, sleep by range
+        assert(len(dump_tables(session)["heart_rate_intraday"]) == 3 * 10)
+        assert(backfill.count_items(session) == (4 * 10, 4 * 10))
+
+        session.get_bind().dispose()
+
+
+def test_loader_sync_state():
+
+    with tempfile.TemporaryDirectory() as folder:
+
+        session = make_session(folder, num_days=10)
+        today = pd.to_datetime(datetime.date.today())
+
+        # ------------------ TEST 1 - Watermarks follow the writes ------------
+        Loader(session, FakeFitbit()).run()
+
+        states = session.query(db_tables.SyncState).all()
+        assert(len(states) == 6)  # one per (endpoint, table)
+        assert(all(state.watermark == today for state in states))
+
+        # tables left empty by the payloads are not fetched from the start
+        fitbit = FakeFitbit()
+        Loader(session, fitbit).run()
+        assert(len(fitbit.urls) == 3 * 2 + 1)
+
+        # ------------------ TEST 2 - Failed writes leave them untouched ------
+        loader = Loader(session, FakeFitbit())
+        df_dict = {"HeartRateIntraday": pd.DataFrame({"bad_column": [1]})}
+        tomorrow = today + pd.Timedelta(days=1)
+
+        try:
+            loader._write_parsed_response("heart_rate", df_dict, tomorrow)
+        except Exception:
+            pass
+
+        state = session.query(db_tables.SyncState).get(
+                                    (1, "heart_rate", "HeartRateIntraday"))
+        assert(state.watermark == today)
+
+        # ------------------ TEST 3 - Seeding from existing data --------------
+        session.query(db_tables.SyncState).delete()
+        session.commit()
+
+        loader.seed_sync_state()
+        watermarks = {(state.endpoint, state.table_name): state.watermark
+                      for state in session.query(db_tables.SyncState)}
+
+        assert(watermarks[("heart_rate", "HeartRateIntraday")] == today)
+        assert(watermarks[("activities", "ActivitiesDailySummary")] == today)
+        assert(("activities", "Activities") not in watermarks)  # empty table
+
+        session.get_bind().dispose()
+
+
+def test_loader_backfill():
+
+    with tempfile.TemporaryDirectory() as folder:
+
+        session = make_session(folder, num_days=10)
+        today = pd.to_datetime(datetime.date.today())
+
+        # ------------------ TEST 1 - Full history, newest days first ---------
+        fitbit = FakeFitbit()
+        Loader(session, fitbit).backfill()
+
+        assert(backfill.count_items(session) == (4 * 10, 4 * 10))
+        assert(len(dump_tables(session)["heart_rate_intraday"]) == 3 * 10)
+
+        heart_dates = [url.split("/date/")[1][:10] for url in fitbit.urls
+                       if "/heart/" in url]
+        assert(heart_dates == sorted(heart_dates, reverse=True))
+        assert(heart_dates[0] == today.strftime("%Y-%m-%d"))
+
+        # ------------------ TEST 2 - Resuming fetches nothing done -----------
+        fitbit = FakeFitbit()
+        Loader(session, fitbit).backfill()
+        assert(len(fitbit.urls) == 0)
+
+        # ------------------ TEST 3 - Interrupted backfill resumes ------------
+        # Days whose write failed stay pending, and are the only ones
+        # fetched again.
+        session.query(db_tables.BackfillItem).filter(
+            db_tables.BackfillItem.endpoint == "heart_rate",
+            db_tables.BackfillItem.date >= today - pd.Timedelta(days=2)
+            ).update({"done": False}, synchronize_session=False)
+        session.commit()
+
+        loader = Loader(session, FakeFitbit())
+        df_dict = {"HeartRateIntraday": pd.DataFrame({"bad_column": [1]})}
+        try:
+            loader._write_parsed_response("heart_rate", df_dict, today)
+        except Exception:
+            pass
+
+        assert(len(backfill.pending_dates(session, 1, "heart_rate")) == 3)
+
+        fitbit = FakeFitbit()
+        Loader(session, fitbit).backfill(newest_first=False)
+        assert(len(fitbit.urls) == 3)
+        assert(backfill.count_items(session) == (4 * 10, 4 * 10))
+
+        session.get_bind().dispose()
+
+
+def test_loader_backfill_gives_up_on_failing_days():
+
+    today = pd.to_datetime(datetime.date.today())
+    failing_day = today - pd.Timedelta(days=20)
+
+    class FailingFitbit(FakeFitbit):
+        def get_resource(self, url):
+            if "/heart/date/" + failing_day.strftime("%Y-%m-%d") in url:
+                raise retry.RetriesExhausted(ConnectionResetError(), 5)
+            return FakeFitbit.get_resource(self, url)
+
+    with tempfile.TemporaryDirectory() as folder:
+
+        session = make_session(folder, num_days=30)
+
+        # ------------------ TEST 1 - Failures of all batches are kept --------
+        loader = Loader(session, FailingFitbit())
+        loader.backfill()
+
+        assert(len(loader.failed_jobs) == 1)
+        assert(loader.failed_jobs[0][0] == "heart_rate")
+        assert(list(loader.failed_jobs[0][1]) == [failing_day])
+
+        # ------------------ TEST 2 - The day stays pending, unrewound --------
+        assert(backfill.pending_dates(session, 1, "heart_rate")
+               == [failing_day])
+        state = session.query(db_tables.SyncState).get(
+                                    (1, "heart_rate", "HeartRateIntraday"))
+        assert(state.watermark == today)
+
+        # updates go on from today, and the next backfill fetches the day
+        fitbit = FakeFitbit()
+        Loader(session, fitbit).run()
+        assert(len([url for url in fitbit.urls if "/heart/" in url]) == 2)
+
+        fitbit = FakeFitbit()
+        Loader(session, fitbit).backfill()
+        assert(len(fitbit.urls) == 1)
+        assert(backfill.pending_dates(session, 1, "heart_rate") == [])
+
+        session.get_bind().dispose()
+
+
+def test_loader_multiple_users():
+
+    with tempfile.TemporaryDirectory() as folder:
+
+        session = make_session(folder, num_days=10)
+        add_user(session, user_id=2, num_days=5)
+        today = pd.to_datetime(datetime.date.today())
+
+        # A Loader per user, with a session of its own.
+        Session = sessionmaker(bind=session.get_bind())
+        fitbits = {1: FakeFitbit(), 2: FakeFitbit()}
+        loaders = {user_id: Loader(Session(), fitbit, user_id=user_id)
+                   for user_id, fitbit in fitbits.items()}
+
+        # ------------------ TEST 1 - Each user from their start date ---------
+        for loader in loaders.values():
+            loader.run()
+
+        assert(len(fitbits[1].urls) == 3 * 10 + 1)
+        assert(len(fitbits[2].urls) == 3 * 5 + 1)
+
+        heart = dump_tables(session)["heart_rate_intraday"]
+        assert(heart.groupby("user_id").size().to_dict() == {1: 3 * 10,
+                                                             2: 3 * 5})
+
+        # same dates and times, kept apart by the user in the key
+        user_rows = {user_id: df.drop(columns="user_id").reset_index(
+                                                                drop=True)
+                     for user_id, df in heart.groupby("user_id")}
+        pd.testing.assert_frame_equal(user_rows[1].iloc[-3 * 5:].reset_index(
+                                                    drop=True), user_rows[2])
+
+        # ------------------ TEST 2 - Watermarks per user ---------------------
+        states = session.query(db_tables.SyncState).all()
+        assert(len(states) == 2 * 6)
+        assert(all(state.watermark == today for state in states))
+
+        # a user's run leaves the other's data alone
+        fitbits[1].urls = []
+        loaders[1].run()
+        assert(len(fitbits[1].urls) == 3 * 2 + 1)
+        assert(len(dump_tables(session)["heart_rate_intraday"]) == 3 * 15)
+
+        # ------------------ TEST 3 - Backfill queues per user ----------------
+        for loader in loaders.values():
+            loader.backfill()
+
+        assert(backfill.count_items(session, 1) == (4 * 10, 4 * 10))
+        assert(backfill.count_items(session, 2) == (4 * 5, 4 * 5))
+        assert(backfill.count_items(session) == (4 * 15, 4 * 15))
+
+        for loader in loaders.values():
+            loader.session.close()
+        session.get_bind().dispose()
+
+
+def test_backfill_progress():
+
+    now = [0]
+    progress = backfill.Progress(num_calls=100, clock=lambda: now[0])
+    assert(progress.eta() is None)
+
+    # 10 calls in the first hour leave 9 hours for the other 90
+    now[0] = 3600
+    progress.update(10)
+    assert(progress.calls_per_hour() == 10)
+    assert(progress.eta() == datetime.timedelta(hours=9))
+    assert("ETA 9:00:00" in progress.report(10, 40))
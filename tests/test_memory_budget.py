@@ -0,0 +1,49 @@
+"""
+Unit tests for the bound on parsed data waiting to be written.
+"""
+from memory_budget import MemoryBudget, frames_bytes
+import pandas as pd
+import threading
+
+
+def test_memory_budget():
+
+    budget = MemoryBudget(max_bytes=100)
+
+    # ------------------ TEST 1 - Acquire within the budget -------------------
+    budget.acquire(60)
+    assert(budget.held == 60)
+
+    # ------------------ TEST 2 - Going over the budget waits for a release ---
+    acquired = threading.Event()
+
+    def acquire():
+        budget.acquire(60)
+        acquired.set()
+
+    thread = threading.Thread(target=acquire)
+    thread.start()
+
+    assert(not acquired.wait(0.2))
+
+    budget.release(60)
+    assert(acquired.wait(5))
+    thread.join()
+
+    assert(budget.held == 60)
+    assert(budget.peak == 60)
+
+    # ------------------ TEST 3 - An item over the budget goes through alone --
+    budget.release(60)
+    budget.acquire(500)
+    assert(budget.held == 500)
+    budget.release(500)
+
+
+def test_frames_bytes():
+
+    df = pd.DataFrame({"bpm": range(100)}, dtype="int64")
+
+    assert(frames_bytes({"HeartRateIntraday": df, "Other": None})
+           == df.memory_usage(index=True, deep=True).sum())
+    assert(frames_bytes({}) == 0)
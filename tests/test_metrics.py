@@ -0,0 +1,116 @@
+"""
+Tests for the pipeline metrics, over a run against the local Fitbit API
+emulator.
+"""
+from fitbit_api import Fitbit
+from fitbit_emulator import FitbitEmulator
+from pipeline import Loader
+from rate_limiter import RateLimiter
+from tests.helpers import FakeClock, add_credentials, make_retrier
+from tests.helpers import make_session
+import db_tables
+import json
+import metrics
+import os
+import requests
+import tempfile
+
+
+def test_registry():
+
+    registry = metrics.Registry()
+    registry.inc("api_requests_total", status="200")
+    registry.inc("api_requests_total", 2, status="200")
+    registry.inc("api_requests_total", status="500")
+    for seconds in [0.001, 0.2, 3]:
+        registry.observe("parse_seconds", seconds, endpoint="sleep")
+
+    # ------------------ TEST 1 - Totals over labels --------------------------
+    totals = registry.totals()
+    assert(totals["api_requests_total"] == 4)
+    assert(totals["parse_seconds_count"] == 3)
+    assert(abs(totals["parse_seconds_sum"] - 3.201) < 1e-9)
+
+    # ------------------ TEST 2 - Prometheus text format ----------------------
+    lines = registry.to_prometheus().splitlines()
+    assert("# TYPE api_requests_total counter" in lines)
+    assert('api_requests_total{status="200"} 3' in lines)
+    assert("# TYPE parse_seconds histogram" in lines)
+    assert('parse_seconds_bucket{endpoint="sleep",le="0.005"} 1' in lines)
+    assert('parse_seconds_bucket{endpoint="sleep",le="0.25"} 2' in lines)
+    assert('parse_seconds_bucket{endpoint="sleep",le="+Inf"} 3' in lines)
+    assert('parse_seconds_count{endpoint="sleep"} 3' in lines)
+
+    # ------------------ TEST 3 - Served over HTTP ----------------------------
+    server = metrics.serve(0, registry)
+    try:
+        host, port = server.server_address
+        assert(host == "127.0.0.1")  # local clients only, by default
+        response = requests.get("http://127.0.0.1:{}/metrics".format(port))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert(response.text == registry.to_prometheus())
+
+
+def test_run_summary():
+
+    clock = FakeClock(start=0)
+    emulator = FitbitEmulator(clock=clock.time,
+                              faults={"/heart/": [503]}).start()
+
+    with tempfile.TemporaryDirectory() as folder:
+        try:
+            session = make_session(folder, num_days=10)
+            add_credentials(session)
+            fitbit = Fitbit(session, base_url=emulator.url,
+                            rate_limiter=RateLimiter(clock=clock.time,
+                                                     sleep=clock.sleep))
+            loader = Loader(session, fitbit, retrier=make_retrier(clock))
+
+            metrics_file = os.path.join(folder, "metrics.json")
+            with metrics.run_summary(session, "update", metrics_file):
+                loader.run()
+
+            # ------------------ TEST 1 - Run totals are stored --------------
+            run = session.query(db_tables.PipelineRun).one()
+
+            assert(run.run_type == "update")
+            assert(run.error is None)
+            assert(run.api_calls == 3 * 10 + 1 + 1)  # one 503 retried
+            assert(run.api_bytes > 0)
+            assert(run.rows_written == sum(
+                        session.query(table).count()
+                        for endpoint in loader.endpoints.values()
+                        for table in endpoint.db_tables.values()))
+            assert(run.rows_written > 2 * 1440 * 10)
+            assert(run.failed_jobs == 0)
+            assert(run.retry_sleep_seconds == 5)
+            assert(run.parse_seconds > 0)
+            assert(run.db_seconds > 0)
+            assert(run.duration_seconds >= run.parse_seconds + run.db_seconds)
+
+            # ------------------ TEST 2 - Metrics file -----------------------
+            with open(metrics_file) as f:
+                dumped = json.load(f)
+
+            names = {counter["name"] for counter in dumped["counters"]}
+            assert("rows_written_total" in names)
+            assert("api_requests_total" in names)
+
+            # ------------------ TEST 3 - Failed runs are stored too ---------
+            try:
+                with metrics.run_summary(session, "update"):
+                    raise ValueError("boom")
+            except ValueError:
+                pass
+
+            run = session.query(db_tables.PipelineRun).filter(
+                                    db_tables.PipelineRun.id == 2).one()
+            assert("boom" in run.error)
+            assert(run.api_calls == 0)
+
+        finally:
+            emulator.stop()
+            session.get_bind().dispose()
@@ -0,0 +1,138 @@
+"""
+Unit tests for the read-side queries over the warehouse tables.
+"""
+from db_tables import SleepIntraday
+from pipeline import Loader
+from query import LRUCache, Query
+from sinks import DatabaseSink
+from tests.helpers import FakeClock, FakeFitbit, dump_tables
+from tests.helpers import make_session
+import pandas as pd
+import pytest
+import tempfile
+
+
+def test_lru_cache():
+
+    clock = FakeClock()
+    cache = LRUCache(max_entries=2, ttl_seconds=10, clock=clock.time)
+
+    # ------------------ TEST 1 - Least recently used entries go first --------
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert(cache.get("a") == 1)
+
+    cache.put("c", 3)
+    assert(cache.get("b") is None)
+    assert((cache.get("a"), cache.get("c")) == (1, 3))
+    assert((cache.hits, cache.misses) == (3, 1))
+
+    # ------------------ TEST 2 - Entries expire ------------------------------
+    clock.now = 10
+    assert(cache.get("a") is None)
+
+
+def test_query():
+
+    with tempfile.TemporaryDirectory() as folder:
+
+        session = make_session(folder, num_days=10)
+        Loader(session, FakeFitbit()).run()
+
+        raw = dump_tables(session)
+        today = pd.to_datetime("today").normalize()
+        start = today - pd.Timedelta(days=9)
+
+        clock = FakeClock()
+        query = Query(session, ttl_seconds=60, clock=clock.time)
+
+        # ------------------ TEST 1 - Heart rate from the rollups -------------
+        heart = raw["heart_rate_intraday"].set_index("time")["bpm"]
+
+        hourly = query.heart_rate(1, start, today, "hour")
+        expected = heart.groupby(heart.index.floor("H")).agg(
+                                            ["min", "max", "mean", "count"])
+
+        assert(list(hourly.index) == list(expected.index))
+        assert(list(hourly["bpm_min"]) == list(expected["min"]))
+        assert(list(hourly["bpm_max"]) == list(expected["max"]))
+        assert(list(hourly["bpm_mean"]) == list(expected["mean"]))
+        assert(list(hourly["num_samples"]) == list(expected["count"]))
+
+        assert(len(query.heart_rate(1, start, today, "minute")) == 3 * 10)
+        assert(len(query.heart_rate(1, start, today, "day")) == 10)
+
+        # a range of dates, both included
+        daily = query.heart_rate(1, today - pd.Timedelta(days=1), today,
+                                 "day")
+        assert(list(daily.index) == [today - pd.Timedelta(days=1), today])
+
+        # ------------------ TEST 2 - Steps by minute, hour and day -----------
+        steps = raw["activities_steps_intraday"].set_index("time")[
+                                                                "num_steps"]
+
+        minutes = query.steps(1, start, today, "minute")
+        assert(list(minutes["num_steps"]) == list(steps))
+
+        daily = query.steps(1, start, today, "day")
+        assert(list(daily["num_steps"])
+               == list(steps.groupby(steps.index.floor("D")).sum()))
+
+        with pytest.raises(Exception):
+            query.steps(1, start, today, "week")
+
+        # ------------------ TEST 3 - Resting heart rate ----------------------
+        resting = query.resting_heart_rate(1, start, today)
+        assert(list(resting.index) == list(pd.date_range(start, today)))
+
+        # ------------------ TEST 4 - Minutes per sleep stage per night -------
+        sleep = pd.DataFrame({"date": today, "duration_seconds": [1800, 600],
+                              "sleep_stage": [1, 2]},
+                             index=pd.Index(pd.to_datetime(
+                                    [today, today + pd.Timedelta(hours=1)]),
+                                    name="time"))
+        DatabaseSink().write(session, SleepIntraday, sleep, today, 1)
+        session.commit()
+
+        nights = query.sleep_stages(1, start, today)
+        assert(list(nights.columns) == ["deep", "light"])
+        assert(list(nights.loc[today]) == [30, 10])
+
+        # ------------------ TEST 5 - Hot ranges come from the cache ----------
+        hits = query.cache.hits
+        again = query.heart_rate(1, start, today, "hour")
+
+        assert(query.cache.hits == hits + 1)
+        pd.testing.assert_frame_equal(again, hourly)
+
+        # results handed out are copies of the cached ones
+        again["bpm_min"] = 0
+        assert(list(query.heart_rate(1, start, today, "hour")["bpm_min"])
+               == list(expected["min"]))
+
+        # ------------------ TEST 6 - Cached results expire -------------------
+        clock.now = 60
+        misses = query.cache.misses
+        query.heart_rate(1, start, today, "hour")
+        assert(query.cache.misses == misses + 1)
+
+        session.get_bind().dispose()
+
+
+def test_query_as_arrow():
+
+    pytest.importorskip("pyarrow")  # optional dependency of as_arrow
+
+    with tempfile.TemporaryDirectory() as folder:
+
+        session = make_session(folder, num_days=2)
+        Loader(session, FakeFitbit()).run()
+
+        today = pd.to_datetime("today").normalize()
+        table = Query(session).steps(1, today - pd.Timedelta(days=1), today,
+                                     "hour", as_arrow=True)
+
+        assert(table.column_names == ["num_steps", "time"])
+        assert(table.num_rows == 2)
+
+        session.get_bind().dispose()
@@ -0,0 +1,139 @@
+"""
+Tests for the Fitbit API rate limiter, including a throughput comparison
+against fixed spacing between calls on the local Fitbit API emulator.
+"""
+from fitbit_emulator import FitbitEmulator
+from rate_limiter import RateLimiter
+from tests.helpers import FakeClock, make_fitbit
+import retry
+import threading
+import time
+
+
+class FixedSpacingLimiter:
+    """The former Fitbit throttling: sleep a fixed number of seconds before
+    each call, and until five minutes past the next hour after a 429.
+    """
+
+    def __init__(self, clock, seconds_between_calls=24):
+        self.clock = clock
+        self.seconds_between_calls = seconds_between_calls
+
+    def acquire(self):
+        self.clock.sleep(self.seconds_between_calls)
+
+    def update(self, headers):
+        pass
+
+    def on_rate_limited(self, headers):
+        now = self.clock.time()
+        self.clock.sleep((now // 3600 + 1) * 3600 + 300 - now)
+
+
+def count_calls_over(seconds, make_limiter):
+    """Call the Fitbit API emulator repeatedly for the given simulated time,
+    returning the number of successful and of rate limited calls.
+    """
+    # start 20 minutes into an hour, so that the first window is partial
+    clock = FakeClock(start=1000 * 3600 + 1200)
+    emulator = FitbitEmulator(limit=150, latency=1, clock=clock.time,
+                              sleep=clock.sleep).start()
+
+    try:
+        fitbit = make_fitbit(make_limiter(clock))
+        end = clock.time() + seconds
+        while clock.time() < end:
+            fitbit.get_resource(emulator.url + "/1/user/-/profile.json")
+
+    finally:
+        emulator.stop()
+
+    return emulator.stats["success"], emulator.stats["rate_limited"]
+
+
+def test_rate_limiter_bursts_then_waits_for_reset():
+
+    clock = FakeClock(start=0)
+    limiter = RateLimiter(limit=150, clock=clock.time, sleep=clock.sleep)
+
+    # ------------------ TEST 1 - Burst while budget remains ------------------
+    limiter.update({"Fitbit-Rate-Limit-Remaining": "3",
+                    "Fitbit-Rate-Limit-Reset": "600"})
+    for _ in range(3):
+        limiter.acquire()
+
+    assert(clock.time() == 0)
+
+    # ------------------ TEST 2 - Sleep exactly until the reset ---------------
+    limiter.acquire()
+    assert(clock.time() == 600)
+
+    # ------------------ TEST 3 - Retry time after a 429 ----------------------
+    limiter.on_rate_limited({"Retry-After": "120"})
+    limiter.acquire()
+    assert(clock.time() == 720)
+
+
+def test_rate_limiter_wait_is_cut_short_when_stopped():
+
+    stop_event = threading.Event()
+    limiter = RateLimiter(limit=150, stop_event=stop_event)
+    limiter.on_rate_limited({"Fitbit-Rate-Limit-Reset": "3600"})
+
+    # an hour to wait, stopped after a tenth of a second
+    threading.Timer(0.1, stop_event.set).start()
+    start = time.time()
+
+    try:
+        limiter.acquire()
+        assert(False)
+    except retry.Stopped:
+        pass
+
+    assert(time.time() - start < 1)
+
+
+def test_rate_limiter_is_shared_across_threads():
+
+    clock = FakeClock(start=0)
+    limiter = RateLimiter(limit=150, clock=clock.time, sleep=clock.sleep)
+    limiter.update({"Fitbit-Rate-Limit-Remaining": "100",
+                    "Fitbit-Rate-Limit-Reset": "3600"})
+
+    granted = []
+
+    def take_tokens():
+        for _ in range(20):
+            if limiter.reserve() == 0:
+                granted.append(1)
+
+    threads = [threading.Thread(target=take_tokens) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # 160 attempts, but only the 100 calls left in the budget go through
+    assert(len(granted) == 100)
+
+
+def test_rate_limiter_throughput_against_fixed_spacing():
+
+    three_hours = 3 * 3600
+
+    def header_limiter(clock):
+        return RateLimiter(clock=clock.time, sleep=clock.sleep)
+
+    def fixed_limiter(clock):
+        return FixedSpacingLimiter(clock, seconds_between_calls=24)
+
+    num_calls, num_rate_limited = count_calls_over(three_hours,
+                                                   header_limiter)
+    fixed_num_calls, _ = count_calls_over(three_hours, fixed_limiter)
+
+    # The full budget is used in each of the four (partial) hourly windows,
+    # while fixed spacing only gets in one call every 25 seconds.
+    assert(num_calls >= 600)
+    assert(num_rate_limited == 0)
+    assert(fixed_num_calls == three_hours // 25)
+    assert(num_calls > fixed_num_calls)
@@ -261,6 +261,32 @@ def test_parse_heart_rate_response():
     # test heart rate dataframe
     assert(df_heart is None)
 
+    # ----------------- TEST 3 - missing intraday dict ------------------------
+    response = {'activities-heart': []}
+
+    # apply parsing function
+    df_dict = parser.parse_heart_rate_response(response, date)
+
+    # test heart rate dataframe
+    assert(df_dict["HeartRateIntraday"] is None)
+
+    # ----------------- TEST 4 - missing value --------------------------------
+    response = {'activities-heart-intraday':{
+                    'dataset': [{'time': '00:00:00', 'value': 69},
+                                {'time': '00:01:00'}],
+                    'datasetInterval': 1,
+                    'datasetType': 'minute'}
+    }
+
+    # apply parsing function
+    df_dict = parser.parse_heart_rate_response(response, date)
+    df_heart = df_dict["HeartRateIntraday"]
+
+    # test heart rate dataframe: the missing value is null
+    assert(df_heart.shape == (2, 2))
+    assert(df_heart["bpm"].iloc[0] == 69)
+    assert(np.isnan(df_heart["bpm"].iloc[1]))
+
 
 def test_parse_sleep_response():
 
@@ -764,3 +790,64 @@ def test_parse_sleep_response():
     # test intraday dataframe
     assert(df_intraday.shape == (57, 3))
     pd.testing.assert_frame_equal(df_intraday, df_intraday_answer)
+
+
+def test_split_sleep_range_response():
+
+    parser = ResponseParser()
+
+    # ------------------ TEST 1 - Two records on one night, none on the next --
+    dates = pd.date_range(start='2021-07-24', end='2021-07-25')
+
+    def sleep_record(end_time, minutes_asleep, time_in_bed, deep, light):
+        return {
+            'dateOfSleep': '2021-07-24',
+            'endTime': end_time,
+            'levels': {
+                'data': [{'dateTime': '2021-07-24T00:32:30.000',
+                          'level': 'light', 'seconds': 720}],
+                'summary': {
+                    'deep': {'count': 1, 'minutes': deep},
+                    'light': {'count': 1, 'minutes': light},
+                    'rem': {'count': 0, 'minutes': 0},
+                    'wake': {'count': 0, 'minutes': 0}
+                    }
+                },
+            'minutesAsleep': minutes_asleep,
+            'timeInBed': time_in_bed,
+            'type': 'stages'
+            }
+
+    response = {'sleep': [
+        sleep_record('2021-07-24T10:26:30.000', 257, 297, 53, 175),
+        sleep_record('2021-07-24T04:22:30.000', 188, 230, 36, 122)
+        ]}
+
+    # apply split function
+    responses = parser.split_sleep_range_response(response, dates)
+
+    # test the night with sleep data
+    summary = responses[pd.to_datetime('2021-07-24')]['summary']
+    assert(len(responses[pd.to_datetime('2021-07-24')]['sleep']) == 2)
+    assert(summary == {
+        'totalMinutesAsleep': 445,
+        'totalSleepRecords': 2,
+        'totalTimeInBed': 527,
+        'stages': {'deep': 89, 'light': 297, 'rem': 0, 'wake': 0}
+        })
+
+    # test the night without sleep data
+    assert(responses[pd.to_datetime('2021-07-25')] == {
+        'sleep': [],
+        'summary': {'totalMinutesAsleep': 0,
+                    'totalSleepRecords': 0,
+                    'totalTimeInBed': 0}
+        })
+
+    # the split responses go through the single day parser
+    df_dict = parser.parse_sleep_response(
+                            responses[pd.to_datetime('2021-07-24')],
+                            pd.to_datetime('2021-07-24'))
+    df_summary = df_dict["SleepDailySummary"]
+    assert(df_summary["sleepBreakTimes"].iloc[0] == "2021-07-24T04:22:30.000")
+    assert(df_summary["deepMinutes"].iloc[0] == 89)
@@ -0,0 +1,84 @@
+"""
+Unit tests for the on-disk store of raw API responses.
+"""
+from response_store import ResponseStore
+import datetime
+import os
+import pandas as pd
+import tempfile
+
+
+def test_response_store():
+
+    with tempfile.TemporaryDirectory() as folder:
+
+        store = ResponseStore(folder)
+        date = pd.to_datetime("2020-05-01")
+        response = {'activities-heart-intraday': {
+                        'dataset': [{'time': '00:00:00', 'value': 69}]}}
+
+        # ------------------ TEST 1 - Round trip ------------------------------
+        store.put("heart_rate", date, response,
+                  fetched_at=datetime.datetime(2020, 5, 1, 23, 0))
+
+        assert(store.get("heart_rate", date) == response)
+        assert(store.get("heart_rate", pd.to_datetime("2020-05-02")) is None)
+        assert(store.get("steps", date) is None)
+        assert(store.dates("heart_rate") == [date])
+
+        # ------------------ TEST 2 - Identical content is stored once --------
+        store.put("heart_rate", pd.to_datetime("2020-05-02"), response)
+
+        objects = [f for _, _, files in os.walk(os.path.join(folder, "objects"))
+                   for f in files]
+        assert(len(objects) == 1)
+        assert(store.dates("heart_rate") == [date,
+                                             pd.to_datetime("2020-05-02")])
+
+        # ------------------ TEST 3 - Freshness policy ------------------------
+        # fetched on the day itself: not final
+        assert(not store.is_final("heart_rate", date, final_after_days=2))
+
+        # fetched two days later: final
+        store.put("heart_rate", date, response,
+                  fetched_at=datetime.datetime(2020, 5, 3, 0, 30))
+        assert(store.is_final("heart_rate", date, final_after_days=2))
+
+        # never fetched: not final
+        assert(not store.is_final("steps", date, final_after_days=2))
+
+
+def test_response_store_moves_single_user_refs_to_user_1():
+
+    with tempfile.TemporaryDirectory() as folder:
+
+        date = pd.to_datetime("2020-05-01")
+        next_date = pd.to_datetime("2020-05-02")
+        old_response = {"sleep": []}
+        new_response = {"sleep": [{"logId": 1}]}
+
+        # user 1 already has a newer response for the first day
+        ResponseStore(folder, user_id=1).put("sleep", date, new_response)
+
+        # references written before they were kept per user
+        legacy_store = ResponseStore(folder)
+        legacy_store.put("sleep", date, old_response)
+        legacy_store.put("sleep", next_date, old_response)
+
+        # ------------------ TEST 1 - Other users are left alone --------------
+        assert(ResponseStore(folder, user_id=2).dates("sleep") == [])
+        assert(legacy_store.dates("sleep") == [date, next_date])
+
+        # ------------------ TEST 2 - References move to user 1 ---------------
+        store = ResponseStore(folder, user_id=1)
+
+        assert(store.dates("sleep") == [date, next_date])
+        assert(store.get("sleep", next_date) == old_response)
+        assert(os.listdir(os.path.join(folder, "refs")) == ["user_id=1"])
+
+        # ------------------ TEST 3 - Newer references are kept ---------------
+        assert(store.get("sleep", date) == new_response)
+
+        # opening it again finds nothing to move
+        store = ResponseStore(folder, user_id=1)
+        assert(store.dates("sleep") == [date, next_date])
@@ -0,0 +1,381 @@
+"""
+Tests for the retries of failed API calls, against faults injected by the
+local Fitbit API emulator.
+"""
+from fitbit_api import Fitbit
+from fitbit_emulator import FitbitEmulator
+from pipeline import Loader
+from rate_limiter import RateLimiter
+from sinks import DatabaseSink
+from tests.helpers import FakeClock, add_credentials, dump_tables
+from tests.helpers import make_memory_session, make_retrier, make_session
+import datetime
+import db_tables
+import emulator_payloads
+import pandas as pd
+import requests
+import retry
+import tempfile
+import threading
+import time
+
+
+def http_error(status):
+    response = requests.Response()
+    response.status_code = status
+    return requests.exceptions.HTTPError(response=response)
+
+
+def failing(errors):
+    """A function raising the given errors in turn, then returning "ok"."""
+    errors = list(errors)
+
+    def function():
+        if errors:
+            raise errors.pop(0)
+        return "ok"
+
+    return function
+
+
+def test_retrier():
+
+    # ------------------ TEST 1 - Error classes -------------------------------
+    assert(retry.classify(http_error(503)) == "server_error")
+    assert(retry.classify(http_error(429)) == "rate_limited")
+    assert(retry.classify(http_error(404)) is None)
+    assert(retry.classify(requests.exceptions.ReadTimeout()) == "timeout")
+    assert(retry.classify(requests.exceptions.ConnectTimeout()) == "timeout")
+    assert(retry.classify(ConnectionResetError()) == "connection")
+    assert(retry.classify(KeyError()) is None)
+
+    # ------------------ TEST 2 - Exponential backoff -------------------------
+    clock = FakeClock(start=0)
+    retrier = make_retrier(clock)
+    function = failing([http_error(503), http_error(502), http_error(500)])
+
+    assert(retrier.call(function) == "ok")
+    assert(clock.time() == 5 + 10 + 20)
+
+    # ------------------ TEST 3 - Other errors are raised right away ----------
+    function = failing([http_error(404)])
+    try:
+        retrier.call(function)
+        assert(False)
+    except requests.exceptions.HTTPError as e:
+        assert(e.response.status_code == 404)
+
+    # ------------------ TEST 4 - Giving up -----------------------------------
+    function = failing([requests.exceptions.ReadTimeout()] * 10)
+    try:
+        retrier.call(function)
+        assert(False)
+    except retry.RetriesExhausted as e:
+        assert(e.attempts == 5)
+        assert(isinstance(e.error, requests.exceptions.ReadTimeout))
+
+    # ------------------ TEST 5 - Retry budget --------------------------------
+    retrier = make_retrier(clock, max_retries=3)
+    function = failing([ConnectionResetError()] * 2)
+    assert(retrier.call(function) == "ok")
+
+    # a single retry left
+    function = failing([ConnectionResetError()] * 2)
+    try:
+        retrier.call(function)
+        assert(False)
+    except retry.RetriesExhausted as e:
+        assert(e.attempts == 2)
+
+
+def test_fitbit_retries_faults():
+
+    clock = FakeClock(start=0)
+    emulator = FitbitEmulator(clock=clock.time, slow_seconds=0.5,
+                              faults={"profile": [503, "reset", "slow", 429]})
+    emulator.start()
+
+    try:
+        session = make_memory_session()
+        add_credentials(session)
+        fitbit = Fitbit(session, timeout=0.2,
+                        rate_limiter=RateLimiter(clock=clock.time,
+                                                 sleep=clock.sleep))
+        retrier = make_retrier(clock)
+
+        payload = retrier.call(fitbit.get_resource,
+                               emulator.url + "/1/user/-/profile.json")
+
+    finally:
+        emulator.stop()
+
+    assert(payload == emulator_payloads.profile_response())
+    assert(emulator.stats["errors"] == 4)
+    assert(emulator.stats["success"] == 1)
+    assert(retrier.budget.retries == 4)
+
+    # the 429 held the next call until the next hour
+    assert(clock.time() == 3600)
+
+
+def test_loader_gives_up_on_failing_days_only():
+
+    clock = FakeClock(start=0)
+    today = pd.to_datetime(datetime.date.today())
+    failing_day = (today - pd.Timedelta(days=5)).strftime("%Y-%m-%d")
+
+    emulator = FitbitEmulator(
+                clock=clock.time,
+                faults={"/heart/date/" + failing_day: [500] * 5,
+                        "/steps/date/" + failing_day: [503, 502]})
+    emulator.start()
+
+    with tempfile.TemporaryDirectory() as folder:
+        try:
+            session = make_session(folder, num_days=10)
+            add_credentials(session)
+            fitbit = Fitbit(session, base_url=emulator.url,
+                            rate_limiter=RateLimiter(clock=clock.time,
+                                                     sleep=clock.sleep))
+            loader = Loader(session, fitbit, retrier=make_retrier(clock))
+
+            # ------------------ TEST 1 - Only failing calls are retried -----
+            loader.run()
+
+            # every call went through, but the heart rate of the failing day
+            assert(len(emulator.paths) == 3 * 10 + 1 - 1)
+            assert(emulator.stats["errors"] == 5 + 2)
+            tables = dump_tables(session)
+            assert(len(tables["activities_steps_intraday"]) == 1440 * 10)
+            assert(len(tables["heart_rate_intraday"]) == 1440 * 9)
+
+            # ------------------ TEST 2 - Days given up on are fetched again -
+            assert(len(loader.failed_jobs) == 1)
+            assert(loader.failed_jobs[0][0] == "heart_rate")
+
+            state = session.query(db_tables.SyncState).get(
+                                    (1, "heart_rate", "HeartRateIntraday"))
+            assert(state.watermark == pd.to_datetime(failing_day)
+                                      - pd.Timedelta(days=1))
+
+            emulator.paths = []
+            loader.run()
+
+            heart_paths = [path for path in emulator.paths
+                           if "/heart/" in path]
+            # from the padding day before the watermark, i.e. 7 days ago, on
+            assert(len(heart_paths) == 8)
+            assert(len(dump_tables(session)["heart_rate_intraday"])
+                   == 1440 * 10)
+            assert(loader.failed_jobs == [])
+
+        finally:
+            emulator.stop()
+            session.get_bind().dispose()
+
+
+class FailingSink(DatabaseSink):
+    """A database sink failing to write the given table on the given day."""
+
+    def __init__(self, table, date):
+        DatabaseSink.__init__(self)
+        self.table = table
+        self.date = date
+
+    def write(self, session, table, dataframe, date, user_id):
+        if table is self.table and date == self.date:
+            raise Exception("Disk full")
+        return DatabaseSink.write(self, session, table, dataframe, date,
+                                  user_id)
+
+
+def test_loader_gives_up_on_failing_days_when_a_later_job_raises():
+
+    today = pd.to_datetime(datetime.date.today())
+    failing_day = (today - pd.Timedelta(days=5)).strftime("%Y-%m-%d")
+
+    # sequentially, then with fetching threads
+    for workers in [1, 2]:
+
+        clock = FakeClock(start=0)
+        emulator = FitbitEmulator(
+                    clock=clock.time,
+                    faults={"/heart/date/" + failing_day: [503] * 5})
+        emulator.start()
+
+        with tempfile.TemporaryDirectory() as folder:
+            try:
+                session = make_session(folder, num_days=10)
+                add_credentials(session)
+                fitbit = Fitbit(session, base_url=emulator.url,
+                                rate_limiter=RateLimiter(clock=clock.time,
+                                                         sleep=clock.sleep))
+                sink = FailingSink(db_tables.ActivitiesStepsIntraday, today)
+                loader = Loader(session, fitbit, workers=workers,
+                                sinks=[sink], retrier=make_retrier(clock))
+
+                # ------------------ TEST 1 - The error is raised ------------
+                try:
+                    loader.run()
+                    assert(False)
+                except Exception as e:
+                    assert(str(e) == "Disk full")
+
+                # ------------------ TEST 2 - The day given up on is rewound -
+                assert(loader.failed_jobs[0][0] == "heart_rate")
+                assert(len(dump_tables(session)["heart_rate_intraday"])
+                       == 1440 * 9)
+
+                state = session.query(db_tables.SyncState).get(
+                                    (1, "heart_rate", "HeartRateIntraday"))
+                assert(state.watermark == pd.to_datetime(failing_day)
+                                          - pd.Timedelta(days=1))
+
+                # ------------------ TEST 3 - And fetched by the next run ----
+                sink.date = None
+                loader.run()
+
+                assert(len(dump_tables(session)["heart_rate_intraday"])
+                       == 1440 * 10)
+                assert(loader.failed_jobs == [])
+
+            finally:
+                emulator.stop()
+                session.get_bind().dispose()
+
+
+def test_loader_rewinds_days_written_out_of_order_before_an_error():
+
+    today = pd.to_datetime(datetime.date.today())
+    failing_day = today - pd.Timedelta(days=5)
+
+    # the failing day comes in late, after later days were written
+    clock = FakeClock(start=0)
+    emulator = FitbitEmulator(
+                clock=clock.time, slow_seconds=0.5,
+                faults={"/heart/date/" + failing_day.strftime("%Y-%m-%d"):
+                        ["slow"]})
+    emulator.start()
+
+    with tempfile.TemporaryDirectory() as folder:
+        try:
+            session = make_session(folder, num_days=10)
+            add_credentials(session)
+            fitbit = Fitbit(session, base_url=emulator.url,
+                            rate_limiter=RateLimiter(clock=clock.time,
+                                                     sleep=clock.sleep))
+            sink = FailingSink(db_tables.HeartRateIntraday, failing_day)
+            loader = Loader(session, fitbit, workers=2, sinks=[sink],
+                            retrier=make_retrier(clock))
+
+            # ------------------ TEST 1 - The error is raised ----------------
+            try:
+                loader.run()
+                assert(False)
+            except Exception as e:
+                assert(str(e) == "Disk full")
+
+            heart_rate = dump_tables(session)["heart_rate_intraday"]
+            assert((heart_rate["date"] > failing_day).any())
+
+            # ------------------ TEST 2 - Rewound before the failed day ------
+            state = session.query(db_tables.SyncState).get(
+                                    (1, "heart_rate", "HeartRateIntraday"))
+            assert(state.watermark == failing_day - pd.Timedelta(days=1))
+
+            # ------------------ TEST 3 - And fetched by the next run --------
+            sink.date = None
+            loader.run()
+
+            assert(len(dump_tables(session)["heart_rate_intraday"])
+                   == 1440 * 10)
+            assert(loader.failed_jobs == [])
+
+        finally:
+            emulator.stop()
+            session.get_bind().dispose()
+
+
+def test_loader_gives_up_on_refused_endpoints_only():
+
+    # sequentially, then with fetching threads
+    for workers in [1, 2]:
+
+        # the token lacks the scope of the heart rate
+        emulator = FitbitEmulator(faults={"/heart/": [403] * 10})
+        emulator.start()
+
+        with tempfile.TemporaryDirectory() as folder:
+            try:
+                session = make_session(folder, num_days=10)
+                add_credentials(session)
+                fitbit = Fitbit(session, base_url=emulator.url)
+                loader = Loader(session, fitbit, workers=workers)
+
+                # ------------------ TEST 1 - The other endpoints go on ------
+                loader.run()
+
+                tables = dump_tables(session)
+                assert(len(tables["activities_steps_intraday"]) == 1440 * 10)
+                assert(len(tables["activities_daily_summary"]) == 10)
+                assert(len(tables["heart_rate_intraday"]) == 0)
+
+                # ------------------ TEST 2 - The refused calls are failed ---
+                # a call per day, none retried
+                assert(emulator.stats["errors"] == 10)
+                assert(len(loader.failed_jobs) == 10)
+                assert(all(endpoint_name == "heart_rate"
+                           for endpoint_name, window in loader.failed_jobs))
+
+                assert(session.query(db_tables.SyncState).get(
+                        (1, "heart_rate", "HeartRateIntraday")) is None)
+
+            finally:
+                emulator.stop()
+                session.get_bind().dispose()
+
+
+def test_stop_cuts_retry_and_rate_limit_waits_short():
+
+    # ------------------ TEST 1 - Waiting to retry ----------------------------
+    stop_event = threading.Event()
+    retrier = retry.Retrier(random=lambda: 1.0, stop_event=stop_event)
+    function = failing([http_error(503)])
+
+    # 5 seconds to wait, stopped after a tenth of a second
+    threading.Timer(0.1, stop_event.set).start()
+    start = time.time()
+
+    try:
+        retrier.call(function)
+        assert(False)
+    except retry.Stopped as e:
+        assert(e.__cause__.response.status_code == 503)
+
+    assert(time.time() - start < 1)
+
+    # ------------------ TEST 2 - Loader.stop() during a rate limit wait ------
+    emulator = FitbitEmulator().start()
+
+    with tempfile.TemporaryDirectory() as folder:
+        try:
+            session = make_session(folder, num_days=10)
+            add_credentials(session)
+            fitbit = Fitbit(session, base_url=emulator.url)
+            loader = Loader(session, fitbit)
+
+            # the budget is spent for the next hour
+            fitbit.rate_limiter.on_rate_limited(
+                                    {"Fitbit-Rate-Limit-Reset": "3600"})
+
+            threading.Timer(0.1, loader.stop).start()
+            start = time.time()
+            loader.run()
+
+            assert(time.time() - start < 2)
+            assert(emulator.paths == [])
+            assert(loader.failed_jobs == [])
+
+        finally:
+            emulator.stop()
+            session.get_bind().dispose()
@@ -0,0 +1,234 @@
+"""
+Unit tests for the rollups of the intraday tables.
+"""
+from db_tables import ActivitiesStepsRollup, HeartRateIntraday
+from db_tables import HeartRateRollup, SleepIntraday, SleepStageRollup
+from pipeline import Loader
+from sinks import DatabaseSink
+from tests.helpers import FakeFitbit, add_user, heart_rate_day
+from tests.helpers import make_memory_session, make_session
+import db_migrations
+import db_upsert
+import pandas as pd
+import rollups
+import tempfile
+
+
+def dump_rollups(session):
+    tables = [HeartRateRollup, ActivitiesStepsRollup, SleepStageRollup]
+    return {table.__tablename__: pd.read_sql_table(
+                    table.__tablename__, session.get_bind()).sort_values(
+                    db_upsert.primary_key_names(table), ignore_index=True)
+            for table in tables}
+
+
+def test_heart_rate_and_steps_rollups():
+
+    date = pd.to_datetime("2021-07-24")
+    df = heart_rate_day(date, [60, 70, 80, 90], freq="20min")
+
+    # ------------------ TEST 1 - Heart rate by minute, hour and day ----------
+    rollup = rollups.heart_rate_rollup(df)
+
+    assert(list(rollup.index.names) == ["resolution", "time"])
+    assert(len(rollup.loc["minute"]) == 4)
+
+    hours = rollup.loc["hour"]
+    assert(list(hours.index) == [date, date + pd.Timedelta(hours=1)])
+    assert(list(hours["bpm_min"]) == [60, 90])
+    assert(list(hours["bpm_max"]) == [80, 90])
+    assert(list(hours["bpm_mean"]) == [70, 90])
+    assert(list(hours["num_samples"]) == [3, 1])
+
+    day = rollup.loc["day"].iloc[0]
+    assert((day["bpm_min"], day["bpm_max"], day["num_samples"]) == (60, 90, 4))
+    assert(day["bpm_mean"] == 75)
+    assert((rollup["date"] == date).all())
+
+    # ------------------ TEST 2 - Steps by hour and day -----------------------
+    steps = df.rename(columns={"bpm": "num_steps"})
+    rollup = rollups.steps_rollup(steps)
+
+    assert(list(rollup.index.get_level_values("resolution").unique())
+           == ["hour", "day"])
+    assert(list(rollup.loc["hour", "num_steps"]) == [210, 90])
+    assert(list(rollup.loc["day", "num_steps"]) == [300])
+
+    # ------------------ TEST 3 - Several users and days in one pass ----------
+    other_date = date + pd.Timedelta(days=1)
+    days = pd.concat([df.assign(user_id=1),
+                      heart_rate_day(other_date, [50], freq="20min",
+                                     user_id=1),
+                      heart_rate_day(date, [100, 110], freq="20min",
+                                     user_id=2)])
+    rollup = rollups.heart_rate_rollup(days)
+
+    hours = rollup.loc["hour"]
+    assert(list(hours["user_id"]) == [1, 1, 1, 2])
+    assert(list(hours["date"]) == [date, date, other_date, date])
+    assert(list(hours["bpm_mean"]) == [70, 90, 50, 105])
+    assert(list(rollup.loc["day", "num_samples"]) == [4, 1, 2])
+
+
+def test_sleep_stage_rollup():
+
+    date = pd.to_datetime("2021-07-24")
+    times = pd.to_datetime(["2021-07-23 23:00:00", "2021-07-23 23:30:00",
+                            "2021-07-24 01:00:00"])
+    df = pd.DataFrame({"date": date, "duration_seconds": [1800, 5400, 600],
+                       "sleep_stage": [2, 1, 2]},
+                      index=pd.Index(times, name="time"))
+
+    rollup = rollups.sleep_stage_rollup(df)
+
+    assert(list(rollup.index) == [(date, 1), (date, 2)])
+    assert(list(rollup["duration_seconds"]) == [5400, 2400])
+
+
+def test_database_sink_writes_rollups():
+
+    session = make_memory_session()
+    sink = DatabaseSink()
+    date = pd.to_datetime("2021-07-24")
+
+    def hourly_means():
+        rows = session.query(HeartRateRollup).filter(
+                    HeartRateRollup.resolution == "hour").order_by(
+                    HeartRateRollup.time)
+        return [row.bpm_mean for row in rows]
+
+    # ------------------ TEST 1 - Rollups come with the intraday rows ---------
+    sink.write(session, HeartRateIntraday,
+               heart_rate_day(date, [60, 70], freq="20min"), date, 1)
+    session.commit()
+
+    assert(hourly_means() == [65])
+
+    # ------------------ TEST 2 - A day written again updates its rollups -----
+    sink.write(session, HeartRateIntraday,
+               heart_rate_day(date, [60, 70, 80, 90], freq="20min"), date, 1)
+    session.commit()
+
+    assert(hourly_means() == [70, 90])
+    assert(session.query(HeartRateRollup).count() == 4 + 2 + 1)
+
+    # ------------------ TEST 3 - In the same transaction ---------------------
+    other_date = pd.to_datetime("2021-07-25")
+    sink.write(session, HeartRateIntraday,
+               heart_rate_day(other_date, [50], freq="20min"), other_date, 1)
+    session.rollback()
+
+    assert(session.query(HeartRateIntraday).count() == 4)
+    assert(session.query(HeartRateRollup).count() == 4 + 2 + 1)
+
+    # ------------------ TEST 4 - Rollups can be turned off -------------------
+    times = pd.to_datetime(["2021-07-24 01:00:00"])
+    sleep = pd.DataFrame({"date": date, "duration_seconds": [600],
+                          "sleep_stage": [2]},
+                         index=pd.Index(times, name="time"))
+
+    DatabaseSink(rollups=False).write(session, SleepIntraday, sleep, date, 1)
+    session.commit()
+
+    assert(session.query(SleepIntraday).count() == 1)
+    assert(session.query(SleepStageRollup).count() == 0)
+
+    # ------------------ TEST 5 - Unchanged days keep their rollups -----------
+    session.query(HeartRateRollup).update({"bpm_mean": 0})
+    session.commit()
+
+    sink.write(session, HeartRateIntraday,
+               heart_rate_day(date, [60, 70, 80, 90], freq="20min"), date, 1)
+    session.commit()
+
+    assert(hourly_means() == [0, 0])
+
+    # ------------------ TEST 6 - A day left empty loses its rollups ----------
+    counts = sink.write(session, HeartRateIntraday, None, date, 1)
+    session.commit()
+
+    assert(counts["deleted"] == 4)
+    assert(session.query(HeartRateIntraday).count() == 0)
+    assert(session.query(HeartRateRollup).count() == 0)
+
+
+def test_rebuild_rollups():
+
+    with tempfile.TemporaryDirectory() as folder:
+
+        session = make_session(folder, num_days=40)
+        add_user(session, user_id=2, num_days=3)
+        for user_id in [1, 2]:
+            Loader(session, FakeFitbit(), user_id=user_id).run()
+
+        session.add(SleepIntraday(user_id=2, date=pd.to_datetime("2021-07-24"),
+                                  time=pd.to_datetime("2021-07-24 01:00:00"),
+                                  duration_seconds=600, sleep_stage=2))
+        session.commit()
+
+        maintained = dump_rollups(session)
+        engine = session.get_bind()
+
+        # ------------------ TEST 1 - Same rollups as maintained by the sink --
+        written = rollups.rebuild_rollups(engine, days_per_chunk=7)
+        rebuilt = dump_rollups(session)
+
+        for table in [HeartRateRollup, ActivitiesStepsRollup]:
+            name = table.__tablename__
+            pd.testing.assert_frame_equal(rebuilt[name], maintained[name])
+            assert(written[table.__name__] == len(maintained[name]))
+
+        # including the intraday rows written without the sink
+        assert(len(rebuilt["sleep_stage_rollup"])
+               == len(maintained["sleep_stage_rollup"]) + 1)
+
+        # ------------------ TEST 2 - An interrupted rebuild keeps the rest ---
+        calls = []
+
+        def failing_rollup(df):
+            calls.append(len(df))
+            if len(calls) == 2:
+                raise Exception("Interrupted")
+            return rollups.heart_rate_rollup(df)
+
+        rollups.ROLLUPS["HeartRateIntraday"] = (HeartRateRollup,
+                                                failing_rollup)
+        try:
+            rollups.rebuild_rollups(engine, days_per_chunk=7)
+            assert(False)
+        except Exception as e:
+            assert(str(e) == "Interrupted")
+        finally:
+            rollups.ROLLUPS["HeartRateIntraday"] = (HeartRateRollup,
+                                                    rollups.heart_rate_rollup)
+
+        # the first chunk was rebuilt, the second one left as it was
+        pd.testing.assert_frame_equal(
+            dump_rollups(session)["heart_rate_rollup"],
+            maintained["heart_rate_rollup"])
+
+        # ------------------ TEST 3 - Rollups without intraday rows are gone --
+        date = pd.to_datetime("today").normalize() - pd.Timedelta(days=100)
+        session.add(HeartRateRollup(user_id=1, resolution="day", time=date,
+                                    date=date, bpm_min=60, bpm_max=60,
+                                    bpm_mean=60, num_samples=1))
+        session.commit()
+
+        rollups.rebuild_rollups(engine, days_per_chunk=7)
+        pd.testing.assert_frame_equal(
+            dump_rollups(session)["heart_rate_rollup"],
+            maintained["heart_rate_rollup"])
+
+        # ------------------ TEST 4 - From the compact intraday tables --------
+        db_migrations.migrate_intraday_to_compact(engine)
+        session.query(HeartRateIntraday).delete()
+        session.commit()
+
+        rollups.rebuild_rollups(engine, compact_intraday=True)
+        rebuilt = dump_rollups(session)
+
+        pd.testing.assert_frame_equal(rebuilt["heart_rate_rollup"],
+                                      maintained["heart_rate_rollup"])
+
+        session.close()
+        engine.dispose()
@@ -0,0 +1,193 @@
+"""
+Tests for the scheduler of the daemon mode, on a simulated clock.
+"""
+from pipeline import Loader
+from scheduler import DailyAt, Every, Scheduler
+from tests.helpers import FakeClock, FakeFitbit, dump_tables
+from tests.helpers import make_memory_session, make_session
+import datetime
+import db_tables
+import os
+import signal
+import tempfile
+import threading
+
+
+class RecordingLoader:
+    """Record the endpoints updated on each run, and when."""
+
+    def __init__(self, clock, user_id=1, session=None):
+        self.clock = clock
+        self.user_id = user_id
+        self.runs = []
+
+        # for the run summaries
+        if session is None:
+            session = make_memory_session()
+        self.session = session
+
+    def run(self, endpoint_names):
+        self.runs.append((self.clock.time(), sorted(endpoint_names)))
+
+    def stop(self):
+        pass
+
+
+def run_for(scheduler, clock, seconds):
+    """Run the scheduler for the given simulated time."""
+    end = clock.time() + seconds
+
+    def sleep(seconds):
+        clock.sleep(seconds)
+        if clock.time() >= end:
+            scheduler.stop()
+
+    scheduler.sleep = sleep
+    scheduler.run_forever(handle_signals=False)
+
+
+def test_schedules():
+
+    start = datetime.datetime(2021, 7, 24, 8, 30).timestamp()
+
+    assert(Every(900).next_run(start) == start + 900)
+
+    # later that morning, then the next day once past
+    next_run = DailyAt(hour=9).next_run(start)
+    assert(next_run == datetime.datetime(2021, 7, 24, 9).timestamp())
+    assert(DailyAt(hour=9).next_run(next_run) ==
+           datetime.datetime(2021, 7, 25, 9).timestamp())
+
+
+def test_scheduler_runs_endpoints_on_their_schedule():
+
+    start = datetime.datetime(2021, 7, 24, 0, 0).timestamp()
+    clock = FakeClock(start=start)
+    loader = RecordingLoader(clock)
+    scheduler = Scheduler(loader, clock=clock.time, schedules={
+                                        "heart_rate": Every(15 * 60),
+                                        "activities": Every(60 * 60),
+                                        "sleep": DailyAt(hour=9)})
+
+    run_for(scheduler, clock, 24 * 3600)
+
+    runs = {name: [time for time, names in loader.runs if name in names]
+            for name in ["heart_rate", "activities", "sleep"]}
+
+    # ------------------ TEST 1 - Everything is updated at start --------------
+    assert(loader.runs[0] == (start, ["activities", "heart_rate", "sleep"]))
+
+    # ------------------ TEST 2 - Then each on its own schedule ---------------
+    assert(len(runs["heart_rate"]) == 24 * 4)
+    assert(len(runs["activities"]) == 24)
+    assert(runs["sleep"] == [start, start + 9 * 3600])
+
+    # endpoints due together share a single run
+    assert(len(loader.runs) == len(runs["heart_rate"]))
+
+    # ------------------ TEST 3 - Each run is summarized ----------------------
+    summaries = loader.session.query(db_tables.PipelineRun).all()
+    assert(len(summaries) == len(loader.runs))
+    assert(all(row.run_type == "scheduled" for row in summaries))
+
+
+def test_scheduler_fans_out_across_users():
+
+    start = datetime.datetime(2021, 7, 24, 0, 0).timestamp()
+    clock = FakeClock(start=start)
+    first = RecordingLoader(clock, user_id=1)
+    second = RecordingLoader(clock, user_id=2, session=first.session)
+
+    scheduler = Scheduler([first, second], clock=clock.time, schedules={
+                                        "heart_rate": Every(15 * 60),
+                                        "sleep": DailyAt(hour=9)})
+    run_for(scheduler, clock, 24 * 3600)
+
+    # ------------------ TEST 1 - Each user on the schedules ------------------
+    for loader in [first, second]:
+        assert(loader.runs[0] == (start, ["heart_rate", "sleep"]))
+        assert(len(loader.runs) == 24 * 4)
+
+    # ------------------ TEST 2 - A run summary per user run ------------------
+    summaries = first.session.query(db_tables.PipelineRun).all()
+    assert(len(summaries) == 2 * 24 * 4)
+    assert(sorted({row.user_id for row in summaries}) == [1, 2])
+
+
+def test_scheduler_runs_users_at_once():
+
+    class BlockedLoader(RecordingLoader):
+        """Hold its runs until the other user has run."""
+
+        def run(self, endpoint_names):
+            # only set meanwhile if users run at once
+            self.other_ran_meanwhile = other_ran.wait(timeout=5)
+            RecordingLoader.run(self, endpoint_names)
+
+    class OtherLoader(RecordingLoader):
+
+        def run(self, endpoint_names):
+            RecordingLoader.run(self, endpoint_names)
+            other_ran.set()
+
+    other_ran = threading.Event()
+    clock = FakeClock(start=0)
+    blocked = BlockedLoader(clock, user_id=1)
+    other = OtherLoader(clock, user_id=2, session=blocked.session)
+
+    # Real time, with runs far apart.
+    scheduler = Scheduler([blocked, other], workers=2,
+                          schedules={"heart_rate": Every(3600)})
+    thread = threading.Thread(target=scheduler.run_forever,
+                              kwargs={"handle_signals": False})
+    thread.start()
+
+    while not blocked.runs:
+        threading.Event().wait(0.01)
+
+    scheduler.stop()
+    thread.join(timeout=10)
+
+    # ------------------ TEST 1 - The other user is not held up ---------------
+    assert(blocked.other_ran_meanwhile)
+    assert(len(blocked.runs) == len(other.runs) == 1)
+
+    # ------------------ TEST 2 - Stopped while waiting -----------------------
+    assert(not thread.is_alive())
+
+
+def test_scheduler_stops_gracefully_on_sigterm():
+
+    class SignalingFitbit(FakeFitbit):
+        """Send SIGTERM to this process while fetching the 5th response."""
+
+        def get_resource(self, url):
+            if len(self.urls) == 4:
+                os.kill(os.getpid(), signal.SIGTERM)
+            return FakeFitbit.get_resource(self, url)
+
+    with tempfile.TemporaryDirectory() as folder:
+
+        session = make_session(folder, num_days=10)
+        fitbit = SignalingFitbit()
+        clock = FakeClock(start=0)
+        scheduler = Scheduler(Loader(session, fitbit), clock=clock.time,
+                              sleep=clock.sleep)
+
+        previous_handler = signal.getsignal(signal.SIGTERM)
+        scheduler.run_forever()
+
+        # ------------------ TEST 1 - The job in flight was written -----------
+        assert(scheduler.stopped())
+        assert(len(fitbit.urls) == 5)
+        assert(len(dump_tables(session)["heart_rate_intraday"]) == 3 * 5)
+
+        state = session.query(db_tables.SyncState).get(
+                                    (1, "heart_rate", "HeartRateIntraday"))
+        assert(state.watermark.date() == (datetime.date.today()
+                                          - datetime.timedelta(days=5)))
+
+        # ------------------ TEST 2 - Signal handlers were restored -----------
+        assert(signal.getsignal(signal.SIGTERM) == previous_handler)
+
+        session.get_bind().dispose()
@@ -0,0 +1,73 @@
+"""
+Tests for the sinks receiving parsed dataframes.
+"""
+from pipeline import Loader
+from sinks import DatabaseSink, ParquetSink
+from tests.helpers import FakeFitbit, dump_tables, make_session
+import db_tables
+import os
+import pandas as pd
+import pytest
+import tempfile
+
+pytest.importorskip("pyarrow")  # optional dependency of ParquetSink
+
+
+def test_parquet_sink():
+
+    with tempfile.TemporaryDirectory() as folder:
+
+        sink = ParquetSink(os.path.join(folder, "parquet"))
+        table = db_tables.HeartRateIntraday
+        date = pd.to_datetime("2021-07-24")
+        df = pd.DataFrame({"date": [date, date], "bpm": [69, 140]},
+                          index=pd.Index(pd.to_datetime(["2021-07-24 00:00",
+                                                         "2021-07-24 17:17"]),
+                                         name="time"))
+
+        # ------------------ TEST 1 - User and date partitioned day files -----
+        sink.write(None, table, df, date, 1)
+
+        path = sink.day_path("heart_rate_intraday", date, 1)
+        assert(path.endswith(os.path.join("heart_rate_intraday", "user_id=1",
+                                          "year=2021", "month=07",
+                                          "2021-07-24.parquet")))
+        pd.testing.assert_frame_equal(pd.read_parquet(path).set_index("time"),
+                                      df)
+
+        # ------------------ TEST 2 - Writing a day again replaces it ---------
+        sink.write(None, table, df.iloc[:1], date, 1)
+
+        assert(len(pd.read_parquet(path)) == 1)
+        assert(os.listdir(os.path.dirname(path)) == ["2021-07-24.parquet"])
+
+        # ------------------ TEST 3 - A day left empty is removed -------------
+        sink.write(None, table, None, date, 1)
+
+        assert(os.listdir(os.path.dirname(path)) == [])
+
+
+def test_loader_sinks():
+
+    with tempfile.TemporaryDirectory() as folder:
+
+        session = make_session(folder, num_days=10)
+        parquet_root = os.path.join(folder, "parquet")
+        sinks = [DatabaseSink(), ParquetSink(parquet_root)]
+
+        # Run twice: the padding day files are replaced, not duplicated.
+        Loader(session, FakeFitbit(), sinks=sinks).run()
+        Loader(session, FakeFitbit(), sinks=sinks).run()
+
+        database = dump_tables(session)["heart_rate_intraday"]
+        archive = pd.read_parquet(os.path.join(parquet_root,
+                                               "heart_rate_intraday"))
+
+        assert(len(archive) == 3 * 10)
+        pd.testing.assert_frame_equal(
+            archive[["date", "time", "bpm"]].sort_values(
+                "time").reset_index(drop=True),
+            database[["date", "time", "bpm"]].sort_values(
+                "time").reset_index(drop=True))
+
+        session.get_bind().dispose()